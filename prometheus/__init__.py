@@ -1,9 +1,21 @@
-__all__ = ["models","getpsf","synth","groupfit","leastsquares","allfit","multifit",
-           "ccddata","detection","aperture","sky","prometheus","utils","galfit","forced"]
+__all__ = ["models","getpsf","synth","groupfit","leastsquares","allfit","multifit","batch","service","compiled","engine","metrics","bench",
+           "ccddata","detection","aperture","sky","prometheus","utils","galfit","forced","completeness"]
 __version__ = '1.0.22'
 
-from .ccddata import CCDData
-from prometheus import prometheus as pm
+# The submodules and CCDData/read/run are imported on first use (PEP 562)
+#  so "import prometheus" does not pull in astropy, scipy, photutils, etc.
+import importlib
 
-read = CCDData.read
-run = pm.run
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.'+name,__name__)
+    if name=='CCDData':
+        return importlib.import_module('.ccddata',__name__).CCDData
+    if name=='read':
+        return importlib.import_module('.ccddata',__name__).CCDData.read
+    if name=='run':
+        return importlib.import_module('.prometheus',__name__).run
+    raise AttributeError('module '+__name__+' has no attribute '+name)
+
+def __dir__():
+    return sorted(list(globals().keys())+__all__+['CCDData','read','run'])
@@ -24,14 +24,10 @@ from dlnpyutils import utils as dln, bindata
 import copy
 import logging
 import time
-import matplotlib
 import sep
-from photutils.aperture import CircularAnnulus
-from astropy.stats import sigma_clipped_stats
 from . import leastsquares as lsq
 from . import groupfit,utils
 from .ccddata import CCDData,BoundingBox
-from photutils.psf.groupstars import DAOGroup
 
 # Fit a PSF model to all stars in an image
 
@@ -95,7 +91,8 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
     -------
     out : table
        Table of best-fitting parameters for each star.
-       id, amp, amp_error, x, x_err, y, y_err, sky
+       id, amp, amp_error, x, x_err, y, y_err, sky, niter, frozen (converged
+       before maxiter) ...
     model : numpy array
        Best-fitting model of the stars and sky background.
 
@@ -124,6 +121,7 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
     
     # Groups
     if 'group_id' not in cat.keys():
+        from photutils.psf.groupstars import DAOGroup
         daogroup = DAOGroup(crit_separation=2.5*psf.fwhm())
         starlist = cat.copy()
         starlist['x_0'] = cat['x']
@@ -143,7 +141,7 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
     dt = np.dtype([('id',int),('amp',float),('amp_error',float),('x',float),
                    ('x_error',float),('y',float),('y_error',float),('sky',float),
                    ('flux',float),('flux_error',float),('mag',float),('mag_error',float),
-                   ('niter',int),('group_id',int),('ngroup',int),('rms',float),('chisq',float)])
+                   ('niter',int),('frozen',bool),('group_id',int),('ngroup',int),('rms',float),('chisq',float)])
     outcat = np.zeros(nstars,dtype=dt)
     outcat = Table(outcat)
     if 'id' in cat.keys():
@@ -153,9 +151,9 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
         
     # Group Loop
     #---------------
-    resid = image.copy()
-    outmodel = CCDData(np.zeros(image.shape),bbox=image.bbox,unit=image.unit)
-    outsky = CCDData(np.zeros(image.shape),bbox=image.bbox,unit=image.unit)    
+    resid = image.datacopy()
+    outmodel = CCDData(np.zeros(image.shape,image.data.dtype),bbox=image.bbox,unit=image.unit)
+    outsky = CCDData(np.zeros(image.shape,image.data.dtype),bbox=image.bbox,unit=image.unit)    
     for g,grp in enumerate(groups):
         ind = starindex['index'][starindex['lo'][g]:starindex['hi'][g]+1]
         nind = len(ind)
@@ -177,6 +175,8 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
         if nind==1:
             inpcat = [inpcat['amp'][0],inpcat['x'][0],inpcat['y'][0]]
             out,model = psf.fit(resid,inpcat,niter=3,verbose=verbose,retfullmodel=True,recenter=recenter)
+            # stopped before the maximum number of iterations
+            out['frozen'] = out['niter'] < 3
             model.data -= out['sky']   # remove sky
             outmodel.data[model.bbox.slices] += model.data
             outsky.data[model.bbox.slices] = out['sky']
@@ -196,7 +196,7 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
         
         # Put in catalog
         cols = ['amp','amp_error','x','x_error','y','y_error',
-                'sky','flux','flux_error','mag','mag_error','niter','rms','chisq']
+                'sky','flux','flux_error','mag','mag_error','niter','frozen','rms','chisq']
         for c in cols:
             outcat[c][ind] = out[c]
         outcat['group_id'][ind] = grp
@@ -10,10 +10,10 @@ __version__ = '20241013'  # yyyymmdd
 import os
 import numpy as np
 import time
-from numba import njit,types,from_dtype
+from numba import types,from_dtype,prange
+from .compiled import njit   # njit with on-disk caching
 from numba.experimental import jitclass
 from . import utils_numba as utils, groupfit_numba as gfit, models_numba as mnb
-from .clock_numba import clock
 
 #@njit(cache=True)
 @njit
@@ -219,21 +219,11 @@ def initstararrays(image,error,mask,tab,psfnpix,fitradius,skyradius):
         invindex1 = invindex[invlo:invlo+n1]
         starfitinvindex[i,:n1] = invindex1
     
-    # For all of the fitting pixels, find the ones that
-    # a given star contributes to (basically within its PSF radius)
-    starflat_index = np.zeros((nstars,ntotpix),np.int64)-1
+    # The index of the flat pixels that each star contributes to is not
+    #  needed by allfit(), the stars are fit one at a time on the full
+    #  resid array.  Computing it is O(Nstars*Npix) in time and memory.
+    starflat_index = np.zeros((nstars,1),np.int64)-1
     starflat_ndata = np.zeros(nstars,np.int64)
-    for i in range(ntotpix):
-        x1 = xflat[i]
-        y1 = yflat[i]
-        for j in range(nstars):
-            pars1 = pars[3*i:3*i+3]
-            r = np.sqrt((xflat[i]-pars[1])**2 + (yflat[i]-pars[2])**2)
-            if r <= psfnpix:
-                starflat_index[j,starflat_ndata[j]] = i
-                starflat_ndata[j] += 1
-    maxndata = np.max(starflat_ndata)
-    starflat_index = starflat_index[:,:maxndata]
 
     return (im,err,msk,xx,yy,pars,npars,
             starravelindex,starndata,starfitravelindex,starfitndata,skyravelindex,skyndata,
@@ -398,7 +388,326 @@ def dofreeze(oldpars,newpars,minpercdiff):
     else:
         result = False
     return result
- 
+
+@njit
+def modelimage(psftype,psfparams,psfnpix,psflookup,imshape,tab):
+    """ Render the PSF models of all the stars (amp, xcen, ycen) into an image."""
+    ny,nx = imshape
+    shape = np.array([ny,nx])
+    im = np.zeros(ny*nx,np.float64)
+    hpsfnpix = psfnpix//2
+    for i in range(len(tab)):
+        pars1 = tab[i,:].copy()
+        bbox = utils.starbbox((pars1[1],pars1[2]),shape,hpsfnpix)
+        nbx = bbox[1]-bbox[0]
+        nby = bbox[3]-bbox[2]
+        if nbx<=0 or nby<=0:
+            continue
+        xind1 = np.zeros(nbx*nby,np.int64)
+        yind1 = np.zeros(nbx*nby,np.int64)
+        for j in range(nby):
+            for k in range(nbx):
+                xind1[j*nbx+k] = bbox[0]+k
+                yind1[j*nbx+k] = bbox[2]+j
+        m,_ = mnb.psf(xind1,yind1,pars1,psftype,psfparams,psflookup,
+                      shape,deriv=False,verbose=False)
+        im[yind1*nx+xind1] += m
+    return im.reshape(ny,nx)
+
+
+@njit
+def initallfit(psftype,psfparams,psfnpix,psflookup,image,error,mask,tab,
+               fitradius,skyradius):
+    """ Initialize the star arrays, the smooth sky, the residual and model images."""
+
+    nstars = len(tab)
+    ny,nx = image.shape                             # save image dimensions, python images are (Y,X)
+    imshape = np.array([ny,nx])
+    
+    # PSF information
+    #----------------
+    if psflookup.ndim != 3:
+        raise Exception('psflookup must have 3 dimensions')
+    psforder = psflookup.shape[2]
+    if psforder>1:
+        psforder = 1
+    # Package up the PSF information into a tuple to pass to the functions
+    psfdata = (psftype,psfparams,psflookup,psforder,imshape)
+    
+    # Star arrays
+    #------------
+    #  -full footprint: pixels of a star within the psf radius and not masked
+    #  -fitting pixels: pixels of a star within its fitting radius and not masked
+    #  -sky pixels: pixels in an annulus around a star and not masked
+    # Full footprint information
+    #   starravelindex - full footprint pixel index into the raveled 1D full image/resid array
+    #   starndata - number of pixels for star each star
+    # Fitting pixel information
+    #   starfitravelindex - fitting pixel index into the raveled 1D full image/resid array
+    #   starfitndata - number of fitting pixels for each star
+    # Sky pixel information
+    #   skyravelindex - sky pixel index into the raveled 1D full image/resid array
+    #   skyndata - number of star pixels for each star
+    
+    # Initialize the star arrays
+    initdata = initstararrays(image,error,mask,tab,psfnpix,fitradius,skyradius)
+    im,err,msk,xx,yy,pars,npars = initdata[:7]
+    starravelindex,starndata,starfitravelindex,starfitndata,skyravelindex,skyndata = initdata[7:13]
+    
+    # Package up the star information into a tuple for easy transport
+    stardata = (xx,yy,starravelindex,starndata,starfitravelindex,starfitndata,
+                skyravelindex,skyndata)
+    
+    # Image arrays
+    #-------------
+    #   im/err - full image and error arrays
+    #   resid - full 1D raveled residual image with the smooth sky subtracted
+    #             AND all of the star models subtracted
+    #   modelim - full 1D raveled image of all of the star models
+    #   skyim - full 1D raveled smooth sky image
+    
+    # Create initial sky image
+    #  improve initial sky estimate by removing initial models
+    tresid = np.zeros(imshape[0]*imshape[1],np.float64)
+    tresid[:] = im.copy().astype(np.float64).flatten()
+    for i in range(nstars):
+        pars1 = pars[3*i:3*i+3]
+        n1 = starndata[i]
+        ravelind1 = starravelindex[i,:n1]
+        xind1 = xx[ravelind1]
+        yind1 = yy[ravelind1]
+        xdata1 = (xind1,yind1)
+        m = psf(xdata1,pars1,psfdata)
+        tresid[ravelind1] -= m
+    skyim = utils.sky(tresid.copy().reshape(imshape[0],imshape[1])).flatten()
+
+    # Initialize RESID, subtract initial smooth sky and the initial star models
+    resid = np.zeros(imshape[0]*imshape[1],np.float64)
+    resid[:] = im.copy().astype(np.float64).flatten()   # flatten makes it easier to modify
+    resid[:] -= skyim          # subtract smooth sky
+    modelim = np.zeros(imshape[0]*imshape[1],np.float64)
+    for i in range(nstars):
+        pars1 = pars[3*i:3*i+3]
+        n1 = starndata[i]
+        ravelind1 = starravelindex[i,:n1]
+        xind1 = xx[ravelind1]
+        yind1 = yy[ravelind1]
+        m,_ = mnb.psf(xind1,yind1,pars1,psftype,psfparams,psflookup,
+                      imshape,deriv=False,verbose=False)
+        resid[ravelind1] -= m
+        modelim[ravelind1] += m
+
+    return psfdata,stardata,im,err,pars,resid,modelim,skyim
+
+
+#@njit(cache=True)
+@njit(nogil=True)
+def fitstar(i,niter,psfdata,stardata,pars,resid,modelim,err,
+            freezestars,starsky,starniter,starchisq,starrms,minpercdiff):
+    """
+    One iteration of the fit of a single star.  The star's parameters and
+    statistics, and resid/modelim within its full footprint are updated in
+    place.  Only the star's sky annulus, fitting pixels and full footprint
+    are read or written.
+    """
+    psftype,psfparams,psflookup,psforder,imshape = psfdata
+    (xx,yy,starravelindex,starndata,starfitravelindex,starfitndata,
+     skyravelindex,skyndata) = stardata
+
+    # Get fitting information for this star
+    pars1 = pars[3*i:3*i+3].copy()
+    fn1 = starfitndata[i]
+    fravelindex1 = starfitravelindex[i,:fn1]
+    fxind1 = xx[fravelindex1]
+    fyind1 = yy[fravelindex1]
+            
+    # Get local sky
+    sn1 = skyndata[i]
+    skyravelindex1 = skyravelindex[i,:sn1]
+    sky1 = getstarsky(skyravelindex1,resid,err)
+    starsky[i] = sky1
+            
+    # Get new best parameters
+    newpars1 = starfit(psftype,psfparams,psflookup,imshape,
+                       pars1,fxind1,fyind1,fravelindex1,resid,err,sky1)
+    freezestars[i] = dofreeze(pars1,newpars1,minpercdiff)
+
+    # Update the residuals for a star's full footprint
+    #  add in the previous full footprint model
+    #  and subtract the new full footprint model
+    n1 = starndata[i]
+    ravelindex1 = starravelindex[i,:n1]
+    xind1 = xx[ravelindex1]
+    yind1 = yy[ravelindex1]
+    prevmodel,_ = mnb.psf(xind1,yind1,pars1,psftype,psfparams,psflookup,
+                          imshape,deriv=False,verbose=False)
+    newmodel,_ = mnb.psf(xind1,yind1,newpars1,psftype,psfparams,psflookup,
+                         imshape,deriv=False,verbose=False)
+    resid[ravelindex1] += prevmodel
+    resid[ravelindex1] -= newmodel
+    # Update the model image
+    modelim[ravelindex1] += prevmodel
+    modelim[ravelindex1] -= newmodel
+            
+    # Calculate chisq with updated resid array
+    chisq1 = np.sum(resid[fravelindex1]**2/err.ravel()[fravelindex1]**2)
+    rms1 = np.sqrt(np.mean((resid[fravelindex1]/newpars1[0])**2))
+            
+    # Save new values
+    pars[3*i:3*i+3] = newpars1
+    starniter[i] = niter
+    starchisq[i] = chisq1
+    starrms[i] = rms1
+
+
+@njit
+def reskyallfit(im,modelim,skyim,resid,imshape):
+    """ Re-estimate the smooth sky with the current models removed and update resid."""
+    prevsky = skyim.copy()
+    # Remove the current best-fit model
+    tresid = im - modelim.copy().reshape(imshape[0],imshape[1])    # remove model
+    newsky = utils.sky(tresid).flatten()
+    # Update resid
+    resid[:] += prevsky
+    resid[:] -= newsky
+    skyim[:] = newsky
+
+
+@njit
+def allfitoutput(psfdata,stardata,tab,pars,resid,err,psfflux,
+                 starsky,starniter,starchisq,starrms,niter):
+    """ Calculate the parameter uncertainties and put the results in the output table."""
+    psftype,psfparams,psflookup,psforder,imshape = psfdata
+    (xx,yy,starravelindex,starndata,starfitravelindex,starfitndata,
+     skyravelindex,skyndata) = stardata
+    nstars = len(tab)
+    
+    # Check that all starniter are set properly
+    #  if we stopped "prematurely" then not all stars were frozen
+    #  and didn't have starniter set
+    starniter[np.where(starniter==0)] = niter
+    
+    # Calculate parameter uncertainties
+    # estimate uncertainties
+    # Calculate covariance matrix
+    perror = np.zeros(len(pars),np.float64)
+    for i in range(nstars):
+        # Get fitting information for this star
+        pars1 = pars[3*i:3*i+3]
+        fn1 = starfitndata[i]
+        fravelindex1 = starfitravelindex[i,:fn1]
+        fxind1 = xx[fravelindex1]
+        fyind1 = yy[fravelindex1]
+        cov1 = starcov(psftype,psfparams,psflookup,imshape,
+                       pars1,fxind1,fyind1,fravelindex1,resid,err)
+        perror1 = np.sqrt(np.diag(cov1))
+        perror[3*i:3*i+3] = perror1
+    
+    # Put in catalog
+    #  the stars were sorted by amp in initstararrays(), put them
+    #  back in the order of the input table
+    si = np.argsort(tab[:,1])[::-1]
+    outtab = np.zeros((nstars,15),np.float64)
+    outtab[si,0] = tab[si,0]                         # id
+    outtab[si,1] = pars[0::3]                        # amp
+    outtab[si,2] = perror[0::3]                      # amp_error
+    outtab[si,3] = pars[1::3]                        # x
+    outtab[si,4] = perror[1::3]                      # x_error
+    outtab[si,5] = pars[2::3]                        # y
+    outtab[si,6] = perror[2::3]                      # y_error
+    outtab[si,7] = starsky                           # sky
+    outtab[:,8] = outtab[:,1]*psfflux                # flux
+    outtab[:,9] = outtab[:,2]*psfflux                # flux_error
+    outtab[:,10] = -2.5*np.log10(np.maximum(outtab[:,8],1e-10))+25.0   # mag
+    outtab[:,11] = (2.5/np.log(10))*outtab[:,9]/np.maximum(outtab[:,8],1e-10)   # mag_error
+    outtab[si,12] = starrms
+    outtab[si,13] = starchisq
+    outtab[si,14] = starniter                     # niter, what iteration it converged on
+
+    return outtab
+
+
+@njit
+def starcolors(x,y,dist):
+    """
+    Greedy colouring of the star overlap graph.  Two stars are connected
+    if they are closer than dist.  The stars are coloured in the input
+    order with the lowest colour that none of their neighbours have.
+
+    Parameters
+    ----------
+    x : numpy array
+       X-coordinates of the stars.
+    y : numpy array
+       Y-coordinates of the stars.
+    dist : float
+       Distance below which two stars conflict.
+
+    Returns
+    -------
+    colors : numpy array
+       Colour (0 to ncolors-1) of each star.
+
+    Example
+    -------
+
+    colors = starcolors(x,y,50.0)
+
+    """
+    nstars = len(x)
+    colors = np.zeros(nstars,np.int64)-1
+    if nstars==0:
+        return colors
+    # Put the stars on a grid of dist-sized cells so that the
+    #  neighbours can only be in the adjacent cells
+    x0 = np.min(x)
+    y0 = np.min(y)
+    ncx = int((np.max(x)-x0)/dist)+1
+    ncy = int((np.max(y)-y0)/dist)+1
+    cx = np.zeros(nstars,np.int64)
+    cy = np.zeros(nstars,np.int64)
+    cell = np.zeros(nstars,np.int64)
+    for i in range(nstars):
+        cx[i] = int((x[i]-x0)/dist)
+        cy[i] = int((y[i]-y0)/dist)
+        cell[i] = cy[i]*ncx+cx[i]
+    cindex = np.argsort(cell,kind='mergesort')
+    clo = np.zeros(ncx*ncy+1,np.int64)
+    for i in range(nstars):
+        clo[cell[i]+1] += 1
+    clo = np.cumsum(clo)
+    # Colour the stars
+    used = np.zeros(nstars+1,np.bool_)
+    for i in range(nstars):
+        for iy in range(max(cy[i]-1,0),min(cy[i]+2,ncy)):
+            for ix in range(max(cx[i]-1,0),min(cx[i]+2,ncx)):
+                c = iy*ncx+ix
+                for k in range(clo[c],clo[c+1]):
+                    j = cindex[k]
+                    if colors[j]>=0 and (x[i]-x[j])**2+(y[i]-y[j])**2 < dist**2:
+                        used[colors[j]] = True
+        col = 0
+        while used[col]:
+            col += 1
+        colors[i] = col
+        used[:] = False
+    return colors
+
+
+#@njit(cache=True)
+@njit(parallel=True,nogil=True)
+def fitcolorclass(index,niter,psfdata,stardata,pars,resid,modelim,err,
+                  freezestars,starsky,starniter,starchisq,starrms,minpercdiff):
+    """
+    Fit all of the stars of a colour class in parallel.  The stars of a class
+    do not share any pixels so the order in which they are fit does not matter.
+    """
+    for k in prange(len(index)):
+        i = index[k]
+        if freezestars[i]==False:
+            fitstar(i,niter,psfdata,stardata,pars,resid,modelim,err,
+                    freezestars,starsky,starniter,starchisq,starrms,minpercdiff)
+
 
 #@njit(cache=True)
 @njit
@@ -461,96 +770,15 @@ def allfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     
     """
 
-    # ----- START copied from groupfit_numba.py ---------
-
-    start = clock()
-    
     nstars = len(tab)
     skyradius = psfnpix//2 + 10
     ny,nx = image.shape                             # save image dimensions, python images are (Y,X)
     imshape = np.array([ny,nx])
-    
-    # PSF information
-    #----------------
-    _,_,npsforder = psflookup.shape
-    psforder = 0
-    if npsforder==4:
-        psforder = 1
-    if psflookup.ndim != 3:
-        raise Exception('psflookup must have 3 dimensions')
-    psforder = psflookup.shape[2]
-    if psforder>1:
-        psforder = 1
-    # Package up the PSF information into a tuple to pass to the functions
-    psfdata = (psftype,psfparams,psflookup,psforder,imshape)
-    
-    # Star arrays
-    #------------
-    #  -full footprint: pixels of a star within the psf radius and not masked
-    #  -fitting pixels: pixels of a star within its fitting radius and not masked
-    #  -sky pixels: pixels in an annulus around a star and not masked
-    #  -flat pixels: all fitting pixels of all stars combined (unique),
-    #                  these are the pixels that we are actually fitting
-    # Full footprint information
-    #   starravelindex -
-    #   starndata - number of pixels for star each star
-    # Fitting pixel information
-    #   starfitravelindex - fitting pixel index into the raveled 1D full image/resid array
-    #   starfitndata - number of fitting pixels for each star
-    # Sky pixel information
-    #   skyravelindex - sky pixel index into the raveled 1D full image/resid array
-    #   skyndata - number of star pixels for each star
-    # Flat information
-    #   xflat/yflat - x/y values of the flat pixels
-    #   indflat - index of the flat pixels into the full 1D raveled arrays
-    #   starflat_index - index of all flat pixels that are within a star's full footprint
-    #                         index into the flat 1D array
-    #   starflat_ndata - number of flat pixels for each star
-    
-    # Initialize the star arrays
-    initdata = initstararrays(image,error,mask,tab,psfnpix,fitradius,skyradius)
-    im,err,msk,xx,yy,pars,npars = initdata[:7]
-    starravelindex,starndata,starfitravelindex,starfitndata,skyravelindex,skyndata = initdata[7:13]
-    xflat,yflat,indflat,imflat,errflat,resflat,ntotpix = initdata[13:20]
-    starfitinvindex,starflat_index,starflat_ndata = initdata[20:]
-    
-    # Package up the star information into tuples for easy transport
-    stardata = (starravelindex,starndata,xx,yy)
-    flatdata = (starflat_ndata,starflat_index,xflat,yflat,indflat,ntotpix)
-    
-    # Image arrays
-    #-------------
-    # Full arrays:
-    #   im/err/mask - full 1D raveled image, error and mask arrays
-    #   resid - full 1D raveled residual image with the smooth sky subtracted
-    #             AND any frozen stars subtracted
-    # Flat arrays:
-    #   indflat - index of the flat pixels into the full 1D raveled arrays
-    #   imflat/errflat - 1D raveled image and error arrays for the flat/fitting pixels
-    #   skyflat - smooth sky values for the flat pixels
-    #   resflat - flat pixel values of "resid"
-    
-    # Create initial sky image
-    #  improve initial sky estimate by removing initial models
-    tresid = np.zeros(imshape[0]*imshape[1],np.float64)
-    tresid[:] = im.copy().astype(np.float64).flatten()
-    for i in range(nstars):
-        pars1 = pars[3*i:3*i+3]
-        n1 = starndata[i]
-        ravelind1 = starravelindex[i]
-        xind1 = xx[ravelind1]
-        yind1 = yy[ravelind1]
-        xdata1 = (xind1,yind1)
-        m = psf(xdata1,pars1,psfdata)
-        tresid[ravelind1] -= m
-    skyim = utils.sky(tresid.copy().reshape(imshape[0],imshape[1])).flatten()
-    skyflat = skyim[indflat]
 
-    # Initialize RESID and subtract initial smooth sky
-    resid = np.zeros(imshape[0]*imshape[1],np.float64)
-    resid[:] = im.copy().astype(np.float64).flatten()   # flatten makes it easier to modify
-    resid[:] -= skyim          # subtract smooth sky
-    resflat = resid[indflat]   # initialize resflat
+    # Initialize the star arrays, sky, resid and model images
+    initdata = initallfit(psftype,psfparams,psfnpix,psflookup,image,error,mask,
+                          tab,fitradius,skyradius)
+    psfdata,stardata,im,err,pars,resid,modelim,skyim = initdata
 
     # Perform the fitting
     #--------------------
@@ -561,265 +789,251 @@ def allfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     starchisq = np.zeros(nstars,np.float64)
     starrms = np.zeros(nstars,np.float64)
     freezestars = np.zeros(nstars,np.bool_)
-    freezepars = np.zeros(len(pars),np.bool_)
-    
-    # Initial estimates
-    initpar = pars.copy()
-    # Make bounds
-    #  this requires all 3*Nstars parameters to be input
-    bounds = utils.mkbounds(initpar,imshape,2)    
-    
-    # Iterate
-    bestpar_all = initpar.copy()
-    allpars = initpar.copy()
-    bestpar = initpar.copy()
-    
-
-    
-    # ----- END copied from groupfit_numba.py ---------
-
-
-    return
-
-
-    
-    # nstars = len(tab)
-    # _,_,npsforder = psflookup.shape
-    # psforder = 0
-    # if npsforder==4:
-    #     psforder = 1
-    # if psflookup.ndim != 3:
-    #     raise Exception('psflookup must have 3 dimensions')
-    # psforder = psflookup.shape[2]
-    # if psforder>1:
-    #     psforder = 1
-    # ny,nx = image.shape                             # save image dimensions, python images are (Y,X)
-    # nx = nx
-    # ny = ny
-    # imshape = np.array([ny,nx])
-    # im = image.copy().astype(np.float64)
-    # err = error.copy().astype(np.float64)
-    # msk = mask.copy().astype(np.bool_)
-    # xx,yy = utils.meshgrid(np.arange(nx),np.arange(ny))
-    # xx = xx.flatten()
-    # yy = yy.flatten()
-    # # Order stars by flux, brightest first
-    # si = np.argsort(tab[:,1])[::-1]       # largest amp first
-    # startab = tab[si]                     # ID, amp, xcen, ycen
-    # initpars = startab[:,1:4]             # amp, xcen, ycen
-    # nfitpix = int(np.ceil(fitradius))     # +/- nfitpix
-    # skyradius = psfnpix//2 + 10
-    # # Initialize the parameter array
-    # initpars = startab[:,1:4] 
-    # pars = np.zeros(nstars*3,float) # amp, xcen, ycen
-    # pars[0::3] = initpars[:,0]
-    # pars[1::3] = initpars[:,1]
-    # pars[2::3] = initpars[:,2]
-    
-    # # Get information for all the stars
-    # xcen = pars[1::3]
-    # ycen = pars[2::3]
-    # hpsfnpix = psfnpix//2
-    # out = collatestarsinfo(imshape,msk,xcen,ycen,hpsfnpix,fitradius,skyradius)
-    # starravelindex,starndata,starfitravelindex,starfitndata,skyravelindex,skyndata = out
-    
-    # # Put indices of all the unique fitted pixels into one array
-    # ntotpix = np.sum(starfitndata)
-    # allravelindex = np.zeros(ntotpix,np.int64)
-    # count = 0
-    # for i in range(nstars):
-    #     n1 = starfitndata[i]
-    #     ravelind1 = starfitravelindex[i,:n1]
-    #     allravelindex[count:count+n1] = ravelind1
-    #     count += n1
-    # allravelindex = np.unique(allravelindex)
-    # ravelindex = allravelindex
-    # ntotpix = len(allravelindex)
-    
-    # # Create initial smooth sky image
-    # skyim = utils.sky(im).flatten()
-    # # Subtract the initial models from the residual array
-    # resid = np.zeros(imshape[0]*imshape[1],np.float64)
-    # resid[:] = im.copy().astype(np.float64).flatten()   # flatten makes it easier to modify
-    # resid[:] -= skyim   # subtract smooth sky
-    # modelim = np.zeros(imshape[0]*imshape[1],np.float64)
-    # for i in range(nstars):
-    #     pars1 = pars[3*i:3*i+3]
-    #     n1 = starndata[i]
-    #     ravelind1 = starravelindex[i]
-    #     xind1 = xx[ravelind1]
-    #     yind1 = yy[ravelind1]
-    #     m,_ = mnb.psf(xind1,yind1,pars1,psftype,psfparams,psflookup,
-    #                   imshape,deriv=False,verbose=False)
-    #     resid[ravelind1] -= m
-    #     modelim[ravelind1] += m
-        
-    # # Sky and Niter arrays for the stars
-    # starsky = np.zeros(nstars,np.float64)
-    # starniter = np.zeros(nstars,np.int64)
-    # starchisq = np.zeros(nstars,np.float64)
-    # starrms = np.zeros(nstars,np.float64)
-    # freezestars = np.zeros(nstars,np.bool_)
     
     # While loop
     niter = 1
-    maxpercdiff = 1e10
     nfreestars = nstars
     while (niter<maxiter and nfreestars>0):
-        start0 = clock()
             
         # Star loop
         for i in range(nstars):
             # Fit the single star (if not frozen)
             if freezestars[i]==True:
                 continue
-            
-            # Get fitting information for this star
-            pars1 = pars[3*i:3*i+3]
-            fn1 = starfitndata[i]
-            fravelindex1 = starfitravelindex[i,:fn1]
-            fxind1 = xx[fravelindex1]
-            fyind1 = yy[fravelindex1]
-            
-            # Get local sky
-            sn1 = skyndata[i]
-            skyravelindex1 = skyravelindex[i,:sn1]
-            sky1 = getstarsky(skyravelindex1,resid,err)
-            starsky[i] = sky1
-            
-            # Get new best parameters
-            newpars1 = starfit(psftype,psfparams,psflookup,imshape,
-                               pars1,fxind1,fyind1,fravelindex1,resid,err,sky1)
-            freezestars[i] = dofreeze(pars1,newpars1,minpercdiff)
-
-            # Update the residuals for a star's full footprint
-            #  add in the previous full footprint model
-            #  and subtract the new full footprint model
-            n1 = starndata[i]
-            ravelindex1 = starravelindex[i,:n1]
-            xind1 = xx[ravelindex1]
-            yind1 = yy[ravelindex1]
-            prevmodel,_ = mnb.psf(xind1,yind1,pars1,psftype,psfparams,psflookup,
-                                  imshape,deriv=False,verbose=False)
-            newmodel,_ = mnb.psf(xind1,yind1,newpars1,psftype,psfparams,psflookup,
-                                 imshape,deriv=False,verbose=False)
-            resid[ravelindex1] += prevmodel
-            resid[ravelindex1] -= newmodel
-            # Update the model image
-            modelim[ravelindex1] += prevmodel
-            modelim[ravelindex1] -= newmodel
-            
-            # Calculate chisq with updated resid array
-            chisq1 = np.sum(resid[fravelindex1]**2/error.ravel()[fravelindex1]**2)
-            rms1 = np.sqrt(np.mean((resid[fravelindex1]/newpars1[0])**2))
-            
-            # Save new values
-            pars[3*i:3*i+3] = newpars1
-            starniter[i] = niter
-            starchisq[i] = chisq1
-            starrms[i] = rms1
+            fitstar(i,niter,psfdata,stardata,pars,resid,modelim,err,
+                    freezestars,starsky,starniter,starchisq,starrms,minpercdiff)
     
             if verbose:
                 print('Iter = ',niter)
-                print('Pars = ',newpars1)
-                print('chisq = ',chisq1)
+                print('Pars = ',pars[3*i:3*i+3])
+                print('chisq = ',starchisq[i])
                 
         # Re-estimate the sky
         if niter % reskyiter == 0:
             if verbose:
                 print('Re-estimating the sky')
-            prevsky = skyim.copy()
-            # Remove the current best-fit model
-            tresid = im - modelim.copy().reshape(imshape[0],imshape[1])    # remove model
-            skyim = utils.sky(tresid).flatten()
-            # Update resid
-            resid[:] += prevsky
-            resid[:] -= skyim
-            # CHECK THAT WE ARE DOING THIS CORRECTLY!!
-            # resflat, skyflat???
-            
-        if verbose:
-            print('iter dt =',(clock()-start0)/1e9,'sec.')
+            reskyallfit(im,modelim,skyim,resid,imshape)
 
         nfreezestars = np.sum(freezestars)
         nfreestars = nstars-nfreezestars
             
         niter += 1     # increment counter
 
-            
-    # Check that all starniter are set properly
-    #  if we stopped "prematurely" then not all stars were frozen
-    #  and didn't have starniter set
-    starniter[np.where(starniter==0)] = niter
+    # The stars that were not frozen ran until the last iteration
+    starniter[~freezestars] = niter
+
+    # Parameter uncertainties and output table
+    outtab = allfitoutput(psfdata,stardata,tab,pars,resid,err,psfflux,
+                          starsky,starniter,starchisq,starrms,niter)
+
+    # DO WE NEED TO RECALCULATE chi-squared and RMS for each star ????
     
-    # Calculate parameter uncertainties
-    # estimate uncertainties
-    # Calculate covariance matrix
-    perror = np.zeros(len(pars),np.float64)
+    return outtab,modelim,skyim
+
+
+#@njit(cache=True)
+@njit(nogil=True)
+def allfit_parallel(psftype,psfparams,psfnpix,psflookup,psfflux,
+                    image,error,mask,tab,fitradius,maxiter=10,
+                    minpercdiff=0.5,reskyiter=2,verbose=False,
+                    nofreeze=False):
+    """
+    Fit PSF to all stars iteratively using multiple threads.
+
+    The stars are partitioned into colour classes from the graph of
+    overlapping footprints (the full footprint of one star and the sky
+    annulus of the other) so that the stars of a class never read or write
+    the same residual pixels.  The classes are fit one after another and the
+    stars of a class in parallel.  The results do not depend on the number of
+    threads (set with numba.set_num_threads()), but they are slightly
+    different from allfit() because the stars are not fit strictly in
+    brightness order.
+
+    Parameters
+    ----------
+    psftype : int
+       PSF type.
+    psfparams: numpy array
+       PSF analytical parameters.
+    psfnpix : int
+       Number of pixels in the PSF footprint.
+    psflookup : numpy array
+       PSF lookup table.  Must be 3D.
+    psfflux : float
+       PSF flux.
+    image : numpy array
+       The image to fit.
+    error : numpy array
+       Uncertainty for image.
+    mask : numpy array
+       Boolean mask for image.  True - bad, False - good.
+    tab : numpy array
+       Table of initial guesses for each star.
+       id, amp, xcen, ycen
+    maxiter : int, optional
+       Maximum number of iterations to allow.  Default is 10.
+    minpercdiff : float, optional
+       Minimum percent change in the parameters to allow until the solution is
+       considered converged and the iteration loop is stopped.  Default is 0.5.
+    reskyiter : int, optional
+       After how many iterations to re-calculate the sky background. Default is 2.
+    nofreeze : boolean, optional
+       Do not freeze any parameters even if they have converged.  Default is False.
+    verbose : boolean, optional
+       Verbose output.
+    
+    Returns
+    -------
+    out : table
+       Table of best-fitting parameters for each star.
+       id, amp, amp_error, x, x_err, y, y_err, sky
+    model : numpy array
+       Best-fitting model of the stars and sky background.
+    sky : numpy array
+       Best-fitting sky image.
+
+    Examples
+    --------
+
+    out,model,sky = allfit_parallel(psf,image,error,mask,tab)
+    
+    """
+
+    nstars = len(tab)
+    hpsfnpix = psfnpix//2
+    skyradius = psfnpix//2 + 10
+    ny,nx = image.shape                             # save image dimensions, python images are (Y,X)
+    imshape = np.array([ny,nx])
+
+    # Initialize the star arrays, sky, resid and model images
+    initdata = initallfit(psftype,psfparams,psfnpix,psflookup,image,error,mask,
+                          tab,fitradius,skyradius)
+    psfdata,stardata,im,err,pars,resid,modelim,skyim = initdata
+
+    # Colour classes
+    #  a star writes to its full footprint (hpsfnpix) and reads its
+    #  sky annulus (skyradius), add 2 pixels for the pixel rounding
+    colors = starcolors(pars[1::3],pars[2::3],float(hpsfnpix+skyradius+2))
+    ncolors = np.max(colors)+1
+    colorindex = np.argsort(colors,kind='mergesort')   # stable, keeps brightness order
+    colorlo = np.zeros(ncolors+1,np.int64)
     for i in range(nstars):
-        # Get fitting information for this star
-        pars1 = pars[3*i:3*i+3]
-        fn1 = starfitndata[i]
-        fravelindex1 = starfitravelindex[i,:fn1]
-        fxind1 = xx[fravelindex1]
-        fyind1 = yy[fravelindex1]
-        cov1 = starcov(psftype,psfparams,psflookup,imshape,
-                       pars1,fxind1,fyind1,fravelindex1,resid,err)
-        perror1 = np.sqrt(np.diag(cov1))
-        perror[3*i:3*i+3] = perror1
-    perror[:] = perror
+        colorlo[colors[i]+1] += 1
+    colorlo = np.cumsum(colorlo)
+    if verbose:
+        print(ncolors,' colour classes')
     
-    # Put in catalog
-    outtab = np.zeros((nstars,15),np.float64)
-    outtab[:,0] = np.arange(nstars)+1                # id
-    outtab[:,1] = pars[0:-1:3]                       # amp
-    outtab[:,2] = perror[0:-1:3]                     # amp_error
-    outtab[:,3] = pars[1::3]                         # x
-    outtab[:,4] = perror[1::3]                       # x_error
-    outtab[:,5] = pars[2::3]                         # y
-    outtab[:,6] = perror[2::3]                       # y_error
-    outtab[:,7] = starsky                            # sky
-    outtab[:,8] = outtab[:,1]*psfflux                # flux
-    outtab[:,9] = outtab[:,2]*psfflux                # flux_error
-    outtab[:,10] = -2.5*np.log10(np.maximum(outtab[:,8],1e-10))+25.0   # mag
-    outtab[:,11] = (2.5/np.log(10))*outtab[:,9]/outtab[:,8]            # mag_error
-    outtab[:,12] = starrms
-    outtab[:,13] = starchisq
-    outtab[:,14] = starniter                      # niter, what iteration it converged on
+    # Perform the fitting
+    #--------------------
 
-    # DO WE NEED TO RECALCULATE chi-squared and RMS for each star ????
+    # Initialize arrays for the stars and freezing parameters
+    starsky = np.zeros(nstars,np.float64)
+    starniter = np.zeros(nstars,np.int64)
+    starchisq = np.zeros(nstars,np.float64)
+    starrms = np.zeros(nstars,np.float64)
+    freezestars = np.zeros(nstars,np.bool_)
+    
+    # While loop
+    niter = 1
+    nfreestars = nstars
+    while (niter<maxiter and nfreestars>0):
+
+        # Colour class loop, the stars of a class are fit in parallel
+        for c in range(ncolors):
+            index = colorindex[colorlo[c]:colorlo[c+1]]
+            fitcolorclass(index,niter,psfdata,stardata,pars,resid,modelim,err,
+                          freezestars,starsky,starniter,starchisq,starrms,minpercdiff)
+                
+        # Re-estimate the sky
+        if niter % reskyiter == 0:
+            if verbose:
+                print('Re-estimating the sky')
+            reskyallfit(im,modelim,skyim,resid,imshape)
+
+        nfreezestars = np.sum(freezestars)
+        nfreestars = nstars-nfreezestars
+        if verbose:
+            print('Iter = ',niter,' nfree = ',nfreestars)
+            
+        niter += 1     # increment counter
+
+    # The stars that were not frozen ran until the last iteration
+    starniter[~freezestars] = niter
+
+    # Parameter uncertainties and output table
+    outtab = allfitoutput(psfdata,stardata,tab,pars,resid,err,psfflux,
+                          starsky,starniter,starchisq,starrms,niter)
     
     return outtab,modelim,skyim
     
 
-def pallfit(psf,image,tab,fitradius=0.0,maxiter=10,minpercdiff=0.5,
-           reskyiter=2,nofreeze=False,verbose=False):
+# Integer PSF types used by the numba functions
+PSFTYPES = {'PSFGaussian':1, 'PSFMoffat':2, 'PSFPenny':3, 'PSFGausspow':4,
+            'Sersic':5, 'PSFEmpirical':6}
+
+def psftypeid(psf):
+    """ Return the integer PSF type of a PSF object, or 0 if it is not supported."""
+    return PSFTYPES.get(type(psf).__name__,0)
+
+
+def inputtab(psf,tab):
+    """ Initial id/amp/x/y array of the stars, amp is estimated from flux if needed."""
+    for n in ['x','y']:
+        if n not in tab.keys():
+            raise ValueError('Cat must have x and y columns')
+    nstars = len(tab)
+    inptab = np.zeros((nstars,4),np.float64)
+    if 'id' in tab.keys():
+        inptab[:,0] = tab['id']
+    else:
+        inptab[:,0] = np.arange(nstars)+1
+    if 'amp' in tab.keys():
+        inptab[:,1] = tab['amp']
+    else:
+        # Estimate amp from flux and fwhm
+        # area under 2D Gaussian is 2*pi*A*sigx*sigy
+        if 'fwhm' in tab.keys():
+            amp = tab['flux']/(2*np.pi*(tab['fwhm']/2.35)**2)
+        else:
+            amp = tab['flux']/(2*np.pi*(psf.fwhm()/2.35)**2)
+        inptab[:,1] = np.maximum(amp,0)   # make sure it's positive
+    inptab[:,2] = tab['x']
+    inptab[:,3] = tab['y']
+    return inptab
+
+
+def pallfit(psf,image,tab,fitradius=None,maxiter=10,minpercdiff=0.5,
+            reskyiter=2,nofreeze=False,static=None,nthreads=None,verbose=False):
     """
     Fit PSF to all stars in an image iteratively.
 
     Parameters
     ----------
     psf : PSF object
-       PSF object to use for the fitting.
+       PSF object to use for the fitting.  Only the analytic PSF types without
+         a lookup table are supported.
     image : CCDData object
        Image to use to fit PSF model to stars.
     tab : table
        Catalog with initial amp/x/y values for the stars to use to fit the PSF.
-       To pre-group the stars, add a "group_id" in the catalog.
+         If there is no "amp" column, it is estimated from "flux".
     fitradius : float, optional
        The fitting radius in pixels.  By default the PSF FWHM is used.
-           reskyiter=2,nofreeze=False,skyfit=True,verbose=False):
     maxiter : int, optional
-       Maximum number of iterations to allow.  Only for methods "cholesky", "qr" or "svd".
-       Default is 10.
+       Maximum number of iterations to allow.  Default is 10.
     minpercdiff : float, optional
        Minimum percent change in the parameters to allow until the solution is
-       considered converged and the iteration loop is stopped.  Only for methods
-       "cholesky", "qr" and "svd".  Default is 0.5.
+       considered converged and the iteration loop is stopped.  Default is 0.5.
     reskyiter : int, optional
        After how many iterations to re-calculate the sky background. Default is 2.
     nofreeze : boolean, optional
        Do not freeze any parameters even if they have converged.  Default is False.
+    static : boolean, optional
+       Use the AOT-compiled allfit().  By default, it is used if it was built.
+    nthreads : int, optional
+       Number of threads.  If set, the JIT-compiled allfit_parallel() is used
+         which fits the stars of each colour class in parallel.  The results do
+         not depend on nthreads.  By default, the serial allfit() is used.
     verbose : boolean, optional
        Verbose output.
 
@@ -827,97 +1041,139 @@ def pallfit(psf,image,tab,fitradius=0.0,maxiter=10,minpercdiff=0.5,
     -------
     out : table
        Table of best-fitting parameters for each star.
-       id, amp, amp_error, x, x_err, y, y_err, sky
-    model : numpy array
-       Best-fitting model of the stars and sky background.
-    sky : numpy array
-       Best-fitting sky image.
+       id, amp, amp_error, x, x_err, y, y_err, sky, niter, frozen (converged
+       before maxiter) ...
+    model : CCDData object
+       Best-fitting model of the stars.
+    sky : CCDData object
+       Best-fitting smooth sky image.
 
     Example
     -------
 
-    outtab,model,sky = gf.fit()
+    outtab,model,sky = pallfit(psf,image,tab)
 
     """
+    from astropy.table import Table
+    from .ccddata import CCDData
+    from . import compiled
 
     t0 = time.time()
 
-    # if skyfit==False:
-    #     self.freezepars[-1] = True  # freeze sky value
-        
-    # # Centroids fixed
-    # if recenter==False:
-    #     self.freezepars[1::3] = True  # freeze X values
-    #     self.freezepars[2::3] = True  # freeze Y values
-
-    # Create AllFitter object
-    fitradius = 3.0
-    if psf.haslookup:
-        psflookup = psf.lookup.copy().astype(np.float64)
+    psftype = psftypeid(psf)
+    if psftype==0 or psftype==6 or psf.haslookup or psf.binned:
+        raise ValueError('pallfit() only supports unbinned analytic PSFs without a lookup table')
+    inptab = inputtab(psf,tab)
+    nstars = len(inptab)
+
+    if fitradius is None or fitradius<=0:
+        fitradius = psf.fwhm()
+    data = np.ascontiguousarray(image.data,np.float64)
+    error = np.ascontiguousarray(image.error,np.float64)
+    if image.mask is not None:
+        mask = np.ascontiguousarray(image.mask,np.bool_)
     else:
-        psflookup = np.zeros((1,1,1),np.float64)
-    psfflux = psf.flux()
-    out = numba_allfit(psf.psftype,psf.params,psf.npix,psflookup,psfflux,
-                       image.data,image.error,image.mask,tab,fitradius,
-                       maxiter,minpercdiff,reskyiter,verbose,nofreeze)
-    outtab,model,skyim = out
-    model = model.reshape(image.shape)
-    skyim = skyim.reshape(image.shape)
-    return outtab,model,skyim
-        
-    #af = AllFitter(psf.psftype,psf.params,psf.npix,psflookup,
-    #               image.data,image.error,image.mask,tab,
-    #               fitradius,verbose,nofreeze)
-    ## Fit the stars iteratively
-    #af.fit()
-    
-    # Make final model
-    # self.unfreeze()
-    model = af.modelim.copy().reshape(af.imshape)
-    skyim = af.skyim.copy().reshape(af.imshape)
-
-    # Parameters and uncertainties
-    pars = af.pars
-    perror = af.perror
+        mask = np.zeros(image.shape,np.bool_)
+    psfparams = np.ascontiguousarray(psf.params,np.float64)
+    psflookup = np.zeros((1,1,1),np.float64)
+    psfflux = float(psf.flux())
+
+    args = (psftype,psfparams,int(psf.npix),psflookup,psfflux,
+            data,error,mask,inptab,float(fitradius),
+            int(maxiter),float(minpercdiff),int(reskyiter),False,bool(nofreeze))
+    if nthreads is not None:
+        # The parallel version is only JIT-compiled
+        import numba
+        nthreads = int(np.clip(nthreads,1,numba.config.NUMBA_NUM_THREADS))
+        prevthreads = numba.get_num_threads()
+        numba.set_num_threads(nthreads)
+        try:
+            out = allfit_parallel(*args)
+        finally:
+            numba.set_num_threads(prevthreads)
+    else:
+        afit = compiled.load('allfit',static)
+        out = afit.allfit(*args)
+    outarr,modelim,skyim = out
 
     # Put in catalog
-    outtab = np.zeros((af.nstars,15),np.float64)
-    outtab[:,0] = np.arange(af.nstars)+1           # id
-    outtab[:,1] = pars[0:-1:3]                       # amp
-    outtab[:,2] = perror[0:-1:3]                     # amp_error
-    outtab[:,3] = pars[1::3]                         # x
-    outtab[:,4] = perror[1::3]                       # x_error
-    outtab[:,5] = pars[2::3]                         # y
-    outtab[:,6] = perror[2::3]                       # y_error
-    outtab[:,7] = af._starsky                        # sky
-    psfflux = psf.flux()
-    outtab[:,8] = outtab[:,1]*psfflux                # flux
-    outtab[:,9] = outtab[:,2]*psfflux                # flux_error
-    outtab[:,10] = -2.5*np.log10(np.maximum(outtab[:,8],1e-10))+25.0   # mag
-    outtab[:,11] = (2.5/np.log(10))*outtab[:,9]/outtab[:,8]            # mag_error
-    outtab[:,12] = af.starrms
-    outtab[:,13] = af.starchisq
-    outtab[:,14] = af.starniter                      # niter, what iteration it converged on
+    dt = np.dtype([('id',int),('amp',float),('amp_error',float),('x',float),
+                   ('x_error',float),('y',float),('y_error',float),('sky',float),
+                   ('flux',float),('flux_error',float),('mag',float),('mag_error',float),
+                   ('rms',float),('chisq',float),('niter',int)])
+    outtab = np.zeros(nstars,dtype=dt)
+    for i,n in enumerate(dt.names):
+        outtab[n] = outarr[:,i]
+    outtab = Table(outtab)
+    # The frozen stars have the iteration they converged on, the others maxiter
+    outtab['frozen'] = outtab['niter'] < maxiter
+    dtype = image.data.dtype
+    model = CCDData(modelim.reshape(image.shape).astype(dtype,copy=False),bbox=image.bbox,unit=image.unit)
+    sky = CCDData(skyim.reshape(image.shape).astype(dtype,copy=False),bbox=image.bbox,unit=image.unit)
 
     if verbose:
-        print('dt =',(clock()-start)/1e9,'sec.')
-
-    return outtab,model,skyim
+        print('dt = %.2f sec' % (time.time()-t0))
 
+    return outtab,model,sky
         
 
-#@njit
+@njit
+def groupcolors(bboxes):
+    """
+    Greedy colouring of the star groups.  Two groups are connected if their
+    bounding boxes overlap.  The groups are coloured in the input order with
+    the lowest colour that none of their neighbours have.
+
+    Parameters
+    ----------
+    bboxes : numpy array
+       Bounding boxes [xlo,xhi,ylo,yhi] of the groups, upper values are exclusive.
+
+    Returns
+    -------
+    colors : numpy array
+       Colour (0 to ncolors-1) of each group.
+
+    Example
+    -------
+
+    colors = groupcolors(bboxes)
+
+    """
+    ngroups = len(bboxes)
+    colors = np.zeros(ngroups,np.int64)-1
+    used = np.zeros(ngroups+1,np.bool_)
+    for g in range(ngroups):
+        for h in range(g):
+            if (bboxes[h,0]<bboxes[g,1] and bboxes[h,1]>bboxes[g,0] and
+                bboxes[h,2]<bboxes[g,3] and bboxes[h,3]>bboxes[g,2]):
+                used[colors[h]] = True
+        col = 0
+        while used[col]:
+            col += 1
+        colors[g] = col
+        used[:] = False
+    return colors
+
+
 def fit(psf,image,tab,fitradius=0.0,recenter=True,maxiter=10,minpercdiff=0.5,
-        reskyiter=2,nofreeze=False,skyfit=True,verbose=False):
+        reskyiter=2,nofreeze=False,skyfit=False,nthreads=None,verbose=False):
     """
-    Fit PSF to all stars in an image.
+    Fit PSF to all stars in an image, one group of stars at a time.
+
+    The groups are fit with the JIT-compiled groupfit_numba.groupfit() which
+    runs without the GIL, so groups whose cutouts do not overlap are fit
+    concurrently in a thread pool on the shared residual image.  The groups
+    are split into colour classes of non-overlapping groups that are run one
+    after another, and the results do not depend on the number of threads.
 
     To pre-group the stars, add a "group_id" in the input catalog.
 
     Parameters
     ----------
     psf : PSF object
-       PSF object with initial parameters to use.
+       PSF object with initial parameters to use.  Only the analytic PSF types
+         without a lookup table are supported.
     image : CCDData object
        Image to use to fit PSF model to stars.
     tab : table
@@ -926,20 +1182,20 @@ def fit(psf,image,tab,fitradius=0.0,recenter=True,maxiter=10,minpercdiff=0.5,
     fitradius : float, optional
        The fitting radius in pixels.  By default the PSF FWHM is used.
     recenter : boolean, optional
-       Allow the centroids to be fit.  Default is True.
+       Allow the centroids to be fit.  Only True is supported.
     maxiter : int, optional
-       Maximum number of iterations to allow.  Only for methods "qr" or "svd".
-       Default is 10.
+       Maximum number of iterations to allow.  Default is 10.
     minpercdiff : float, optional
        Minimum percent change in the parameters to allow until the solution is
-       considered converged and the iteration loop is stopped.  Only for methods
-       "qr" and "svd".  Default is 0.5.
+       considered converged and the iteration loop is stopped.  Default is 0.5.
     reskyiter : int, optional
        After how many iterations to re-calculate the sky background. Default is 2.
     nofreeze : boolean, optional
        Do not freeze any parameters even if they have converged.  Default is False.
     skyfit : boolean, optional
-       Fit a constant sky offset with the stellar parameters.  Default is True.
+       Fit a constant sky offset with the stellar parameters.  Default is False.
+    nthreads : int, optional
+       Number of threads.  By default, the groups are fit serially.
     verbose : boolean, optional
        Verbose output.
 
@@ -947,103 +1203,141 @@ def fit(psf,image,tab,fitradius=0.0,recenter=True,maxiter=10,minpercdiff=0.5,
     -------
     results : table
        Table of best-fitting parameters for each star.
-       id, amp, amp_error, x, x_err, y, y_err, sky
-    model : numpy array
-       Best-fitting model of the stars and sky background.
+       id, amp, amp_error, x, x_err, y, y_err, sky, ..., group_id, ngroup
+    model : CCDData object
+       Best-fitting model of the stars.
+    sky : CCDData object
+       Smooth sky of each group within its cutout.
 
     Example
     -------
 
-    results,model = fit(psf,image,tab,groups)
+    results,model,sky = fit(psf,image,tab,nthreads=4)
 
     """
+    from concurrent.futures import ThreadPoolExecutor
+    from astropy.table import Table
+    from .ccddata import CCDData
 
-    start = clock()
-    nstars = len(tab)
+    t0 = time.time()
+
+    psftype = psftypeid(psf)
+    if psftype==0 or psftype==6 or psf.haslookup or psf.binned:
+        raise ValueError('fit() only supports unbinned analytic PSFs without a lookup table')
+    if recenter is False:
+        raise ValueError('fit() only supports recenter=True')
+    inptab = inputtab(psf,tab)
+    nstars = len(inptab)
     ny,nx = image.shape
+    if fitradius is None or fitradius<=0:
+        fitradius = psf.fwhm()
+    if nthreads is None or nthreads<1:
+        nthreads = 1
 
     # Groups
     if 'group_id' not in tab.keys():
+        from photutils.psf.groupstars import DAOGroup
         daogroup = DAOGroup(crit_separation=2.5*psf.fwhm())
         starlist = tab.copy()
         starlist['x_0'] = tab['x']
         starlist['y_0'] = tab['y']
-        # THIS TAKES ~4 SECONDS!!!!!! WAY TOO LONG!!!!
         star_groups = daogroup(starlist)
         tab['group_id'] = star_groups['group_id']
 
     # Star index
-    starindex = utils.index(np.array(tab['group_id']))
-    #starindex = dln.create_index(np.array(tab['group_id'])) 
-    groups = starindex['value']
+    groups,groupindex = np.unique(np.array(tab['group_id']),return_inverse=True)
     ngroups = len(groups)
+    starindex = np.argsort(groupindex,kind='stable')
+    grouplo = np.concatenate(([0],np.cumsum(np.bincount(groupindex,minlength=ngroups))))
     if verbose:
         print(ngroups,'star groups')
 
-    # Initialize catalog
-    #dt = np.dtype([('id',int),('amp',float),('amp_error',float),('x',float),
-    #               ('x_error',float),('y',float),('y_error',float),('sky',float),
-    #               ('flux',float),('flux_error',float),('mag',float),('mag_error',float),
-    #               ('niter',int),('group_id',int),('ngroup',int),('rms',float),('chisq',float)])
-    outtab = np.zeros((nstars,17),dtype=dt)
-    outtab[:,0] = tab[:,0]  # copy ID
+    # Cutout of each group, see allfit.cutoutbbox()
+    hpsfnpix = psf.npix//2
+    bboxes = np.zeros((ngroups,4),np.int64)
+    for g in range(ngroups):
+        ind = starindex[grouplo[g]:grouplo[g+1]]
+        bboxes[g,0] = max(int(np.round(np.min(inptab[ind,2]))-hpsfnpix),0)
+        bboxes[g,1] = min(int(np.round(np.max(inptab[ind,2]))+hpsfnpix),nx)
+        bboxes[g,2] = max(int(np.round(np.min(inptab[ind,3]))-hpsfnpix),0)
+        bboxes[g,3] = min(int(np.round(np.max(inptab[ind,3]))+hpsfnpix),ny)
+
+    # Colour classes of non-overlapping groups
+    colors = groupcolors(bboxes)
+    ncolors = np.max(colors)+1
+    if verbose:
+        print(ncolors,'colour classes')
 
+    # Shared arrays
+    resid = np.array(image.data,np.float64)
+    error = np.ascontiguousarray(image.error,np.float64)
+    if image.mask is not None:
+        mask = np.ascontiguousarray(image.mask,np.bool_)
+    else:
+        mask = np.zeros(image.shape,np.bool_)
+    psfparams = np.ascontiguousarray(psf.params,np.float64)
+    psflookup = np.zeros((1,1,1),np.float64)
+    psfflux = float(psf.flux())
+    outarr = np.zeros((nstars,15),np.float64)
+    outmodel = np.zeros(image.shape,np.float64)
+    outsky = np.zeros(image.shape,np.float64)
+    
+    def fitgroup(g):
+        """ Fit one group, only its cutout of the shared arrays is used."""
+        ind = starindex[grouplo[g]:grouplo[g+1]]
+        xlo,xhi,ylo,yhi = bboxes[g]
+        gtab = inptab[ind].copy()
+        gtab[:,2] -= xlo
+        gtab[:,3] -= ylo
+        out,model,sky = gfit.groupfit(psftype,psfparams,int(psf.npix),psflookup,psfflux,
+                                      np.ascontiguousarray(resid[ylo:yhi,xlo:xhi]),
+                                      np.ascontiguousarray(error[ylo:yhi,xlo:xhi]),
+                                      np.ascontiguousarray(mask[ylo:yhi,xlo:xhi]),
+                                      gtab,float(fitradius),int(maxiter),float(minpercdiff),
+                                      int(reskyiter),bool(nofreeze),bool(skyfit),False)
+        out[:,3] += xlo
+        out[:,5] += ylo
+        outarr[ind,:] = out
+        outmodel[ylo:yhi,xlo:xhi] += model
+        outsky[ylo:yhi,xlo:xhi] = sky.reshape(yhi-ylo,xhi-xlo)
+        # Subtract the best model for the group
+        resid[ylo:yhi,xlo:xhi] -= model
 
     # Group Loop
     #---------------
-    resid = image.copy()
-    outmodel = np.zeros(image.shape,np.float64)
-    outsky = np.zeros(image.shape,np.float64)
-    for g,grp in enumerate(groups):
-        ind = starindex['index'][starindex['lo'][g]:starindex['hi'][g]+1]
-        nind = len(ind)
-        inptab = tab[ind].copy()
-        if 'amp' not in inptab.columns:
-            # Estimate amp from flux and fwhm
-            # area under 2D Gaussian is 2*pi*A*sigx*sigy
-            if 'fwhm' in inptab.columns:
-                amp = inptab['flux']/(2*np.pi*(inptab['fwhm']/2.35)**2)
+    #  the groups of a colour class do not overlap and can be fit at the same time
+    executor = ThreadPoolExecutor(nthreads) if nthreads>1 else None
+    try:
+        for c in range(ncolors):
+            cgroups, = np.where(colors==c)
+            if verbose:
+                print('-- Colour class '+str(c+1)+'/'+str(ncolors)+' : '+str(len(cgroups))+' group(s) --')
+            if executor is not None and len(cgroups)>1:
+                list(executor.map(fitgroup,cgroups))
             else:
-                amp = inptab['flux']/(2*np.pi*(psf.fwhm()/2.35)**2)                
-            staramp = np.maximum(amp,0)   # make sure it's positive
-            inptab['amp'] = staramp
-        
-        if verbose:
-            print('-- Group '+str(grp)+'/'+str(len(groups))+' : '+str(nind)+' star(s) --')
-
-        # Single Star
-        if nind==1:
-            inptab = np.array([inptab[1],inptab[2],inptab[3]])
-            out,model = psf.fit(resid,inptab,niter=3,verbose=verbose,retfullmodel=True,recenter=recenter)
-            model.data -= out['sky']   # remove sky
-            outmodel.data[model.bbox.slices] += model.data
-            outsky.data[model.bbox.slices] = out['sky']
+                for g in cgroups:
+                    fitgroup(g)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-        # Group
-        else:
-            bbox = cutoutbbox(image,psf,inptab)
-            out,model,sky = gfit.fit(psf,resid[bbox.slices],inptab,fitradius=fitradius,
-                                     recenter=recenter,maxiter=maxiter,minpercdiff=minpercdiff,
-                                     reskyiter=reskyiter,nofreeze=nofreeze,verbose=verbose,
-                                     skyfit=skyfit,absolute=True)
-            outmodel.data[model.bbox.slices] += model.data
-            outsky.data[model.bbox.slices] = sky
-            
-        # Subtract the best model for the group/star
-        resid[model.bbox.slices].data -= model.data
-
-        # Put in catalog
-        cols = ['amp','amp_error','x','x_error','y','y_error',
-                'sky','flux','flux_error','mag','mag_error','niter','rms','chisq']
-        for c in cols:
-            outtab[c][ind] = out[c]
-        outtab['group_id'][ind] = grp
-        outtab['ngroup'][ind] = nind
-        outtab = Table(outtab)
-        
+    # Put in catalog
+    dt = np.dtype([('id',int),('amp',float),('amp_error',float),('x',float),
+                   ('x_error',float),('y',float),('y_error',float),('sky',float),
+                   ('flux',float),('flux_error',float),('mag',float),('mag_error',float),
+                   ('rms',float),('chisq',float),('niter',int),('group_id',int),('ngroup',int)])
+    outtab = np.zeros(nstars,dtype=dt)
+    for i,n in enumerate(dt.names[:15]):
+        outtab[n] = outarr[:,i]
+    outtab['id'] = inptab[:,0]
+    outtab['group_id'] = groups[groupindex]
+    outtab['ngroup'] = np.diff(grouplo)[groupindex]
+    outtab = Table(outtab)
+    dtype = image.data.dtype
+    model = CCDData(outmodel.astype(dtype,copy=False),bbox=image.bbox,unit=image.unit)
+    sky = CCDData(outsky.astype(dtype,copy=False),bbox=image.bbox,unit=image.unit)
+    
     if verbose:
-        print('dt = {:.2f} sec.'.format(time.time()-t0))
+        print('dt = %.2f sec' % (time.time()-t0))
     
-    return outtab,outmodel,outsky
-        
-            
+    return outtab,model,sky
@@ -16,7 +16,7 @@ from numba.experimental import jitclass
 #from .clock_numba import clock
 
 
-from clock_numba import clock
+# clock() is a ctypes function pointer that can't be used in AOT-compiled code
 import models_numba_static as mnb, utils_numba_static as utils
 #getpsf_numba as gnb
 
@@ -244,21 +244,11 @@ def initstararrays(image,error,mask,tab,psfnpix,fitradius,skyradius):
         invindex1 = invindex[invlo:invlo+n1]
         starfitinvindex[i,:n1] = invindex1
     
-    # For all of the fitting pixels, find the ones that
-    # a given star contributes to (basically within its PSF radius)
-    starflat_index = np.zeros((nstars,ntotpix),np.int64)-1
+    # The index of the flat pixels that each star contributes to is not
+    #  needed by allfit(), the stars are fit one at a time on the full
+    #  resid array.  Computing it is O(Nstars*Npix) in time and memory.
+    starflat_index = np.zeros((nstars,1),np.int64)-1
     starflat_ndata = np.zeros(nstars,np.int64)
-    for i in range(ntotpix):
-        x1 = xflat[i]
-        y1 = yflat[i]
-        for j in range(nstars):
-            pars1 = pars[3*i:3*i+3]
-            r = np.sqrt((xflat[i]-pars[1])**2 + (yflat[i]-pars[2])**2)
-            if r <= psfnpix:
-                starflat_index[j,starflat_ndata[j]] = i
-                starflat_ndata[j] += 1
-    maxndata = np.max(starflat_ndata)
-    starflat_index = starflat_index[:,:maxndata]
 
     return (im,err,msk,xx,yy,pars,npars,
             starravelindex,starndata,starfitravelindex,starfitndata,skyravelindex,skyndata,
@@ -490,7 +480,7 @@ def dofreeze2(frzpars,pars,freezedata,flatdata,psfdata,resid,resflat):
 
 
 @njit
-@cc.export('allfit', '(i8,f8[:],i8,f8[:,:,:],f8,f8[:,:],f8[:,:],b1[:,:],f8[:,:],f8,i8,f8,i8,b1,b1)')
+@cc.export('allfit', 'Tuple((f8[:,:],f8[:],f8[:]))(i8,f8[:],i8,f8[:,:,:],f8,f8[:,:],f8[:,:],b1[:,:],f8[:,:],f8,i8,f8,i8,b1,b1)')
 def allfit(psftype,psfparams,psfnpix,psflookup,psfflux,
            image,error,mask,tab,fitradius,maxiter=10,
            minpercdiff=0.5,reskyiter=2,verbose=False,
@@ -552,7 +542,6 @@ def allfit(psftype,psfparams,psfnpix,psflookup,psfflux,
 
     # ----- START copied from groupfit_numba.py ---------
 
-    start = clock()
     
     nstars = len(tab)
     skyradius = psfnpix//2 + 10
@@ -626,7 +615,7 @@ def allfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     for i in range(nstars):
         pars1 = pars[3*i:3*i+3]
         n1 = starndata[i]
-        ravelind1 = starravelindex[i]
+        ravelind1 = starravelindex[i,:n1]
         xind1 = xx[ravelind1]
         yind1 = yy[ravelind1]
         xdata1 = (xind1,yind1)
@@ -635,11 +624,21 @@ def allfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     skyim = utils.sky(tresid.copy().reshape(imshape[0],imshape[1])).flatten()
     skyflat = skyim[indflat]
 
-    # Initialize RESID and subtract initial smooth sky
+    # Initialize RESID, subtract initial smooth sky and the initial star models
     resid = np.zeros(imshape[0]*imshape[1],np.float64)
     resid[:] = im.copy().astype(np.float64).flatten()   # flatten makes it easier to modify
     resid[:] -= skyim          # subtract smooth sky
-    resflat = resid[indflat]   # initialize resflat
+    modelim = np.zeros(imshape[0]*imshape[1],np.float64)
+    for i in range(nstars):
+        pars1 = pars[3*i:3*i+3]
+        n1 = starndata[i]
+        ravelind1 = starravelindex[i,:n1]
+        xind1 = xx[ravelind1]
+        yind1 = yy[ravelind1]
+        m,_ = mnb.psf(xind1,yind1,pars1,psftype,psfparams,psflookup,
+                      imshape,deriv=False,verbose=False)
+        resid[ravelind1] -= m
+        modelim[ravelind1] += m
 
     # Perform the fitting
     #--------------------
@@ -650,112 +649,12 @@ def allfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     starchisq = np.zeros(nstars,np.float64)
     starrms = np.zeros(nstars,np.float64)
     freezestars = np.zeros(nstars,np.bool_)
-    freezepars = np.zeros(len(pars),np.bool_)
-    
-    # Initial estimates
-    initpar = pars.copy()
-    # Make bounds
-    #  this requires all 3*Nstars parameters to be input
-    bounds = utils.mkbounds(initpar,imshape,2)    
-    
-    # Iterate
-    bestpar_all = initpar.copy()
-    allpars = initpar.copy()
-    bestpar = initpar.copy()
-    
-
-    
-    # ----- END copied from groupfit_numba.py ---------
-
-
-    return
-
-
-    
-    # nstars = len(tab)
-    # _,_,npsforder = psflookup.shape
-    # psforder = 0
-    # if npsforder==4:
-    #     psforder = 1
-    # if psflookup.ndim != 3:
-    #     raise Exception('psflookup must have 3 dimensions')
-    # psforder = psflookup.shape[2]
-    # if psforder>1:
-    #     psforder = 1
-    # ny,nx = image.shape                             # save image dimensions, python images are (Y,X)
-    # nx = nx
-    # ny = ny
-    # imshape = np.array([ny,nx])
-    # im = image.copy().astype(np.float64)
-    # err = error.copy().astype(np.float64)
-    # msk = mask.copy().astype(np.bool_)
-    # xx,yy = utils.meshgrid(np.arange(nx),np.arange(ny))
-    # xx = xx.flatten()
-    # yy = yy.flatten()
-    # # Order stars by flux, brightest first
-    # si = np.argsort(tab[:,1])[::-1]       # largest amp first
-    # startab = tab[si]                     # ID, amp, xcen, ycen
-    # initpars = startab[:,1:4]             # amp, xcen, ycen
-    # nfitpix = int(np.ceil(fitradius))     # +/- nfitpix
-    # skyradius = psfnpix//2 + 10
-    # # Initialize the parameter array
-    # initpars = startab[:,1:4] 
-    # pars = np.zeros(nstars*3,float) # amp, xcen, ycen
-    # pars[0::3] = initpars[:,0]
-    # pars[1::3] = initpars[:,1]
-    # pars[2::3] = initpars[:,2]
-    
-    # # Get information for all the stars
-    # xcen = pars[1::3]
-    # ycen = pars[2::3]
-    # hpsfnpix = psfnpix//2
-    # out = collatestarsinfo(imshape,msk,xcen,ycen,hpsfnpix,fitradius,skyradius)
-    # starravelindex,starndata,starfitravelindex,starfitndata,skyravelindex,skyndata = out
-    
-    # # Put indices of all the unique fitted pixels into one array
-    # ntotpix = np.sum(starfitndata)
-    # allravelindex = np.zeros(ntotpix,np.int64)
-    # count = 0
-    # for i in range(nstars):
-    #     n1 = starfitndata[i]
-    #     ravelind1 = starfitravelindex[i,:n1]
-    #     allravelindex[count:count+n1] = ravelind1
-    #     count += n1
-    # allravelindex = np.unique(allravelindex)
-    # ravelindex = allravelindex
-    # ntotpix = len(allravelindex)
-    
-    # # Create initial smooth sky image
-    # skyim = utils.sky(im).flatten()
-    # # Subtract the initial models from the residual array
-    # resid = np.zeros(imshape[0]*imshape[1],np.float64)
-    # resid[:] = im.copy().astype(np.float64).flatten()   # flatten makes it easier to modify
-    # resid[:] -= skyim   # subtract smooth sky
-    # modelim = np.zeros(imshape[0]*imshape[1],np.float64)
-    # for i in range(nstars):
-    #     pars1 = pars[3*i:3*i+3]
-    #     n1 = starndata[i]
-    #     ravelind1 = starravelindex[i]
-    #     xind1 = xx[ravelind1]
-    #     yind1 = yy[ravelind1]
-    #     m,_ = mnb.psf(xind1,yind1,pars1,psftype,psfparams,psflookup,
-    #                   imshape,deriv=False,verbose=False)
-    #     resid[ravelind1] -= m
-    #     modelim[ravelind1] += m
-        
-    # # Sky and Niter arrays for the stars
-    # starsky = np.zeros(nstars,np.float64)
-    # starniter = np.zeros(nstars,np.int64)
-    # starchisq = np.zeros(nstars,np.float64)
-    # starrms = np.zeros(nstars,np.float64)
-    # freezestars = np.zeros(nstars,np.bool_)
     
     # While loop
     niter = 1
     maxpercdiff = 1e10
     nfreestars = nstars
     while (niter<maxiter and nfreestars>0):
-        start0 = clock()
             
         # Star loop
         for i in range(nstars):
@@ -827,8 +726,6 @@ def allfit(psftype,psfparams,psfnpix,psflookup,psfflux,
             # CHECK THAT WE ARE DOING THIS CORRECTLY!!
             # resflat, skyflat???
             
-        if verbose:
-            print('iter dt =',(clock()-start0)/1e9,'sec.')
 
         nfreezestars = np.sum(freezestars)
         nfreestars = nstars-nfreezestars
@@ -836,6 +733,9 @@ def allfit(psftype,psfparams,psfnpix,psflookup,psfflux,
         niter += 1     # increment counter
 
             
+    # The stars that were not frozen ran until the last iteration
+    starniter[~freezestars] = niter
+
     # Check that all starniter are set properly
     #  if we stopped "prematurely" then not all stars were frozen
     #  and didn't have starniter set
@@ -859,22 +759,25 @@ def allfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     perror[:] = perror
     
     # Put in catalog
+    #  the stars were sorted by amp in initstararrays(), put them
+    #  back in the order of the input table
+    si = np.argsort(tab[:,1])[::-1]
     outtab = np.zeros((nstars,15),np.float64)
-    outtab[:,0] = np.arange(nstars)+1                # id
-    outtab[:,1] = pars[0:-1:3]                       # amp
-    outtab[:,2] = perror[0:-1:3]                     # amp_error
-    outtab[:,3] = pars[1::3]                         # x
-    outtab[:,4] = perror[1::3]                       # x_error
-    outtab[:,5] = pars[2::3]                         # y
-    outtab[:,6] = perror[2::3]                       # y_error
-    outtab[:,7] = starsky                            # sky
+    outtab[si,0] = tab[si,0]                         # id
+    outtab[si,1] = pars[0::3]                        # amp
+    outtab[si,2] = perror[0::3]                      # amp_error
+    outtab[si,3] = pars[1::3]                        # x
+    outtab[si,4] = perror[1::3]                      # x_error
+    outtab[si,5] = pars[2::3]                        # y
+    outtab[si,6] = perror[2::3]                      # y_error
+    outtab[si,7] = starsky                           # sky
     outtab[:,8] = outtab[:,1]*psfflux                # flux
     outtab[:,9] = outtab[:,2]*psfflux                # flux_error
     outtab[:,10] = -2.5*np.log10(np.maximum(outtab[:,8],1e-10))+25.0   # mag
-    outtab[:,11] = (2.5/np.log(10))*outtab[:,9]/outtab[:,8]            # mag_error
-    outtab[:,12] = starrms
-    outtab[:,13] = starchisq
-    outtab[:,14] = starniter                      # niter, what iteration it converged on
+    outtab[:,11] = (2.5/np.log(10))*outtab[:,9]/np.maximum(outtab[:,8],1e-10)   # mag_error
+    outtab[si,12] = starrms
+    outtab[si,13] = starchisq
+    outtab[si,14] = starniter                     # niter, what iteration it converged on
 
     # DO WE NEED TO RECALCULATE chi-squared and RMS for each star ????
     
@@ -17,14 +17,12 @@ from astropy.table import Table
 import astropy.units as u
 from scipy.optimize import curve_fit, least_squares
 from scipy.interpolate import interp1d
+from scipy.spatial import cKDTree
 from dlnpyutils import utils as dln, bindata
-from photutils import aperture_photometry, CircularAperture, CircularAnnulus
 import copy
 import logging
 import time
-import matplotlib
 from .ccddata import BoundingBox,CCDData
-from matplotlib.patches import Ellipse
 import sep
 
 def circaperphot(im,positions,rap=[5.0],rbin=None,rbout=None):
@@ -55,6 +53,8 @@ def circaperphot(im,positions,rap=[5.0],rbin=None,rbout=None):
     phot = circaperphot(im)
 
     """
+    from photutils import aperture_photometry, CircularAperture, CircularAnnulus
+    from astropy.stats import sigma_clipped_stats
 
     # Positions is a catalog
     if type(positions) is not list and type(positions) is not tuple:    
@@ -635,26 +635,6 @@ def apercorr(psf,image,objects,psfobj,verbose=False):
 
     """
 
-    # Get model of all stars except the PSF stars
-    ind1,ind2 = dln.match(objects['id'],psfobj['id'])
-    left = np.delete(np.arange(len(objects)),ind1)
-    neiobj = objects[left]
-    neimodel = image.copy()
-    neimodel.data *= 0
-    neimodel.error[:] = 1
-    neimodelim = psf.add(neimodel,neiobj)
-    neimodel.data = neimodelim
-    
-    # Subtract everything except the PSF stars from the image
-    resid = image.copy()
-    if image.mask is not None:
-        resid.data[~resid.mask] -= neimodel.data[~resid.mask]
-    else:
-        resid.data -= modelnei.data            
-    residim = np.maximum(resid.data-resid.sky,0)
-    resid.data = residim
-    resid.sky[:] = 0.0
-    
     # Do aperture photometry with lots of apertures on the PSF
     #  stars
     # rk = (20/3.)**(1/11.) * rk-1  for k=2,..,12
@@ -663,8 +643,66 @@ def apercorr(psf,image,objects,psfobj,verbose=False):
     #apers = np.array([3.0,3.7965,4.8046,6.0803,7.6947,9.7377,12.3232,
     #                  15.5952,19.7360,24.9762,31.6077,40.0000])
 
+    # All stars except the PSF stars are neighbors
+    ind1,ind2 = dln.match(objects['id'],psfobj['id'])
+    left = np.delete(np.arange(len(objects)),ind1)
+    neiobj = objects[left]
 
-    apercat = aperphot(resid,psfobj,apers)   
+    # Only work on cutouts around the PSF stars, with a radius of the
+    #  largest aperture, and subtract the neighbors that overlap them.
+    #  The cutouts are put in a mosaic image so that aperphot() only
+    #  needs to be run once.  Tiles are separated by masked pixels.
+    npsfobj = len(psfobj)
+    cutrad = int(np.ceil(apers[-1]))+1
+    ntile = 2*cutrad+3
+    nxtile = int(np.ceil(np.sqrt(npsfobj)))
+    nytile = int(np.ceil(npsfobj/nxtile))
+    mosdata = np.zeros((nytile*ntile,nxtile*ntile),float)
+    moserror = np.ones((nytile*ntile,nxtile*ntile),float)
+    mosmask = np.ones((nytile*ntile,nxtile*ntile),bool)
+    mosobj = psfobj.copy()
+    if len(neiobj)>0:
+        X1 = np.vstack((np.array(neiobj['x']),np.array(neiobj['y']))).T
+        X2 = np.vstack((np.array(psfobj['x']),np.array(psfobj['y']))).T
+        kdt = cKDTree(X1)
+        # Chebyshev distance, the neighbor's PSF footprint overlaps the cutout box
+        neilist = kdt.query_ball_point(X2,cutrad+psf.radius+1,p=np.inf)
+    else:
+        neilist = [[] for i in range(npsfobj)]
+    for i in range(npsfobj):
+        xcen,ycen = psfobj['x'][i],psfobj['y'][i]
+        bbox = psf.starbbox((xcen,ycen),image.shape,cutrad)
+        cutdata = image.data[bbox.slices].copy()
+        if image.mask is not None:
+            cutmask = image.mask[bbox.slices]
+        else:
+            cutmask = np.zeros(cutdata.shape,bool)
+        # Subtract the overlapping neighbors
+        for j in neilist[i]:
+            nbbox = psf.starbbox((neiobj['x'][j],neiobj['y'][j]),image.shape,psf.radius)
+            xlo,xhi = np.maximum(nbbox.ixmin,bbox.ixmin),np.minimum(nbbox.ixmax,bbox.ixmax)
+            ylo,yhi = np.maximum(nbbox.iymin,bbox.iymin),np.minimum(nbbox.iymax,bbox.iymax)
+            if xhi<=xlo or yhi<=ylo:
+                continue
+            im1 = psf(pars=[neiobj['amp'][j],neiobj['x'][j],neiobj['y'][j]],
+                      bbox=BoundingBox(xlo,xhi,ylo,yhi))
+            oslc = (slice(ylo-bbox.iymin,yhi-bbox.iymin),slice(xlo-bbox.ixmin,xhi-bbox.ixmin))
+            cutdata[oslc][~cutmask[oslc]] -= im1[~cutmask[oslc]]
+        # Put the sky-subtracted residual cutout in the mosaic
+        #  keeping the star at the same position within its tile
+        xoff = (i % nxtile)*ntile + 1 + cutrad - int(np.floor(xcen))
+        yoff = (i // nxtile)*ntile + 1 + cutrad - int(np.floor(ycen))
+        mslc = (slice(bbox.iymin+yoff,bbox.iymax+yoff),slice(bbox.ixmin+xoff,bbox.ixmax+xoff))
+        mosdata[mslc] = np.maximum(cutdata-image.sky[bbox.slices],0)
+        moserror[mslc] = image.error[bbox.slices]
+        mosmask[mslc] = cutmask
+        mosobj['x'][i] += xoff
+        mosobj['y'][i] += yoff
+    mosaic = CCDData(mosdata,error=moserror,mask=mosmask,sky=np.zeros(mosdata.shape,float),
+                     gain=image.gain,unit=image.unit)
+    apercat = aperphot(mosaic,mosobj,apers)
+    apercat['x'] = psfobj['x']
+    apercat['y'] = psfobj['y']
     
     # Fit curve of growth
     # use magnitude differences between successive apertures.
@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+
+"""BATCH.PY - Run Prometheus on many images in parallel
+
+"""
+
+__authors__ = 'David Nidever <dnidever@montana.edu?'
+__version__ = '20261018'  # yyyymmdd
+
+
+import os
+import time
+import json
+import queue
+import threading
+import traceback
+import numpy as np
+import multiprocessing as mp
+# astropy, utils and CCDData are imported in the functions that use them
+#  so that a thin client (e.g. service.submit) starts quickly
+
+# Images with more pixels than this are "large", only maxlarge of them
+# are processed at the same time to bound the memory use
+LARGEPIX = 4096*4096
+
+# Semaphore that limits the number of large images, set by initworker()
+_largesem = None
+
+
+def outputfile(filename,outfile=None,outdir=None):
+    """
+    Get the Prometheus output filename for an image.
+
+    Parameters
+    ----------
+    filename : str
+       Filename of the input image.
+    outfile : str, optional
+       Output filename.  By default, the image base name with
+         "_prometheus.fits" is used.
+    outdir : str, optional
+       Output directory.  By default, the directory of the image is used.
+
+    Returns
+    -------
+    outfile : str
+       The output filename.
+
+    Example
+    -------
+
+    outfile = outputfile(filename,outdir=outdir)
+
+    """
+    from .utils import splitfilename
+    if outfile is not None and outfile != '':
+        return outfile
+    fdir,base,ext = splitfilename(filename)
+    outfile = base+'_prometheus.fits'
+    if outdir is not None and outdir != '':
+        outfile = os.path.join(outdir,outfile)
+    elif fdir != '':
+        outfile = os.path.join(fdir,outfile)
+    return outfile
+
+
+def checkoutput(outfile):
+    """
+    Check that a Prometheus output file is complete.
+
+    Parameters
+    ----------
+    outfile : str
+       The Prometheus output filename.
+
+    Returns
+    -------
+    good : bool
+       True if the file exists and has the source table (or its Parquet
+         file), model, sky and PSF HDUs.  A source table without rows (an
+         image without stars) is a complete output.
+
+    Example
+    -------
+
+    good = checkoutput(outfile)
+
+    """
+    from astropy.io import fits
+    if os.path.exists(outfile) is False:
+        return False
+    try:
+        with fits.open(outfile,memmap=True) as hdulist:
+            if len(hdulist) < 5:
+                return False
+            extnames = ['SOURCE TABLE','MODEL IMAGE','SKY MODEL IMAGE']
+            for i,extname in enumerate(extnames):
+                if hdulist[i+1].header.get('EXTNAME') != extname:
+                    return False
+            head = hdulist[1].header
+            if isinstance(hdulist[1],fits.BinTableHDU) is False or 'NAXIS2' not in head:
+                return False
+            if head.get('CATFILE') is not None:
+                catfile = os.path.join(os.path.dirname(outfile),head['CATFILE'])
+                if os.path.exists(catfile) is False:
+                    return False
+            for i in [2,3]:
+                if hdulist[i].header.get('NAXIS',0) != 2 and hdulist[i].header.get('OMITTED') is not True:
+                    return False
+    except Exception:
+        return False
+    return True
+
+
+def imagesize(filename):
+    """ Return the number of pixels of the largest image in a FITS file."""
+    from astropy.io import fits
+    npix = 0
+    try:
+        with fits.open(filename,memmap=True) as hdulist:
+            for h in hdulist:
+                if h.header.get('NAXIS',0) >= 2:
+                    npix = max(npix,int(np.prod([h.header.get('NAXIS'+str(j+1),0)
+                                                 for j in range(h.header['NAXIS'])])))
+                if npix > 0:
+                    break
+    except Exception:
+        pass
+    return npix
+
+
+def initworker(sem):
+    """ Initialize a batch worker process with the large image semaphore."""
+    global _largesem
+    _largesem = sem
+
+
+def newrecord(filename,outfile):
+    """ Return a new, empty status record for an image."""
+    return {'file':filename, 'outfile':outfile, 'status':None, 'nstars':None,
+            'npix':None, 'start':time.strftime('%Y-%m-%dT%H:%M:%S'), 'pid':os.getpid(),
+            'tread':None, 'trun':None, 'twrite':None, 'ttotal':None, 'error':None}
+
+
+def _failed(rec,verbose=0):
+    """ Record the current exception in a status record."""
+    rec['status'] = 'failed'
+    rec['error'] = traceback.format_exc()
+    if verbose>0:
+        traceback.print_exc()
+        print('Prometheus failed on '+rec['file'])
+
+
+def checkfile(rec,resume=False):
+    """
+    Check if an image needs to be processed, sets the status if not.
+
+    Parameters
+    ----------
+    rec : dict
+       Status record of the image from newrecord().
+    resume : bool, optional
+       Skip the image if a complete output file already exists.  Default is False.
+
+    Returns
+    -------
+    torun : bool
+       True if the image should be processed.
+
+    Example
+    -------
+
+    torun = checkfile(rec,resume=True)
+
+    """
+    if os.path.exists(rec['file']) is False:
+        rec['status'] = 'notfound'
+        rec['error'] = rec['file']+' NOT FOUND'
+        return False
+    if resume and checkoutput(rec['outfile']):
+        rec['status'] = 'skipped'
+        return False
+    return True
+
+
+def readfile(rec,dtype=float,verbose=0):
+    """ Read the image of a status record, returns None if it failed."""
+    from .ccddata import CCDData
+    try:
+        t0 = time.time()
+        image = CCDData.read(rec['file'],dtype=dtype)
+        rec['tread'] = time.time()-t0
+    except Exception:
+        _failed(rec,verbose)
+        return None
+    return image
+
+
+def runfile(rec,image,dtype=float,background=False,verbose=0,**kwargs):
+    """
+    Run Prometheus on an image, returns (out,model,sky,psf) or None if it failed.
+    With background=True the smooth background of the image (image.sky) is
+    returned instead of the fitted sky, e.g. for saving it as a mesh.
+    With metrics=filename the metrics record of the run, with the image
+    name and read time, is appended to that file.
+    """
+    from . import prometheus as pm
+    from .ccddata import CCDData
+    try:
+        t0 = time.time()
+        mfile = kwargs.pop('metrics',None)
+        res = pm.run(image,dtype=dtype,verbose=verbose,metrics=bool(mfile),**kwargs)
+        if mfile:
+            from .metrics import writemetrics
+            record = res[4]
+            res = res[:4]
+            record['image'] = rec['file']
+            record['tread'] = rec.get('tread')
+            writemetrics(mfile,record)
+        if background:
+            res = (res[0],res[1],CCDData(image.sky,unit=image.unit),res[3])
+        rec['trun'] = time.time()-t0
+    except Exception:
+        _failed(rec,verbose)
+        return None
+    return res
+
+
+def writefile(rec,out,model,sky,psf,saveopts=None,verbose=0):
+    """
+    Save the Prometheus output of an image.
+
+    The output is written to a temporary file and then renamed, so an
+    interrupted run never leaves a partial output file behind.
+
+    Parameters
+    ----------
+    rec : dict
+       Status record of the image from newrecord().
+    out : table
+       The output catalog.
+    model : CCDData object
+       The model image.
+    sky : CCDData object
+       The sky image.
+    psf : PSF object
+       The PSF model.
+    saveopts : dict, optional
+       Output options passed to utils.saveoutput(), e.g. compress, skytype.
+
+    Returns
+    -------
+    The output is saved to rec['outfile'] and the status set to "done".
+
+    Example
+    -------
+
+    writefile(rec,out,model,sky,psf)
+
+    """
+    from . import utils
+    outfile = rec['outfile']
+    tmpfile = outfile+'.'+str(os.getpid())+'.tmp'
+    try:
+        t0 = time.time()
+        try:
+            saveopts = dict(saveopts) if saveopts is not None else {}
+            if saveopts.get('catformat','fits')=='parquet':
+                saveopts['catfile'] = os.path.splitext(outfile)[0]+'.parquet'
+            utils.saveoutput(rec['file'],tmpfile,out,model,sky,psf,**saveopts)
+            os.replace(tmpfile,outfile)
+        finally:
+            if os.path.exists(tmpfile): os.remove(tmpfile)
+        rec['twrite'] = time.time()-t0
+        rec['nstars'] = len(out)
+        rec['status'] = 'done'
+    except Exception:
+        _failed(rec,verbose)
+
+
+def processfile(filename,outfile=None,outdir=None,resume=False,largepix=LARGEPIX,
+                dtype=float,saveopts=None,verbose=0,**kwargs):
+    """
+    Run Prometheus on a single image and save the output.
+
+    Parameters
+    ----------
+    filename : str
+       Filename of the image.
+    outfile : str, optional
+       Output filename.  By default, the image base name with
+         "_prometheus.fits" is used.
+    outdir : str, optional
+       Output directory.  By default, the directory of the image is used.
+    resume : bool, optional
+       Skip the image if a complete output file already exists.  Default is False.
+    largepix : int, optional
+       Images with more pixels than this wait for the large image semaphore.
+         Default is 4096*4096.
+    dtype : data-type, optional
+       Data type to use for the image, model and sky arrays.  Default is float.
+    saveopts : dict, optional
+       Output options passed to utils.saveoutput(), e.g. compress, skytype.
+    verbose : int, optional
+       Verbose output to the screen.  Default is 0.
+    kwargs : dict
+       Other keyword arguments passed to prometheus.run().
+
+    Returns
+    -------
+    rec : dict
+       Status record for the manifest with keys file, outfile, status
+         (done, skipped, notfound or failed), nstars, npix, timings and error.
+
+    Example
+    -------
+
+    rec = processfile(filename,outdir=outdir)
+
+    """
+    t0 = time.time()
+    usemesh = (saveopts is not None and saveopts.get('skytype')=='mesh')
+    rec = newrecord(filename,outputfile(filename,outfile,outdir))
+    if checkfile(rec,resume) is False:
+        rec['ttotal'] = time.time()-t0
+        return rec
+
+    npix = imagesize(filename)
+    rec['npix'] = npix
+    sem = _largesem if npix > largepix else None
+    if sem is not None:
+        sem.acquire()
+    try:
+        image = readfile(rec,dtype,verbose)
+        res = None
+        if image is not None:
+            res = runfile(rec,image,dtype,usemesh,verbose,**kwargs)
+            del image
+        if res is not None:
+            writefile(rec,*res,saveopts=saveopts,verbose=verbose)
+    finally:
+        if sem is not None:
+            sem.release()
+    rec['ttotal'] = time.time()-t0
+    return rec
+
+
+def _processfile(args):
+    """ Pool wrapper for processfile()."""
+    i,filename,kwargs = args
+    return i,processfile(filename,**kwargs)
+
+
+def pipeline(files,outfile=None,outdir=None,resume=False,nqueue=1,dtype=float,
+             saveopts=None,callback=None,verbose=0,**kwargs):
+    """
+    Run Prometheus on a list of images with a three-stage pipeline.
+
+    A reader thread loads the next image and a writer thread saves the
+    output of the previous image while the current image is being fit.
+    The stages are connected by bounded queues so at most nqueue images
+    are waiting on each side of the fitting.
+
+    Parameters
+    ----------
+    files : list
+       List of image filenames.
+    outfile : str, optional
+       Output filename, only used with a single image.
+    outdir : str, optional
+       Output directory.  By default, the directory of each image is used.
+    resume : bool, optional
+       Skip images that already have a complete output file.  Default is False.
+    nqueue : int, optional
+       Maximum number of images waiting to be fit or written.  Default is 1.
+    dtype : data-type, optional
+       Data type to use for the image, model and sky arrays.  Default is float.
+    saveopts : dict, optional
+       Output options passed to utils.saveoutput(), e.g. compress, skytype.
+    callback : function, optional
+       Function called as callback(i,rec) by the writer thread when an image
+         is finished, in input order.
+    verbose : int, optional
+       Verbose output to the screen.  Default is 0.
+    kwargs : dict
+       Other keyword arguments passed to prometheus.run().
+
+    Returns
+    -------
+    records : list
+       List of status records, one per image, in the input order.
+
+    Example
+    -------
+
+    records = pipeline(files,outdir=outdir)
+
+    """
+    nfiles = len(files)
+    if nfiles > 1:
+        outfile = None
+    nqueue = max(int(nqueue),1)
+    usemesh = (saveopts is not None and saveopts.get('skytype')=='mesh')
+    readq = queue.Queue(maxsize=nqueue)
+    writeq = queue.Queue(maxsize=nqueue)
+    records = [None]*nfiles
+
+    def reader():
+        for i,f in enumerate(files):
+            t0 = time.time()
+            rec = newrecord(f,outputfile(f,outfile,outdir))
+            image = None
+            if checkfile(rec,resume):
+                image = readfile(rec,dtype,verbose)
+            readq.put((i,rec,image,t0))
+        readq.put(None)
+
+    def writer():
+        while True:
+            item = writeq.get()
+            if item is None:
+                break
+            i,rec,res,t0 = item
+            if res is not None:
+                writefile(rec,*res,saveopts=saveopts,verbose=verbose)
+            rec['ttotal'] = time.time()-t0
+            records[i] = rec
+            if callback is not None:
+                try:
+                    callback(i,rec)
+                except Exception:
+                    traceback.print_exc()
+
+    rthread = threading.Thread(target=reader,daemon=True)
+    wthread = threading.Thread(target=writer,daemon=True)
+    rthread.start()
+    wthread.start()
+    # Fit the images in this thread as they come in
+    while True:
+        item = readq.get()
+        if item is None:
+            break
+        i,rec,image,t0 = item
+        res = None
+        if image is not None:
+            res = runfile(rec,image,dtype,usemesh,verbose,**kwargs)
+            del image
+        writeq.put((i,rec,res,t0))
+    writeq.put(None)
+    rthread.join()
+    wthread.join()
+
+    return records
+
+
+def runbatch(files,outfile=None,outdir=None,nproc=1,resume=False,manifest=None,
+             maxlarge=None,largepix=LARGEPIX,prefetch=True,saveopts=None,verbose=0,**kwargs):
+    """
+    Run Prometheus on a list of images, optionally with a pool of processes.
+
+    Parameters
+    ----------
+    files : list
+       List of image filenames.
+    outfile : str, optional
+       Output filename, only used with a single image.
+    outdir : str, optional
+       Output directory.  By default, the directory of each image is used.
+    nproc : int, optional
+       Number of worker processes.  Default is 1.
+    resume : bool, optional
+       Skip images that already have a complete output file.  Default is False.
+    manifest : str, optional
+       JSON-lines file that a status record is appended to for each image.
+    maxlarge : int, optional
+       Maximum number of large images (more than largepix pixels) that are
+         processed at the same time.  Default is nproc.
+    largepix : int, optional
+       Number of pixels above which an image counts as large.  Default is 4096*4096.
+    prefetch : bool, optional
+       With nproc=1, read the next image and write the previous output in
+         background threads while fitting, see pipeline().  Default is True.
+    saveopts : dict, optional
+       Output options passed to utils.saveoutput(), e.g. compress, skytype.
+    verbose : int, optional
+       Verbose output to the screen.  Default is 0.
+    kwargs : dict
+       Other keyword arguments passed to prometheus.run().
+
+    Returns
+    -------
+    records : list
+       List of status records, one per image, in the input order.
+
+    Example
+    -------
+
+    records = runbatch(files,nproc=4,resume=True,manifest='manifest.jsonl')
+
+    """
+    nfiles = len(files)
+    if nfiles > 1:
+        outfile = None
+    nproc = max(int(nproc),1)
+    nproc = min(nproc,max(nfiles,1))
+    if maxlarge is None:
+        maxlarge = nproc
+    maxlarge = max(int(maxlarge),1)
+
+    mfile = open(manifest,'a') if manifest is not None else None
+
+    def report(i,rec):
+        if verbose>0:
+            print('Image %3d/%d: %s  %s  %s' % (i+1,nfiles,rec['file'],rec['status'],
+                  '' if rec['nstars'] is None else str(rec['nstars'])+' stars'))
+        if mfile is not None:
+            mfile.write(json.dumps(rec)+'\n')
+            mfile.flush()
+
+    try:
+        # Single process
+        if nproc == 1:
+            if prefetch:
+                records = pipeline(files,outfile=outfile,outdir=outdir,resume=resume,
+                                   saveopts=saveopts,callback=report,verbose=verbose,**kwargs)
+            else:
+                initworker(None)
+                records = []
+                for i,f in enumerate(files):
+                    rec = processfile(f,outfile=outfile,outdir=outdir,resume=resume,
+                                      saveopts=saveopts,verbose=verbose,**kwargs)
+                    records.append(rec)
+                    report(i,rec)
+        # Process pool
+        else:
+            pkw = dict(kwargs)
+            pkw.update({'outfile':outfile, 'outdir':outdir, 'resume':resume,
+                        'largepix':largepix, 'saveopts':saveopts, 'verbose':verbose})
+            records = [None]*nfiles
+            sem = mp.BoundedSemaphore(maxlarge)
+            with mp.Pool(nproc,initializer=initworker,initargs=(sem,)) as pool:
+                for i,rec in pool.imap_unordered(_processfile,[(i,f,pkw) for i,f in enumerate(files)]):
+                    records[i] = rec
+                    report(i,rec)
+    finally:
+        if mfile is not None:
+            mfile.close()
+
+    return records
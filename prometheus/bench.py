@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+
+"""BENCH.PY - Reproducible performance benchmarks on synthetic images
+
+"""
+
+__authors__ = 'David Nidever <dnidever@montana.edu?'
+__version__ = '20261019'  # yyyymmdd
+
+
+import os
+import sys
+import time
+import json
+import zlib
+import platform
+import numpy as np
+
+# Scenario matrices
+#  sizes      image size in pixels (nx=ny)
+#  densities  number of stars per pixel
+#  psfs       PSF type of the synthetic image and the fit
+#  binned     binned (pixel-integrated) PSF or not
+#  crowding   "uniform" star positions or "clustered" in Gaussian clumps
+#  engines    compute engines to time, see engine.py
+PRESETS = {'quick': {'sizes':[1024], 'densities':[0.001], 'psfs':['gaussian'],
+                     'binned':[False], 'crowding':['uniform'], 'engines':['python','numba']},
+           'default': {'sizes':[1024,2048], 'densities':[0.001,0.005], 'psfs':['gaussian','moffat'],
+                       'binned':[False,True], 'crowding':['uniform','clustered'],
+                       'engines':['python','numba']},
+           'full': {'sizes':[1024,2048,4096,8192], 'densities':[0.001,0.005,0.01,0.05],
+                    'psfs':['gaussian','moffat','penny','gausspow'], 'binned':[False,True],
+                    'crowding':['uniform','clustered'], 'engines':['python','numba','static']}}
+
+# FWHM of the synthetic PSFs in pixels
+FWHM = 3.5
+
+# Shapes of the synthetic PSFs (models.py parameters), psfpars() scales the
+#  sigmas to the FWHM.  The penny wing is weak since getpsf() does not
+#  recover penny PSFs with stronger wings.
+PSFSHAPE = {'gaussian':[1.6,1.45,0.3], 'moffat':[1.6,1.45,0.3,2.5],
+            'penny':[1.6,1.45,0.3,0.01,4.0], 'gausspow':[1.6,1.45,0.3,1.0,1.0]}
+
+
+def psfpars(psftype,fwhm=FWHM):
+    """
+    Parameters of a synthetic PSF with a given FWHM.
+
+    Parameters
+    ----------
+    psftype : str
+       PSF type, one of the PSFSHAPE keys.
+    fwhm : float, optional
+       FWHM in pixels.  Default is FWHM (3.5).
+
+    Returns
+    -------
+    pars : numpy array
+       The PSF parameters, the PSFSHAPE shape with all of the sigmas scaled
+         to give the FWHM.
+
+    Example
+    -------
+
+    pars = psfpars('moffat',3.5)
+
+    """
+    from . import models
+    pars = np.array(PSFSHAPE[psftype],float)
+    # The FWHM scales with the sigmas (the penny wing sigma too), iterate
+    #  for the penny and gausspow FWHMs which are measured numerically
+    sigind = [0,1,4] if psftype=='penny' else [0,1]
+    for i in range(5):
+        pars[sigind] *= fwhm/models.psfmodel(psftype,pars,npix=31).fwhm()
+    return pars
+
+
+def scenarios(sizes=[1024],densities=[0.001],psfs=['gaussian'],binned=[False],
+              crowding=['uniform'],seed=1):
+    """
+    Make the matrix of benchmark scenarios.
+
+    Parameters
+    ----------
+    sizes : list, optional
+       Image sizes in pixels.  Default is [1024].
+    densities : list, optional
+       Star densities in stars per pixel.  Default is [0.001].
+    psfs : list, optional
+       PSF types.  Default is ['gaussian'].
+    binned : list, optional
+       Binned PSF or not.  Default is [False].
+    crowding : list, optional
+       Star distributions, "uniform" or "clustered".  Default is ['uniform'].
+    seed : int, optional
+       Base random seed.  Default is 1.
+
+    Returns
+    -------
+    scens : list
+       List of scenario dictionaries.  The random seed of each scenario only
+         depends on its parameters and the base seed, so the same scenario
+         gives the same image in any matrix.
+
+    Example
+    -------
+
+    scens = scenarios([1024,2048],[0.001,0.01])
+
+    """
+    scens = []
+    for size in sizes:
+        for dens in densities:
+            for psf in psfs:
+                if psf not in PSFSHAPE:
+                    raise ValueError('PSF type '+str(psf)+' not supported.  Select '+', '.join(PSFSHAPE.keys()))
+                for bn in binned:
+                    for crowd in crowding:
+                        if crowd not in ['uniform','clustered']:
+                            raise ValueError('Crowding '+str(crowd)+' not supported.  Select uniform or clustered')
+                        name = 'n%d_d%g_%s_%s_%s' % (size,dens,psf,'binned' if bn else 'unbinned',crowd)
+                        scens.append({'name':name, 'nx':int(size), 'ny':int(size), 'density':float(dens),
+                                      'nstars':int(round(dens*size*size)), 'psf':psf, 'binned':bool(bn),
+                                      'crowding':crowd, 'seed':(zlib.crc32(name.encode())+seed) % 2**32})
+    return scens
+
+
+def makecat(scen):
+    """ Make the truth catalog of a scenario, uses the global numpy random state."""
+    from . import synth
+    nstars,nx,ny = scen['nstars'],scen['nx'],scen['ny']
+    buf = 20.0
+    if scen['crowding']=='uniform':
+        return synth.makecat(nstars=nstars,xr=[buf,nx-buf],yr=[buf,ny-buf])
+    # Clustered, Gaussian clumps of ~200 stars with sigma of 2% of the image
+    nclumps = np.maximum(nstars//200,1)
+    xcen = np.random.uniform(buf,nx-buf,nclumps)
+    ycen = np.random.uniform(buf,ny-buf,nclumps)
+    clump = np.random.randint(0,nclumps,nstars)
+    sig = 0.02*np.maximum(nx,ny)
+    dt = np.dtype([('id',int),('x',float),('y',float),('amp',float)])
+    cat = np.zeros(nstars,dtype=dt)
+    cat['id'] = np.arange(nstars)+1
+    cat['x'] = np.clip(xcen[clump]+sig*np.random.randn(nstars),buf,nx-buf)
+    cat['y'] = np.clip(ycen[clump]+sig*np.random.randn(nstars),buf,ny-buf)
+    cat['amp'] = np.random.uniform(100.0,1e5,nstars)
+    return cat
+
+
+def makescenario(scen):
+    """
+    Make the synthetic image of a scenario.
+
+    Parameters
+    ----------
+    scen : dict
+       Scenario from scenarios().
+
+    Returns
+    -------
+    image : CCDData object
+       The synthetic image.
+    truth : numpy structured array
+       The truth catalog (id, x, y, amp, flux, mag).
+    psf : PSF object
+       The PSF used to make the image.
+
+    Example
+    -------
+
+    image,truth,psf = makescenario(scen)
+
+    """
+    from . import synth, models
+    state = np.random.get_state()
+    np.random.seed(scen['seed'])
+    try:
+        psf = models.psfmodel(scen['psf'],psfpars(scen['psf']),binned=scen['binned'],npix=31)
+        assert np.abs(psf.fwhm()-FWHM) < 0.01, scen['psf']+' PSF FWHM is %.3f not %.2f pixels' % (psf.fwhm(),FWHM)
+        cat = makecat(scen)
+        image = synth.makeimage(nx=scen['nx'],ny=scen['ny'],psf=psf,cat=cat)
+    finally:
+        np.random.set_state(state)
+    dt = np.dtype([('id',int),('x',float),('y',float),('amp',float),('flux',float),('mag',float)])
+    truth = np.zeros(len(cat),dtype=dt)
+    for n in ['id','x','y','amp']:
+        truth[n] = cat[n]
+    truth['flux'] = truth['amp']*psf.flux()
+    truth['mag'] = -2.5*np.log10(np.maximum(truth['flux'],1e-10))+25.0
+    return image,truth,psf
+
+
+def accuracy(out,truth,maxdist=1.0):
+    """
+    Compare the output catalog to the truth.
+
+    Parameters
+    ----------
+    out : table
+       Output catalog of prometheus.run().
+    truth : numpy structured array
+       Truth catalog from makescenario().
+    maxdist : float, optional
+       Maximum matching distance in pixels.  Default is 1.0.
+
+    Returns
+    -------
+    acc : dict
+       Number of matches, completeness, median magnitude offset (zero-point),
+         robust scatter of the magnitude differences, median position offset
+         and the number of spurious detections.
+
+    Example
+    -------
+
+    acc = accuracy(out,truth)
+
+    """
+    from scipy.spatial import cKDTree
+    acc = {'nmatch':0, 'completeness':0.0, 'dmag_offset':None, 'dmag_sigma':None,
+           'dpos_median':None, 'nspurious':0}
+    if out is None or len(out)==0:
+        return acc
+    tree = cKDTree(np.vstack((truth['x'],truth['y'])).T)
+    dist,ind = tree.query(np.vstack((np.array(out['x']),np.array(out['y']))).T,
+                          distance_upper_bound=maxdist)
+    gd, = np.where(np.isfinite(dist))
+    # Only keep the closest output star for each truth star
+    gd = gd[np.argsort(dist[gd])]
+    _,first = np.unique(ind[gd],return_index=True)
+    gd = gd[first]
+    acc['nmatch'] = len(gd)
+    acc['completeness'] = len(gd)/len(truth)
+    acc['nspurious'] = len(out)-len(gd)
+    if len(gd)>0:
+        dmag = np.array(out['psfmag'])[gd]-truth['mag'][ind[gd]]
+        dmag = dmag[np.isfinite(dmag)]
+        if len(dmag)>0:
+            off = np.median(dmag)
+            acc['dmag_offset'] = float(off)
+            acc['dmag_sigma'] = float(1.4826*np.median(np.abs(dmag-off)))
+        acc['dpos_median'] = float(np.median(dist[gd]))
+    return acc
+
+
+def runscenario(scen,engine='python',nthreads=None,warmup=True,verbose=False):
+    """
+    Run prometheus on a scenario and measure the timing, memory and accuracy.
+
+    Parameters
+    ----------
+    scen : dict
+       Scenario from scenarios().
+    engine : str, optional
+       Compute engine.  Default is "python".
+    nthreads : int, optional
+       Number of threads for the numba/static PSF photometry.
+    warmup : boolean, optional
+       Run on a small image first so that loading/compiling the numba
+         functions is not timed.  Default is True.
+    verbose : boolean, optional
+       Verbose output.  Default is False.
+
+    Returns
+    -------
+    result : dict
+       The scenario, engine, status, total and per-stage wall/CPU time,
+         stars per second, peak memory and accuracy.
+
+    Example
+    -------
+
+    res = runscenario(scen,'numba')
+
+    """
+    from . import prometheus as pm, metrics
+    res = dict(scen)
+    res.update({'engine':engine, 'nthreads':nthreads, 'status':'failed', 'error':None})
+    try:
+        t0 = time.time()
+        image,truth,psf = makescenario(scen)
+        res['tmake'] = time.time()-t0
+        if warmup:
+            wscen = dict(scen,nx=256,ny=256,nstars=50,crowding='uniform',name='warmup')
+            wimage,_,_ = makescenario(wscen)
+            try:
+                pm.run(wimage,psfname=scen['psf'],binned=scen['binned'],engine=engine,nthreads=nthreads)
+            except Exception:
+                pass   # only loading/compiling matters here
+        rss0 = metrics.maxrss()
+        out,model,sky,fpsf,rec = pm.run(image,psfname=scen['psf'],binned=scen['binned'],
+                                        engine=engine,nthreads=nthreads,metrics=True)
+        rss1 = metrics.maxrss()
+        res['wall'] = rec['wall']
+        res['cpu'] = rec['cpu']
+        res['maxrss'] = rec['maxrss']
+        res['rss_delta'] = (rss1-rss0 if rss0 is not None else None)
+        res['nout'] = 0 if out is None else len(out)
+        res['stars_per_sec'] = res['nout']/np.maximum(rec['wall'],1e-10)
+        res['stages'] = [{k:st.get(k) for k in ['stage','wall','cpu','rss_delta']} for st in rec['stages']]
+        res.update(accuracy(out,truth))
+        res['status'] = 'done'
+    except Exception as e:
+        res['error'] = repr(e)
+    if verbose:
+        if res['status']=='done':
+            print('%-45s %-7s %7d stars %8.2f sec %9.1f stars/s %8.1f MB  compl=%.3f  dmag=%s' %
+                  (scen['name'],engine,res['nout'],res['wall'],res['stars_per_sec'],
+                   res['maxrss'] if res['maxrss'] is not None else -1,res['completeness'],
+                   '%.4f' % res['dmag_sigma'] if res['dmag_sigma'] is not None else 'None'))
+        else:
+            print('%-45s %-7s FAILED %s' % (scen['name'],engine,res['error']))
+    return metrics.jsonvalue(res)
+
+
+def _runscenario(args):
+    """ Helper for running a scenario in a separate process."""
+    return runscenario(*args)
+
+
+def environment():
+    """ Versions and machine information to save with the results."""
+    from . import __version__
+    env = {'prometheus':__version__, 'python':platform.python_version(),
+           'numpy':np.__version__, 'platform':platform.platform(),
+           'machine':platform.machine(), 'ncpu':os.cpu_count(),
+           'time':time.strftime('%Y-%m-%dT%H:%M:%S')}
+    try:
+        import numba
+        env['numba'] = numba.__version__
+    except ImportError:
+        env['numba'] = None
+    return env
+
+
+def bench(preset='quick',sizes=None,densities=None,psfs=None,binned=None,crowding=None,
+          engines=None,nthreads=None,seed=1,isolate=True,warmup=True,outfile=None,verbose=True):
+    """
+    Run the benchmark suite.
+
+    Parameters
+    ----------
+    preset : str, optional
+       Scenario matrix to start from: "quick", "default" or "full".  Default is "quick".
+    sizes, densities, psfs, binned, crowding, engines : list, optional
+       Override the values of the preset.
+    nthreads : int, optional
+       Number of threads for the numba/static PSF photometry.
+    seed : int, optional
+       Base random seed.  Default is 1.
+    isolate : boolean, optional
+       Run each scenario in a new process so the peak memory is that of the
+         scenario only.  Default is True.
+    warmup : boolean, optional
+       Do a small untimed run first in each process.  Default is True.
+    outfile : str, optional
+       Save the results to this JSON file.
+    verbose : boolean, optional
+       Print a line for each scenario.  Default is True.
+
+    Returns
+    -------
+    results : dict
+       The environment ("env") and list of scenario results ("results").
+
+    Example
+    -------
+
+    results = bench('quick',outfile='bench.json')
+
+    """
+    if preset not in PRESETS:
+        raise ValueError('Preset '+str(preset)+' not supported.  Select '+', '.join(PRESETS.keys()))
+    pars = dict(PRESETS[preset])
+    for k,v in zip(['sizes','densities','psfs','binned','crowding','engines'],
+                   [sizes,densities,psfs,binned,crowding,engines]):
+        if v is not None:
+            pars[k] = list(v)
+    scens = scenarios(pars['sizes'],pars['densities'],pars['psfs'],pars['binned'],
+                      pars['crowding'],seed=seed)
+    tasks = [(scen,eng,nthreads,warmup,verbose) for scen in scens for eng in pars['engines']]
+    if verbose:
+        print('Running %d scenarios x %d engines' % (len(scens),len(pars['engines'])))
+
+    reslist = []
+    if isolate:
+        import multiprocessing as mp
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(1,maxtasksperchild=1) as pool:
+            for task in tasks:
+                reslist.append(pool.apply(_runscenario,(task,)))
+    else:
+        for task in tasks:
+            reslist.append(runscenario(*task))
+
+    results = {'env':environment(), 'preset':preset, 'matrix':pars, 'seed':seed,
+               'results':reslist}
+    if outfile is not None:
+        with open(outfile,'w') as f:
+            json.dump(results,f,indent=1)
+    return results
+
+
+def load(filename):
+    """ Load the results of bench() from a JSON file."""
+    with open(filename,'r') as f:
+        return json.load(f)
+
+
+def compare(old,new,tol=0.1,verbose=True):
+    """
+    Compare two benchmark results, e.g. of two versions.
+
+    Parameters
+    ----------
+    old : dict or str
+       The reference results or the name of their JSON file.
+    new : dict or str
+       The new results or the name of their JSON file.
+    tol : float, optional
+       Fractional slow-down (or increase in memory or magnitude scatter)
+         above which a scenario is flagged as a regression.  Default is 0.1.
+    verbose : boolean, optional
+       Print the comparison.  Default is True.
+
+    Returns
+    -------
+    tab : table
+       One row per scenario/engine in both results with the old and new
+         wall time, speed-up, memory, magnitude scatter and regression flag.
+
+    Example
+    -------
+
+    tab = compare('bench_old.json','bench_new.json')
+
+    """
+    from astropy.table import Table
+    if isinstance(old,str):
+        old = load(old)
+    if isinstance(new,str):
+        new = load(new)
+    oldres = {(r['name'],r['engine']):r for r in old['results'] if r['status']=='done'}
+    rows = []
+    for r in new['results']:
+        key = (r['name'],r['engine'])
+        if key not in oldres or r['status']!='done':
+            continue
+        o = oldres[key]
+        speedup = o['wall']/np.maximum(r['wall'],1e-10)
+        regress = r['wall'] > (1+tol)*o['wall']
+        if o['maxrss'] is not None and r['maxrss'] is not None:
+            regress |= r['maxrss'] > (1+tol)*o['maxrss']
+        if o['dmag_sigma'] is not None and r['dmag_sigma'] is not None:
+            regress |= r['dmag_sigma'] > (1+tol)*o['dmag_sigma']+1e-3
+        rows.append((r['name'],r['engine'],o['wall'],r['wall'],speedup,
+                     np.nan if o['maxrss'] is None else o['maxrss'],
+                     np.nan if r['maxrss'] is None else r['maxrss'],
+                     np.nan if o['dmag_sigma'] is None else o['dmag_sigma'],
+                     np.nan if r['dmag_sigma'] is None else r['dmag_sigma'],regress))
+    dt = np.dtype([('name',str,60),('engine',str,10),('oldwall',float),('newwall',float),
+                   ('speedup',float),('oldrss',float),('newrss',float),('olddmag',float),
+                   ('newdmag',float),('regression',bool)])
+    tab = Table(np.array(rows,dtype=dt))
+    if verbose:
+        print('Old: prometheus %s   New: prometheus %s' % (old['env']['prometheus'],new['env']['prometheus']))
+        for t in tab:
+            print('%-45s %-7s %8.2f -> %8.2f sec  x%5.2f  %8.1f -> %8.1f MB  %s' %
+                  (t['name'],t['engine'],t['oldwall'],t['newwall'],t['speedup'],
+                   t['oldrss'],t['newrss'],'REGRESSION' if t['regression'] else ''))
+    return tab
+
+
+def main(args=None):
+    """ Command-line interface, run "python -m prometheus.bench --help"."""
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Run the Prometheus benchmark suite on synthetic images')
+    parser.add_argument('--preset', type=str, default='quick', choices=list(PRESETS.keys()),
+                        help='Scenario matrix.  Default is quick.')
+    parser.add_argument('--sizes', type=int, nargs='+', help='Image sizes (pixels).')
+    parser.add_argument('--densities', type=float, nargs='+', help='Star densities (stars per pixel).')
+    parser.add_argument('--psfs', type=str, nargs='+', choices=list(PSFSHAPE.keys()), help='PSF types.')
+    parser.add_argument('--binned', type=str, nargs='+', choices=['yes','no'], help='Binned PSF.')
+    parser.add_argument('--crowding', type=str, nargs='+', choices=['uniform','clustered'],
+                        help='Star distributions.')
+    parser.add_argument('--engines', type=str, nargs='+', choices=['python','numba','static'],
+                        help='Compute engines.')
+    parser.add_argument('--nthreads', type=int, default=None, help='Threads for the numba/static PSF photometry.')
+    parser.add_argument('--seed', type=int, default=1, help='Base random seed.')
+    parser.add_argument('--noisolate', action='store_true', help='Run all scenarios in this process.')
+    parser.add_argument('--nowarmup', action='store_true', help='Do not do an untimed warm-up run.')
+    parser.add_argument('-o','--outfile', type=str, default=None, help='Output JSON file.')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('OLD','NEW'),
+                        help='Compare two result files instead of running.')
+    parser.add_argument('--tol', type=float, default=0.1, help='Regression tolerance for --compare.')
+    args = parser.parse_args(args)
+
+    if args.compare is not None:
+        tab = compare(args.compare[0],args.compare[1],tol=args.tol)
+        return 1 if np.any(tab['regression']) else 0
+
+    binned = None if args.binned is None else [b=='yes' for b in args.binned]
+    bench(args.preset,sizes=args.sizes,densities=args.densities,psfs=args.psfs,binned=binned,
+          crowding=args.crowding,engines=args.engines,nthreads=args.nthreads,seed=args.seed,
+          isolate=(not args.noisolate),warmup=(not args.nowarmup),outfile=args.outfile)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
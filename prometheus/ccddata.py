@@ -59,6 +59,48 @@ def getrdnoise(image):
                     break
     return rdnoise
 
+def tonative(data,dtype=None,nrows=256):
+    """
+    Copy an array (e.g. a FITS memory map) to native byte order in blocks
+    of rows so the full non-native array is never read into memory at once.
+    If dtype is None, then floating point data keeps its original type
+    and integer data is converted to float.
+    """
+    if dtype is None:
+        dtype = np.result_type(data.dtype,np.float32)
+    dtype = np.dtype(dtype).newbyteorder('=')
+    out = np.empty(data.shape,dtype)
+    if data.ndim<2:
+        out[...] = data
+        return out
+    for i in range(0,data.shape[0],nrows):
+        out[i:i+nrows] = data[i:i+nrows]
+    return out
+
+def badpixmask(data,error=None,nrows=256):
+    """
+    Find the non-finite pixels (and bad errors) in blocks of rows and set them
+    to 0.0 (and 1e30 for the errors) in place.  The mask is only created if
+    there are bad pixels, otherwise None is returned.
+    """
+    mask = None
+    if data.ndim==0:
+        slcs = [Ellipsis]
+    else:
+        slcs = [slice(i,i+nrows) for i in range(0,data.shape[0],nrows)]
+    for slc in slcs:
+        bad = ~np.isfinite(data[slc])
+        if error is not None:
+            bad |= (~np.isfinite(error[slc])) | (error[slc]<=0)
+        if np.any(bad):
+            if mask is None:
+                mask = np.zeros(data.shape,bool)
+            mask[slc] = bad
+            data[slc][bad] = 0.0
+            if error is not None:
+                error[slc][bad] = 1e30
+    return mask
+
 def mkbbox(data):
     """ Make BoundingBox and x,y arrays for data."""
 
@@ -173,16 +215,12 @@ class CCDData(CCD):
             unit = 'adu'
 
         # Check for non-finite values
-        bad = (~np.isfinite(data))
-        if error is not None:
-            bad = bad | (~np.isfinite(error)) | (error <=0)
-            if np.sum(bad)>0:
-                error[bad] = 1e30
-        if np.sum(bad)>0:
-            data[bad] = 0.0            
+        bad = badpixmask(np.asarray(data),error)
+        if bad is not None:
             if mask is None:
-                mask = np.array(data.shape,bool)
-            mask[bad] = True    # masked means bad
+                mask = bad
+            else:
+                mask[bad] = True    # masked means bad
             
         # Initialize with the parent...
         super().__init__(data, *args, mask=mask, copy=copy, unit=unit, **kwargs)
@@ -871,6 +909,49 @@ class CCDData(CCD):
         """
         return self.__class__(self, copy=True, error=self._error, gain=self._gain, rdnoise=self._rdnoise)
 
+    def datacopy(self,sky=True,dtype=None):
+        """
+        Return a copy-on-write copy of the CCDData object.  Only the data array
+        is copied.  The error, mask and sky arrays are shared with the original
+        object and should be treated as read-only.  To change one of them in
+        the copy assign a new array to it instead of modifying it in place.
+
+        Parameters
+        ----------
+        sky : boolean, optional
+          Share the sky with the original object.  If False, then the sky
+          will be recomputed from the copied data when it is needed.
+          Default is True.
+        dtype : data-type, optional
+          Convert the data, error and sky arrays to this type.  Arrays that
+          already have this type are still shared.  Default is to keep the
+          current type.
+
+        Returns
+        -------
+        new : CCDData object
+          The copy of the CCDData object.
+
+        Example
+        -------
+
+        resid = image.datacopy()
+        resid.data -= model.data
+
+        """
+
+        if dtype is None:
+            dtype = self.data.dtype
+        wcs = deepcopy(self.wcs) if self.wcs is not None else None
+        new = self.__class__(self.data.astype(dtype), meta=self.meta.copy(), wcs=wcs, unit=self.unit,
+                             bbox=deepcopy(self.bbox), gain=self._gain, rdnoise=self._rdnoise,
+                             skyfunc=self._skyfunc)
+        new._error = self.error.astype(dtype,copy=False)
+        new.mask = self.mask
+        if sky:
+            new._sky = self.sky.astype(dtype,copy=False)
+        return new
+
     def write(self,outfile,overwrite=True):
         """
         Write the image data to a file.
@@ -939,79 +1020,108 @@ class CCDData(CCD):
         return hdu
         
     @classmethod
-    def read(cls,filename):
-        """ Read in an image from file."""
+    def read(cls,filename,memmap=False,dtype=float):
+        """
+        Read in an image from file.
+
+        Parameters
+        ----------
+        filename : str
+          The FITS filename.
+        memmap : boolean, optional
+          Memory-map the file and convert the arrays to native byte order
+          in blocks of rows.  The mask is only created if there are bad
+          pixels and the error is computed only when it is needed if it
+          is not in the file.  Default is False.
+        dtype : data-type, optional
+          The data type of the data, error and sky arrays.  If None, then
+          the data type of the file is kept (e.g. float32).  Default is float.
+
+        Returns
+        -------
+        image : CCDData object
+          The image.
 
-        hdulist = fits.open(filename)
+        Example
+        -------
+
+        image = CCDData.read('image.fits',memmap=True,dtype=None)
+
+        """
+
+        if memmap:
+            hdulist = fits.open(filename,memmap=True)
+        else:
+            hdulist = fits.open(filename)
         nhdu = len(hdulist)
         # Checking if there's an image in HDU0 or HDU1
         if nhdu==1 and hdulist[0].data is None:
             print('No image in '+filename)
         if nhdu>1 and hdulist[0].data is None and hdulist[1].data is None:
-            print('No image in first two extensions of '+filename)            
+            print('No image in first two extensions of '+filename)
+        # HDU indices of data, error, mask, flags and sky
+        hduindex = {}
         # Prometheus file type
         if hdulist[0].header.get('IMAGTYPE') == 'Prometheus':
             # HDU0: Data and header
-            data = hdulist[0].data
-            head = hdulist[0].header
-            # HDU1: error
-            if nhdu>1:
-                error = hdulist[1].data
-                ehead = hdulist[1].header
-            else:
-                error = None
-            # HDU2: mask
-            if nhdu>2:
-                mask = hdulist[2].data
-                mhead = hdulist[2].header
-            else:
-                mask = None
-            # HDU3: flags
-            if nhdu>3:
-                flags = hdulist[3].data
-                fhead = hdulist[3].header
-            else:
-                flags = None
-            # HDU4: sky
-            if nhdu>4:
-                sky = hdulist[4].data
-                shead = hdulist[4].header
-            else:
-                sky = None
+            hduindex['data'] = 0
+            # HDU1: error, HDU2: mask, HDU3: flags, HDU4: sky
+            for i,n in enumerate(['error','mask','flags','sky']):
+                if nhdu>i+1:
+                    hduindex[n] = i+1
         # Other file type
         else:
-            datanum = 0
-            if hdulist[0].data is not None: datanum=1
-                
             # Image in HDU0
             if hdulist[0].data is not None:
-                # data
-                data = hdulist[0].data
-                head = hdulist[0].header
+                hduindex['data'] = 0
                 # error
                 if nhdu>1 and hdulist[1].data is not None:
-                    error = hdulist[1].data
-                else:
-                    error = None
+                    hduindex['error'] = 1
             else:
-                # data
-                data = hdulist[1].data
-                head = hdulist[1].header
+                hduindex['data'] = 1
                 # error
                 if nhdu>2 and hdulist[2].data is not None:
-                    error = hdulist[2].data
+                    hduindex['error'] = 2
+        head = hdulist[hduindex['data']].header.copy()
+
+        # Memory-mapped, convert the arrays to native byte order block by
+        #  block and release the memory map pages after each array
+        arrays = {'data':None,'error':None,'mask':None,'flags':None,'sky':None}
+        if memmap:
+            from .utils import refresh_mmap
+            for n in hduindex.keys():
+                hdata = hdulist[hduindex[n]].data
+                if hdata is None:
+                    continue
+                if n=='mask':
+                    arrays[n] = tonative(hdata,bool)
+                elif n=='flags':
+                    arrays[n] = tonative(hdata,hdata.dtype)
                 else:
-                    error = None
-            # mask
-            mask = np.zeros(data.shape,bool)
-            bad = (~np.isfinite(data))
-            if error is not None:
-                bad = bad | (~np.isfinite(error))
-            mask[bad] = True    # masked means bad
-            # flags, sky
-            flags = None
-            sky = None
-            
+                    arrays[n] = tonative(hdata,dtype)
+                del hdata
+                refresh_mmap(hdulist)
+            # Only make the mask if there are bad pixels
+            if arrays['mask'] is None:
+                arrays['mask'] = badpixmask(arrays['data'],arrays['error'])
+        else:
+            for n in hduindex.keys():
+                arrays[n] = hdulist[hduindex[n]].data
+            # Make sure the data is float
+            if dtype is None:
+                dtype = np.result_type(arrays['data'].dtype,np.float32)
+            arrays['data'] = arrays['data'].astype(dtype)
+            if 'mask' not in hduindex:
+                # mask
+                mask = np.zeros(arrays['data'].shape,bool)
+                bad = (~np.isfinite(arrays['data']))
+                if arrays['error'] is not None:
+                    bad = bad | (~np.isfinite(arrays['error']))
+                mask[bad] = True    # masked means bad
+                arrays['mask'] = mask
+        data,error,mask = arrays['data'],arrays['error'],arrays['mask']
+        flags,sky = arrays['flags'],arrays['sky']
+        
         hdulist.close()
         # Make WCS, this doesn't capture the PV#_# values
         w = WCS(head)
@@ -1022,9 +1132,6 @@ class CCDData(CCD):
         if unit is None:
             unit = 'adu'
 
-        # Make sure the data is float
-        data = data.astype(float)
-            
         # make the ccddata object
         image = CCDData(data,error=error,mask=mask,meta=head,
                         flags=flags,sky=sky,wcs=w,unit=unit)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""COMPILED.PY - Load the AOT-compiled numba modules with a JIT fallback
+
+"""
+
+__authors__ = 'David Nidever <dnidever@montana.edu?'
+__version__ = '20261018'  # yyyymmdd
+
+
+import os
+import importlib
+
+# The *_numba_static.py files define numba.pycc modules that are compiled
+# ahead-of-time by setup.py (or by running the files as __main__ in this
+# directory) into the _*_numba_static extension modules.  The key is the
+# static name and the value the JIT module with the same functions.
+STATICMODULES = {'utils':'utils_numba', 'ladfit':None, 'models':'models_numba',
+                 'getpsf':'getpsf_numba', 'groupfit':'groupfit_numba',
+                 'allfit':'allfit_numba'}
+
+# Cache the JIT-compiled functions on disk, set PROMETHEUS_NUMBA_CACHE=0 to turn off
+NUMBACACHE = os.environ.get('PROMETHEUS_NUMBA_CACHE','1').lower() not in ['0','false','no']
+
+_static = {}
+_dispatchers = {}
+
+
+def njit(*args,**kwargs):
+    """
+    Same as numba.njit but with on-disk caching turned on by default.
+    Can be used as @njit or @njit(...).
+    """
+    import numba
+    kwargs.setdefault('cache',NUMBACACHE)
+    if len(args)==1 and callable(args[0]):
+        return numba.njit(**kwargs)(args[0])
+    return numba.njit(*args,**kwargs)
+
+
+def staticmodule(name):
+    """
+    Import an AOT-compiled numba module.
+
+    Parameters
+    ----------
+    name : str
+       Name of the module, e.g. "allfit" for _allfit_numba_static.
+
+    Returns
+    -------
+    module : module
+       The extension module or None if it has not been compiled.
+
+    Example
+    -------
+
+    mod = staticmodule('utils')
+
+    """
+    if name not in _static:
+        try:
+            _static[name] = importlib.import_module('prometheus._'+name+'_numba_static')
+        except ImportError:
+            _static[name] = None
+    return _static[name]
+
+
+def hasstatic(name=None):
+    """ Check if the AOT-compiled module (or all of them) is available."""
+    if name is None:
+        return all([staticmodule(n) is not None for n in STATICMODULES])
+    return staticmodule(name) is not None
+
+
+class Dispatcher(object):
+    """
+    Module-like object that returns the AOT-compiled version of a function
+    if it exists and the JIT version otherwise.
+
+    Parameters
+    ----------
+    name : str
+       Name of the module, e.g. "allfit".
+    static : bool, optional
+       Use the AOT-compiled functions.  By default, they are used if the
+         extension module was built.
+
+    Example
+    -------
+
+    afit = Dispatcher('allfit')
+    afit.getstarinfo(...)
+
+    """
+
+    def __init__(self,name,static=None):
+        self.name = name
+        self._jitmodule = None
+        if static is None or static is True:
+            self.staticmodule = staticmodule(name)
+            if static is True and self.staticmodule is None:
+                raise ImportError('prometheus._'+name+'_numba_static has not been compiled')
+        else:
+            self.staticmodule = None
+
+    @property
+    def jitmodule(self):
+        """ The JIT module, only imported when it is needed."""
+        if self._jitmodule is None and STATICMODULES[self.name] is not None:
+            self._jitmodule = importlib.import_module('prometheus.'+STATICMODULES[self.name])
+        return self._jitmodule
+
+    @property
+    def isstatic(self):
+        """ Whether the AOT-compiled module is used."""
+        return self.staticmodule is not None
+
+    def __getattr__(self,attr):
+        if attr in ['name','_jitmodule','staticmodule']:
+            raise AttributeError(attr)
+        if self.staticmodule is not None and hasattr(self.staticmodule,attr):
+            return getattr(self.staticmodule,attr)
+        if self.jitmodule is None:
+            raise AttributeError(self.name+' has no function '+attr)
+        return getattr(self.jitmodule,attr)
+
+    def __repr__(self):
+        return 'Dispatcher('+self.name+', static='+str(self.isstatic)+')'
+
+
+def load(name,static=None):
+    """
+    Get the numba functions of a module, AOT-compiled when available.
+
+    Parameters
+    ----------
+    name : str
+       Name of the module: utils, ladfit, models, getpsf, groupfit or allfit.
+    static : bool, optional
+       True to require the AOT-compiled module, False to only use the JIT
+         module.  By default, the AOT-compiled module is used if it exists.
+
+    Returns
+    -------
+    mod : Dispatcher
+       Module-like object with the functions.
+
+    Example
+    -------
+
+    afit = load('allfit')
+
+    """
+    if name not in STATICMODULES:
+        raise ValueError(name+' not supported.  Select '+', '.join(STATICMODULES.keys()))
+    key = (name,static)
+    if key not in _dispatchers:
+        _dispatchers[key] = Dispatcher(name,static)
+    return _dispatchers[key]
@@ -5,23 +5,346 @@
 """
 
 __authors__ = 'David Nidever <dnidever@montana.edu?'
-__version__ = '20241011'  # yyyymmdd
+__version__ = '20261019'  # yyyymmdd
 
 
 import os
 import sys
+import time
 import numpy as np
-import scipy
 import warnings
-from astropy.io import fits
 from astropy.table import Table
-from . import allfit
+from scipy import ndimage
+from . import allfit,detection,aperture
+from .ccddata import CCDData
+from .forced import footprintcolors
+
+# The artificial stars are injected into the original image and only the
+#  cutouts around them are re-detected and refit, the real stars and the
+#  PSF come from the original run.  The stars of one batch are far enough
+#  apart that their cutouts do not see each other.  sep deblends each
+#  connected region above the threshold as a whole, so the cutouts are
+#  grown to contain the full regions that an artificial star touches.
+
+
+def makeatab(shape,psf,nstars=1000,magr=[18.0,24.0],edge=None,seed=None):
+    """
+    Make a table of artificial stars with uniform positions and magnitudes.
+
+    Parameters
+    ----------
+    shape : tuple
+       Image shape (ny,nx).
+    psf : PSF object
+       The PSF model.  Used to convert the magnitudes to amplitudes.
+    nstars : int, optional
+       Number of artificial stars.  Default is 1000.
+    magr : list, optional
+       Magnitude range.  Default is [18.0,24.0].
+    edge : float, optional
+       Distance from the image edges in pixels.  Default is the PSF radius.
+    seed : int, optional
+       Seed for the random number generator.
+
+    Returns
+    -------
+    atab : table
+       Table of artificial stars with id, x, y, amp and mag columns.
+
+    Example
+    -------
+
+    atab = makeatab(image.shape,psf,5000,magr=[20,26])
+
+    """
+    ny,nx = shape
+    if edge is None:
+        edge = psf.radius
+    rng = np.random.RandomState(seed)
+    atab = Table()
+    atab['id'] = np.arange(nstars)+1
+    atab['x'] = rng.uniform(edge,nx-1-edge,nstars)
+    atab['y'] = rng.uniform(edge,ny-1-edge,nstars)
+    atab['mag'] = rng.uniform(magr[0],magr[1],nstars)
+    # same zero-point as the PSF photometry
+    atab['amp'] = 10**(-0.4*(atab['mag']-25.0))/psf.flux()
+    return atab
+
+
+def astbatches(x,y,dist,batchsize=None):
+    """
+    Split the artificial stars into batches of stars that are at least
+    dist pixels apart (in x or y).
+
+    Parameters
+    ----------
+    x : numpy array
+       X-coordinates of the artificial stars.
+    y : numpy array
+       Y-coordinates of the artificial stars.
+    dist : float
+       Minimum separation of the stars of a batch in pixels.
+    batchsize : int, optional
+       Maximum number of stars in a batch.  Default is no limit.
+
+    Returns
+    -------
+    batches : list
+       List of index arrays, one per batch.
+
+    Example
+    -------
+
+    batches = astbatches(atab['x'],atab['y'],50)
 
-def ast(image,psf,atab,detmethod='sep',iterdet=0,ndetsigma=1.5,snrthresh=5,
-        fitradius=None,recenter=True,apcorr=False,timestamp=False,verbose=False):
-        
     """
-    Artificial stars.
+    colors = footprintcolors(np.asarray(x,float),np.asarray(y,float),dist)
+    batches = []
+    for c in range(np.max(colors)+1):
+        ind, = np.where(colors==c)
+        if batchsize is None:
+            batches.append(ind)
+        else:
+            for lo in range(0,len(ind),batchsize):
+                batches.append(ind[lo:lo+batchsize])
+    return batches
+
+
+def cutoutbounds(x,y,cutrad,shape,labels=None,radius=0,pad=0):
+    """
+    Get the cutout bounds of the artificial stars.  The cutouts are boxes
+    of half-size cutrad, grown to contain the connected detection regions
+    of the original image that are within radius of the star.
+
+    Parameters
+    ----------
+    x : numpy array
+       X-coordinates of the artificial stars.
+    y : numpy array
+       Y-coordinates of the artificial stars.
+    cutrad : int
+       Half-size of the cutouts in pixels.
+    shape : tuple
+       Image shape (ny,nx).
+    labels : numpy array, optional
+       Image of the labels of the connected detection regions (0 is no
+         region), e.g. from scipy.ndimage.label() of the sep segmentation map.
+    radius : int, optional
+       Pixels within this distance of a star in x and y are checked for
+         detection regions.  Default is 0.
+    pad : int, optional
+       Number of pixels to grow the detection regions by, e.g. for the
+         detection filter kernel.  Default is 0.
+
+    Returns
+    -------
+    bounds : numpy array
+       Array of [x0,x1,y0,y1] for each star, the upper values are exclusive.
+
+    Example
+    -------
+
+    bounds = cutoutbounds(atab['x'],atab['y'],50,image.shape,labels,psf.radius)
+
+    """
+    ny,nx = shape
+    xc = np.round(np.asarray(x,float)).astype(int)
+    yc = np.round(np.asarray(y,float)).astype(int)
+    bounds = np.zeros((len(xc),4),int)
+    bounds[:,0] = np.maximum(xc-cutrad,0)
+    bounds[:,1] = np.minimum(xc+cutrad+1,nx)
+    bounds[:,2] = np.maximum(yc-cutrad,0)
+    bounds[:,3] = np.minimum(yc+cutrad+1,ny)
+    if labels is None:
+        return bounds
+    slices = ndimage.find_objects(labels)
+    radius = int(np.ceil(radius))
+    for i in range(len(xc)):
+        box = labels[max(yc[i]-radius,0):min(yc[i]+radius+1,ny),
+                     max(xc[i]-radius,0):min(xc[i]+radius+1,nx)]
+        for lab in np.unique(box[box>0]):
+            sl = slices[lab-1]
+            bounds[i,0] = min(bounds[i,0],max(sl[1].start-pad,0))
+            bounds[i,1] = max(bounds[i,1],min(sl[1].stop+pad,nx))
+            bounds[i,2] = min(bounds[i,2],max(sl[0].start-pad,0))
+            bounds[i,3] = max(bounds[i,3],min(sl[0].stop+pad,ny))
+    return bounds
+
+
+def initworker(image,psf,cat):
+    """ Initialize an artificial star worker process with the image, PSF and catalog."""
+    global _image,_psf,_cat
+    _image = image
+    _psf = psf
+    _cat = cat
+
+
+def astcutout(image,psf,cat,astar,bounds,matchdist,rng,detmethod='sep',ndetsigma=1.5,
+              snrthresh=5,fitradius=None,recenter=True):
+    """
+    Inject one artificial star and re-detect and refit the cutout around it.
+
+    Parameters
+    ----------
+    image : CCDData object
+       The original image.
+    psf : PSF object
+       The PSF model.
+    cat : table
+       Catalog of the real stars with x, y and amp columns.
+    astar : table row
+       The artificial star with x, y and amp.
+    bounds : list
+       Cutout bounds [x0,x1,y0,y1], the upper values are exclusive.
+         See cutoutbounds().
+    matchdist : float
+       Maximum distance in pixels for a detection to match a star.
+    rng : RandomState
+       Random number generator for the noise of the artificial star.
+    detmethod : str, optional
+       Detection method.  Default is "sep".
+    ndetsigma : float, optional
+       Detection threshold in units of sigma.  Default is 1.5.
+    snrthresh : float, optional
+       Signal-to-Noise threshold for detections.  Default is 5.
+    fitradius : float, optional
+       The fitting radius in pixels.  By default the PSF FWHM is used.
+    recenter : boolean, optional
+       Allow the centroids to be fit.  Default is True.
+
+    Returns
+    -------
+    out : dict
+       Dictionary with the recovered values of the artificial star.
+
+    Example
+    -------
+
+    out = astcutout(image,psf,cat,atab[0],[100,151,200,251],2.0,rng)
+
+    """
+    out = {'recovered':False,'xout':np.nan,'yout':np.nan,'ampout':np.nan,'amp_error':np.nan,
+           'magout':np.nan,'mag_error':np.nan,'chisq':np.nan,'nfit':0}
+    x0,x1,y0,y1 = [int(b) for b in bounds]
+    mask = image.mask[y0:y1,x0:x1] if image.mask is not None else None
+    cut = CCDData(np.array(image.data[y0:y1,x0:x1],float),error=np.array(image.error[y0:y1,x0:x1],float),
+                  mask=mask,gain=image.gain,rdnoise=image.rdnoise)
+    cut._sky = np.array(image.sky[y0:y1,x0:x1],float)
+
+    # Real stars, in cutout coordinates
+    cx = np.array(cat['x'])-x0
+    cy = np.array(cat['y'])-y0
+    rad = psf.radius
+    near, = np.where((cx>=-rad) & (cx<x1-x0+rad) & (cy>=-rad) & (cy<y1-y0+rad))
+    inside = (cx[near]>=0) & (cx[near]<=x1-x0-1) & (cy[near]>=0) & (cy[near]<=y1-y0-1)
+    # The stars outside of the cutout are not refit, subtract their models
+    outside = near[~inside]
+    if len(outside)>0:
+        otab = Table({'amp':np.array(cat['amp'])[outside],'x':cx[outside],'y':cy[outside],
+                      'sky':np.zeros(len(outside))})
+        cut.data = psf.sub(cut,otab)
+    real = near[inside]
+
+    # Inject the artificial star with Poisson noise
+    atab1 = Table({'amp':[astar['amp']],'x':[astar['x']-x0],'y':[astar['y']-y0],'sky':[0.0]})
+    addmodel = psf.add(cut,atab1)-cut.data
+    addvar = np.maximum(addmodel,0)/cut.gain
+    cut.data = cut.data + addmodel + rng.randn(*addmodel.shape)*np.sqrt(addvar)
+    cut._error = np.sqrt(cut.error**2+addvar)
+
+    # Detection and aperture photometry, like run()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            objects = detection.detect(cut,method=detmethod,nsigma=ndetsigma)
+            objects = aperture.aperphot(cut,objects)
+        except Exception:
+            return out
+    if len(objects)==0:
+        return out
+    gd, = np.where((objects['snr'] >= snrthresh) & np.isfinite(objects['mag_auto']))
+    objects = objects[gd]
+    if len(objects)==0:
+        return out
+    # Each detection belongs to the closest of the real stars and the
+    #  artificial star, the ones that match a real star are not new
+    srcx = np.append(cx[real],astar['x']-x0)
+    srcy = np.append(cy[real],astar['y']-y0)
+    dist = np.hypot(np.array(objects['x']).reshape(-1,1)-srcx.reshape(1,-1),
+                    np.array(objects['y']).reshape(-1,1)-srcy.reshape(1,-1))
+    closest = np.argmin(dist,axis=1)
+    mindist = np.min(dist,axis=1)
+    new = (mindist>matchdist) | (closest==len(real))
+    objects,dist = objects[new],dist[new,-1]
+    match = (mindist[new]<=matchdist) & (closest[new]==len(real))
+    if np.sum(match)==0:
+        return out
+    dist[~match] = np.inf
+
+    # Refit the real stars and the new detections
+    nreal = len(real)
+    fitcat = Table()
+    fitcat['id'] = np.arange(nreal+len(objects))+1
+    fitcat['x'] = np.concatenate((cx[real],np.array(objects['x'])))
+    fitcat['y'] = np.concatenate((cy[real],np.array(objects['y'])))
+    # estimate amp from flux and fwhm, like allfit.fit()
+    detamp = np.maximum(np.array(objects['flux'])/(2*np.pi*(psf.fwhm()/2.35)**2),0)
+    fitcat['amp'] = np.concatenate((np.array(cat['amp'])[real],detamp))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            psfout,model,sky = allfit.fit(psf,cut,fitcat,fitradius=fitradius,recenter=recenter)
+        except Exception:
+            return out
+    ind = nreal+np.argmin(dist)
+    out['recovered'] = True
+    out['xout'] = psfout['x'][ind]+x0
+    out['yout'] = psfout['y'][ind]+y0
+    out['ampout'] = psfout['amp'][ind]
+    out['amp_error'] = psfout['amp_error'][ind]
+    out['magout'] = psfout['mag'][ind]
+    out['mag_error'] = psfout['mag_error'][ind]
+    out['chisq'] = psfout['chisq'][ind]
+    out['nfit'] = len(fitcat)
+    return out
+
+
+def astbatch(args):
+    """
+    Run the artificial star tests of one batch.  The image, PSF and catalog
+    come from initworker().
+
+    Parameters
+    ----------
+    args : tuple
+       Tuple of (atab, bounds, seed, kwargs), the artificial stars of the
+         batch, their cutout bounds, the seed of the noise and the keywords
+         for astcutout().
+
+    Returns
+    -------
+    results : list
+       List of the astcutout() outputs.
+
+    Example
+    -------
+
+    results = astbatch((atab[ind],bounds[ind],seed,kwargs))
+
+    """
+    atab1,bounds,seed,kwargs = args
+    rng = np.random.RandomState(seed)
+    return [astcutout(_image,_psf,_cat,atab1[i],bounds[i],rng=rng,**kwargs) for i in range(len(atab1))]
+
+
+def ast(image,psf,cat,atab,nproc=1,batchsize=None,cutrad=None,matchdist=None,detmethod='sep',
+        ndetsigma=1.5,snrthresh=5,fitradius=None,recenter=True,seed=None,verbose=False):
+    """
+    Artificial star tests.  The artificial stars are injected in batches of
+    stars that are far enough apart not to overlap.  Only the cutouts around
+    them are re-detected and refit, together with the real stars in the
+    cutouts.  The real stars, their models and the PSF come from the
+    original run.
 
     Parameters
     ----------
@@ -29,156 +352,192 @@ def ast(image,psf,atab,detmethod='sep',iterdet=0,ndetsigma=1.5,snrthresh=5,
        The image to add artificial stars to.
     psf : PSF object
        The best-fit PSF.
+    cat : table
+       Catalog of the real stars from run(), needs x, y and amp (or psfamp) columns.
     atab : table
-       Table of artificial stars to add.  Need columns: x, y, amp/ht.
-
+       Table of artificial stars to add.  Need columns: x, y, amp.  See makeatab().
+    nproc : int, optional
+       Number of processes to run the batches with.  Default is 1.
+    batchsize : int, optional
+       Maximum number of artificial stars in a batch.  Default is no limit.
+    cutrad : int, optional
+       Half-size of the cutouts in pixels.  With sep detection the cutouts
+         are grown to contain the connected detection regions of the image
+         that the artificial star touches.  Default is the PSF radius plus
+         the fitting radius, so all stars that overlap the fitted pixels of
+         the artificial star are refit.
+    matchdist : float, optional
+       Maximum distance in pixels between a detection and a star to match them.
+         Default is half the PSF FWHM.
+    detmethod : str, optional
+       Detection method.  Default is "sep".
+    ndetsigma : float, optional
+       Detection threshold in units of sigma.  Default is 1.5.
+    snrthresh : float, optional
+       Signal-to-Noise threshold for detections.  Default is 5.
+    fitradius : float, optional
+       The fitting radius in pixels.  By default the PSF FWHM is used.
+    recenter : boolean, optional
+       Allow the centroids to be fit.  Default is True.
+    seed : int, optional
+       Seed for the noise of the artificial stars.
+    verbose : boolean, optional
+       Verbose output to the screen.  Default is False.
 
     Returns
     -------
+    asttab : table
+       The artificial stars with their recovered values.
     ctab : table
-       Completeness table.
+       Completeness table, see completeness().
 
-    
     Examples
     --------
 
-    ctab = ast(image,psf,atab)
-
+    cat,model,sky,psf = prometheus.run(image)
+    atab = makeatab(image.shape,psf,5000)
+    asttab,ctab = ast(image,psf,cat,atab,nproc=4)
 
     """
 
-    # Add the stars to a new image
-    newim = image.copy()
-    for i in range(len(atab)):
-        newim += psf.add()
-        # add noise too
-
-    # Rerun prometheus run() steps, but use existing PSF
-    ######################################################
-    # I should really modify prometheus.run() to use an existing input PSF
-    # rather than always constructing a new one.
-    residim = newimage.copy()
-
-
-    # Processing steps
-    #-----------------
-    for niter in range(iterdet+1):
-    
-        # 1) Detection
-        #-------------
-        if verbose:
-            print('Step 1: Detection')
-        objects = detection.detect(residim,method=detmethod,
-                                   nsigma=ndetsigma,verbose=verbose)
-        objects['ndetiter'] = niter+1
-        if verbose:
-            print(str(len(objects))+' objects detected')
-
-        # 2) Aperture photometry
-        #-----------------------
-        if verbose:
-            print('Step 2: Aperture photometry')    
-        objects = aperture.aperphot(residim,objects)
-        nobjects = len(objects)
-        # Bright and faint limit, use 5th and 95th percentile
-        if niter==0:
-            minmag, maxmag = np.nanpercentile(objects['mag_auto'],(5,95))
-            if verbose:
-                print('Min/Max mag: %5.2f, %5.2f' % (minmag,maxmag))
-
-        # Imposing S/N cut
-        gd, = np.where((objects['snr'] >= snrthresh) & np.isfinite(objects['mag_auto']))
-        if len(gd)==0:
-            print('No objects passed S/N cut')
-            return None,None,None,None
-        objects = objects[gd]
-        objects['id'] = np.arange(len(objects))+1  # renumber
-        if verbose:
-            print('%d objects left after S/N=%5.1f cut' % (len(objects),snrthresh))
-
-        # 4) Run on all sources
-        #----------------------
-        # If niter>0, then use combined object catalog
-        if iterdet>0:
-            # Add detection
-            # Combine objects catalogs
-            if niter==0:
-                allobjects = objects.copy()
-            else:
-                objects['id'] = np.arange(len(objects))+1+np.max(allobjects['id'])
-                allobjects = vstack((allobjects,objects))
-            if 'group_id' in allobjects.keys():
-                allobjects.remove_column('group_id')
-        else:
-            allobjects = objects
-                
-        if verbose:
-            print('Step 4: Get PSF photometry for all '+str(len(allobjects))+' objects')
-        psfout,model,sky = allfit.fit(psf,newimage,allobjects,fitradius=fitradius,
-                                      recenter=recenter,verbose=(verbose>=2))
-
-        # Construct residual image
-        if iterdet>0:
-            residim = image.copy()
-            residim.data -= model.data
-            
-        # Combine aperture and PSF columns
-        outobj = allobjects.copy()
-        # rename some columns for clarity
-        outobj['x'].name = 'xc'
-        outobj['y'].name = 'yc'
-        outobj['a'].name = 'asemi'
-        outobj['b'].name = 'bsemi'        
-        outobj['flux'].name = 'sumflux'
-        outobj.remove_columns(['cxx','cyy','cxy'])
-        # copy over PSF output columns
-        for n in psfout.columns:
-            outobj[n] = psfout[n]
-        outobj['psfamp'] = outobj['amp'].copy()
-        outobj['amp_error'].name = 'psfamp_error'        
-        outobj['flux'].name = 'psfflux'
-        outobj['flux_error'].name = 'psfflux_error'        
-        # change mag, magerr to psfmag, psfmag_error
-        outobj['mag'].name = 'psfmag'
-        outobj['mag_error'].name = 'psfmag_error'
-        # put ID at the beginning
-        cols = np.char.array(list(outobj.columns))
-        newcols = ['id']+list(cols[cols!='id'])
-        outobj = outobj[newcols]
-
-    # 5) Apply aperture correction
-    #-----------------------------
-    if apcorr:
-        if verbose:
-            print('Step 5: Applying aperture correction')
-        outobj,grow,cgrow = aperture.apercorr(psf,image,outobj,psfcat,verbose=verbose)
-
-    # Add exposure time correction
-    exptime = image.header.get('exptime')
-    if exptime is not None:
-        if verbose:
-            print('Applying correction for exposure time %.2f s' % exptime)
-        outobj['psfmag'] += 2.5*np.log10(exptime)
-        
-    # Add coordinates if there's a WCS
-    if image.wcs is not None:
-        if image.wcs.has_celestial:
-            if verbose:
-                print('Adding RA/DEC coordinates to catalog')
-            skyc = image.wcs.pixel_to_world(outobj['x'],outobj['y'])
-            outobj['ra'] = skyc.ra
-            outobj['dec'] = skyc.dec     
-
-
-    ############################################
-    # Now figure out which ASTs were recovered and calculate completeness
-
-    
+    start = time.time()
+    if cutrad is None:
+        cutrad = int(np.ceil(psf.radius+(fitradius if fitradius is not None else psf.fwhm())))
+    if matchdist is None:
+        matchdist = 0.5*psf.fwhm()
+    # Real star catalog
+    rcat = Table()
+    rcat['x'] = np.array(cat['x'],float)
+    rcat['y'] = np.array(cat['y'],float)
+    rcat['amp'] = np.array(cat['psfamp'] if 'psfamp' in cat.colnames else cat['amp'],float)
+    # Make sure the error and sky are computed once and shared
+    image.error
+    image.sky
+
+    # Cutouts, sep deblends each connected region above the threshold as a
+    #  whole, a cutout that cuts through a region can merge the artificial
+    #  star with its neighbors
+    labels = None
+    if detmethod=='sep':
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            _,segmap = detection.sepdetect(image,nsigma=ndetsigma,segmentation_map=True)
+        labels,_ = ndimage.label(segmap>0,structure=np.ones((3,3),int))
+    bounds = cutoutbounds(atab['x'],atab['y'],cutrad,image.shape,labels,psf.radius+1,pad=3)
+
+    # Batches of artificial stars whose cutouts do not overlap the other stars
+    batches = astbatches(atab['x'],atab['y'],cutrad+psf.radius+1,batchsize=batchsize)
     if verbose:
+        print('{:d} artificial stars in {:d} batches'.format(len(atab),len(batches)))
+    kwargs = {'matchdist':matchdist,'detmethod':detmethod,'ndetsigma':ndetsigma,
+              'snrthresh':snrthresh,'fitradius':fitradius,'recenter':recenter}
+    rng = np.random.RandomState(seed)
+    tasks = [(atab[ind],bounds[ind],rng.randint(0,2**31-1),kwargs) for ind in batches]
+    if nproc>1:
+        import multiprocessing as mp
+        with mp.Pool(nproc,initializer=initworker,initargs=(image,psf,rcat)) as pool:
+            results = pool.map(astbatch,tasks)
+    else:
+        initworker(image,psf,rcat)
+        results = list(map(astbatch,tasks))
+
+    # Combine the results
+    asttab = Table()
+    for c in ['id','x','y','amp','mag']:
+        if c in atab.colnames:
+            asttab[c] = atab[c]
+    if 'mag' not in asttab.colnames:
+        asttab['mag'] = -2.5*np.log10(np.maximum(asttab['amp']*psf.flux(),1e-10))+25.0
+    asttab['batch'] = -1
+    cols = ['recovered','xout','yout','ampout','amp_error','magout','mag_error','chisq','nfit']
+    for c in cols:
+        asttab[c] = np.zeros(len(atab),type(results[0][0][c]) if len(results)>0 else float)
+    for b,(ind,res) in enumerate(zip(batches,results)):
+        asttab['batch'][ind] = b
+        for c in cols:
+            asttab[c][ind] = [r[c] for r in res]
+    asttab['dmag'] = asttab['magout']-asttab['mag']
+
+    # Bright artificial stars that are well separated from the real stars
+    #  should all be recovered
+    if len(rcat)>0 and len(asttab)>0:
+        dist = np.min(np.hypot(np.array(asttab['x']).reshape(-1,1)-np.array(rcat['x']).reshape(1,-1),
+                               np.array(asttab['y']).reshape(-1,1)-np.array(rcat['y']).reshape(1,-1)),axis=1)
+    else:
+        dist = np.full(len(asttab),np.inf)
+    xc = np.clip(np.round(np.array(asttab['x'])).astype(int),0,image.shape[1]-1)
+    yc = np.clip(np.round(np.array(asttab['y'])).astype(int),0,image.shape[0]-1)
+    snr = np.array(asttab['amp'])/np.array(image.error)[yc,xc]
+    isobright, = np.where((dist>2*psf.fwhm()) & (snr>50))
+    if len(isobright)>=10:
+        isocomp = np.mean(np.array(asttab['recovered'])[isobright])
+        if isocomp<0.95:
+            warnings.warn('Only {:.1f}% of the {:d} bright, isolated artificial stars were recovered'.format(
+                100*isocomp,len(isobright)))
+
+    ctab = completeness(asttab)
+    if verbose:
+        print('{:d} of {:d} artificial stars recovered'.format(np.sum(asttab['recovered']),len(asttab)))
         print('dt = %.2f sec' % (time.time()-start))
 
-    # Breakdown logger
-    if timestamp and verbose:
-        del builtins.logger
-        
-    return outobj,model,sky,psf        
+    return asttab,ctab
+
+
+def completeness(asttab,binsize=0.5,magr=None):
+    """
+    Completeness and photometric bias in bins of input magnitude.
+
+    Parameters
+    ----------
+    asttab : table
+       Artificial star results from ast().
+    binsize : float, optional
+       Magnitude bin size.  Default is 0.5.
+    magr : list, optional
+       Magnitude range.  Default is the range of the input magnitudes.
+
+    Returns
+    -------
+    ctab : table
+       Table with the magnitude bins, number of input and recovered stars,
+         completeness and its uncertainty and the median and robust scatter of
+         the recovered minus input magnitudes.
+
+    Example
+    -------
+
+    ctab = completeness(asttab,binsize=0.25)
+
+    """
+    mag = np.array(asttab['mag'])
+    recovered = np.array(asttab['recovered'],bool)
+    dmag = np.array(asttab['dmag'])
+    if magr is None:
+        magr = [np.floor(np.min(mag)/binsize)*binsize,np.ceil(np.max(mag)/binsize)*binsize]
+    edges = np.arange(magr[0],magr[1]+0.5*binsize,binsize)
+    nbins = np.maximum(len(edges)-1,1)
+    dt = np.dtype([('mag',float),('mag_lo',float),('mag_hi',float),('ninput',int),('nrecovered',int),
+                   ('completeness',float),('completeness_error',float),('dmag',float),('dmag_sigma',float)])
+    ctab = np.zeros(nbins,dtype=dt)
+    ctab['mag_lo'] = edges[:nbins]
+    ctab['mag_hi'] = edges[:nbins]+binsize
+    ctab['mag'] = ctab['mag_lo']+0.5*binsize
+    ctab['completeness'] = np.nan
+    ctab['completeness_error'] = np.nan
+    ctab['dmag'] = np.nan
+    ctab['dmag_sigma'] = np.nan
+    ibin = np.floor((mag-magr[0])/binsize).astype(int)
+    for i in range(nbins):
+        ind, = np.where(ibin==i)
+        ctab['ninput'][i] = len(ind)
+        if len(ind)==0:
+            continue
+        rec = ind[recovered[ind]]
+        ctab['nrecovered'][i] = len(rec)
+        frac = len(rec)/len(ind)
+        ctab['completeness'][i] = frac
+        ctab['completeness_error'][i] = np.sqrt(frac*(1-frac)/len(ind))
+        if len(rec)>0:
+            ctab['dmag'][i] = np.median(dmag[rec])
+            ctab['dmag_sigma'][i] = 1.4826*np.median(np.abs(dmag[rec]-ctab['dmag'][i]))
+    return Table(ctab)
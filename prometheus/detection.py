@@ -21,13 +21,10 @@ from dlnpyutils import utils as dln, bindata
 import copy
 import logging
 import time
-import matplotlib
 from .ccddata import BoundingBox,CCDData
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
 import sep
-from photutils.detection import DAOStarFinder,IRAFStarFinder
-from skimage.feature import peak_local_max
+# matplotlib, photutils.detection and skimage are imported in the functions
+#  that use them, they are slow to import
     
 # A bunch of the Gaussian2D and Moffat2D code comes from astropy's modeling module
 # https://docs.astropy.org/en/stable/_modules/astropy/modeling/functional_models.html
@@ -37,6 +34,8 @@ from skimage.feature import peak_local_max
 
 def plotobj(image,objects):
     """ Plot objects on top of image."""
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Ellipse
 
 
     # plot background-subtracted image
@@ -183,6 +182,7 @@ def daodetect(image,nsigma=1.5,fwhm=3.0):
 
     """
 
+    from photutils.detection import DAOStarFinder
     threshold = np.median(image.error)*nsigma
     daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold, sky=0.0)  
     objects = daofind(image.data-image.sky, mask=image.mask)
@@ -216,6 +216,7 @@ def irafdetect(image,nsigma=1.5,fwhm=3.0):
     objects = irafdetect(image)
 
     """
+    from photutils.detection import IRAFStarFinder
     threshold = np.median(image.error)*nsigma        
     iraffind = IRAFStarFinder(fwhm=fwhm, threshold=threshold, sky=0.0)
     objects = iraffind(image.data-image.sky, mask=image.mask)
@@ -253,6 +254,7 @@ def peaks(image,nsigma=1.5,thresh=None):
     # Comparison between image_max and im to find the coordinates of local maxima
     data = image.data-image.sky
     err = image.error
+    from skimage.feature import peak_local_max
     coordinates = peak_local_max(data, threshold_abs=thresh, min_distance=3)
     xind = coordinates[:,1]
     yind = coordinates[:,0]    
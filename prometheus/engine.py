@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+"""ENGINE.PY - Select the compute engine (python, numba or static) for each stage
+
+"""
+
+__authors__ = 'David Nidever <dnidever@montana.edu?'
+__version__ = '20261018'  # yyyymmdd
+
+
+import time
+import numpy as np
+
+# The compute engines, from slowest to fastest
+#  python   the pure-python modules (detection, getpsf, allfit, models)
+#  numba    the JIT-compiled *_numba modules
+#  static   the AOT-compiled _*_numba_static modules (see compiled.py)
+ENGINES = ['python','numba','static']
+
+# The stages of prometheus.run() and the engines that implement them.
+#  The numba and static versions of detection and getpsf are not complete,
+#  so those stages always fall back to python.
+STAGES = {'detection':['python'],
+          'psf':['python'],
+          'allfit':['python','numba','static'],
+          'model':['python','numba','static']}
+
+# Only warn once about each fallback
+_warned = set()
+
+
+def available(engine):
+    """
+    Check if a compute engine can be used in this environment.
+
+    Parameters
+    ----------
+    engine : str
+       Name of the engine: python, numba or static.
+
+    Returns
+    -------
+    flag : bool
+       True if the engine is available.
+
+    Example
+    -------
+
+    flag = available('static')
+
+    """
+    engine = str(engine).lower()
+    if engine not in ENGINES:
+        raise ValueError('Engine '+str(engine)+' not supported.  Select '+', '.join(ENGINES))
+    if engine=='python':
+        return True
+    try:
+        import numba
+    except ImportError:
+        return False
+    if engine=='static':
+        from . import compiled
+        return compiled.hasstatic('allfit')
+    return True
+
+
+def psfsupported(psf):
+    """ Check if the numba/static engines can fit/render this PSF."""
+    # Only the unbinned analytic PSFs without a lookup table
+    names = ['PSFGaussian','PSFMoffat','PSFPenny','PSFGausspow','Sersic']
+    return (type(psf).__name__ in names and psf.haslookup is False and
+            getattr(psf,'binned',False) is False)
+
+
+def select(engine,stage,psf=None,recenter=True,verbose=False):
+    """
+    Pick the engine to use for a stage, falling back to a slower engine
+    when the requested one is not available or cannot handle the inputs.
+
+    Parameters
+    ----------
+    engine : str
+       Requested engine: python, numba or static.
+    stage : str
+       The stage: detection, psf, allfit or model.
+    psf : PSF object, optional
+       The PSF model, used for the capability check.
+    recenter : boolean, optional
+       Whether the centroids are fit, only python supports recenter=False.
+    verbose : boolean, optional
+       Print a message when falling back.  Default is False.
+
+    Returns
+    -------
+    use : str
+       The engine to use for this stage.
+
+    Example
+    -------
+
+    use = select('static','allfit',psf)
+
+    """
+    from . import utils
+    print = utils.getprintfunc() # Get print function to be used locally, allows for easy logging
+    engine = str(engine).lower()
+    if engine not in ENGINES:
+        raise ValueError('Engine '+str(engine)+' not supported.  Select '+', '.join(ENGINES))
+    if stage not in STAGES:
+        raise ValueError('Stage '+str(stage)+' not supported.  Select '+', '.join(STAGES.keys()))
+    # Try the engines from the requested one down
+    for eng in ENGINES[:ENGINES.index(engine)+1][::-1]:
+        reason = None
+        if eng not in STAGES[stage]:
+            reason = 'not implemented'
+        elif available(eng) is False:
+            reason = 'not available'
+        elif eng!='python' and psf is not None and psfsupported(psf) is False:
+            reason = 'does not support '+type(psf).__name__+' with lookup/binned'
+        elif eng!='python' and recenter is False and stage=='allfit':
+            reason = 'does not support recenter=False'
+        if reason is None:
+            return eng
+        if verbose and (eng,stage,reason) not in _warned:
+            _warned.add((eng,stage,reason))
+            print(stage+': '+eng+' engine '+reason+', falling back')
+    return 'python'
+
+
+def detect(image,engine='python',verbose=False,**kwargs):
+    """ Detect sources with the selected engine, see detection.detect()."""
+    from . import detection
+    select(engine,'detection',verbose=verbose)
+    return detection.detect(image,verbose=verbose,**kwargs)
+
+
+def getpsf(psf,image,cat,engine='python',verbose=False,**kwargs):
+    """ Construct the PSF with the selected engine, see getpsf.getpsf()."""
+    from . import getpsf as gpsf
+    select(engine,'psf',psf,verbose=verbose)
+    return gpsf.getpsf(psf,image,cat,verbose=(verbose>=2),**kwargs)
+
+
+def allfit(psf,image,cat,engine='python',fitradius=None,recenter=True,nthreads=None,
+           verbose=False):
+    """
+    Fit the PSF to all stars in an image with the selected engine.
+
+    Parameters
+    ----------
+    psf : PSF object
+       PSF object to use for the fitting.
+    image : CCDData object
+       Image to use to fit PSF model to stars.
+    cat : table
+       Catalog with initial amp/x/y values for the stars.
+    engine : str, optional
+       Compute engine: python, numba or static.  Default is python.
+    fitradius : float, optional
+       The fitting radius in pixels.  By default the PSF FWHM is used.
+    recenter : boolean, optional
+       Allow the centroids to be fit.  Default is True.
+    nthreads : int, optional
+       Number of threads for the numba/static engines.  If set, the stars are
+         fit in parallel with allfit_numba.allfit_parallel() (JIT-compiled).
+         By default, the serial allfit() is used.
+    verbose : boolean, optional
+       Verbose output.
+
+    Returns
+    -------
+    out : table
+       Table of best-fitting parameters for each star.
+    model : CCDData object
+       Best-fitting model of the stars.
+    sky : CCDData object
+       Sky image.  With python this is the local sky of each star/group
+         within their footprints, with numba/static the smooth sky image.
+
+    Example
+    -------
+
+    out,model,sky = allfit(psf,image,cat,engine='numba')
+
+    """
+    use = select(engine,'allfit',psf,recenter=recenter,verbose=verbose)
+    if use=='python':
+        from . import allfit as afit
+        return afit.fit(psf,image,cat,fitradius=fitradius,recenter=recenter,
+                        verbose=(verbose>=2))
+    from . import allfit_numba as afitnb
+    return afitnb.pallfit(psf,image,cat,fitradius=fitradius,static=(use=='static'),
+                          nthreads=nthreads,verbose=(verbose>=2))
+
+
+def model(psf,cat,shape,engine='python',verbose=False):
+    """
+    Render the PSF models of the stars in a catalog into an image.
+
+    Parameters
+    ----------
+    psf : PSF object
+       PSF object to use.
+    cat : table
+       Catalog with amp, x and y columns.
+    shape : tuple
+       Image shape (ny,nx).
+    engine : str, optional
+       Compute engine: python, numba or static.  Default is python.
+    verbose : boolean, optional
+       Verbose output.
+
+    Returns
+    -------
+    im : numpy array
+       Image of the stellar models (no sky).
+
+    Example
+    -------
+
+    im = model(psf,cat,image.shape,engine='numba')
+
+    """
+    use = select(engine,'model',psf,verbose=verbose)
+    tab = np.zeros((len(cat),3),np.float64)
+    tab[:,0] = cat['amp']
+    tab[:,1] = cat['x']
+    tab[:,2] = cat['y']
+    if use=='python':
+        im = np.zeros(shape,np.float64)
+        for i in range(len(tab)):
+            bbox = psf.starbbox((tab[i,1],tab[i,2]),shape,psf.radius)
+            im[bbox.slices] += psf(pars=tab[i,:],bbox=bbox)
+        return im
+    # The static modules do not export a renderer, the kernel is tiny
+    #  so the JIT version is used for both
+    from . import allfit_numba as afitnb
+    psfparams = np.ascontiguousarray(psf.params,np.float64)
+    return afitnb.modelimage(afitnb.psftypeid(psf),psfparams,int(psf.npix),
+                             np.zeros((1,1,1),np.float64),np.array(shape),tab)
+
+
+def checkengines(engines=None,nstars=50,nx=256,ny=256,seed=1,magtol=0.03,
+                 postol=0.05,verbose=True):
+    """
+    Cross-engine consistency check.  A synthetic image is made with
+    synth.makeimage() and run through prometheus.run() with each engine.
+    The PSF magnitudes and centroids of the matched stars, and the
+    rendered model images, are compared to the python engine.
+
+    Parameters
+    ----------
+    engines : list, optional
+       Engines to compare to python.  Default is all available ones.
+    nstars : int, optional
+       Number of synthetic stars.  Default is 50.
+    nx, ny : int, optional
+       Image size.  Default is 256x256.
+    seed : int, optional
+       Random seed.  Default is 1.
+    magtol : float, optional
+       Maximum allowed median absolute PSF magnitude difference.  Default is 0.03.
+    postol : float, optional
+       Maximum allowed median absolute centroid difference in pixels.  Default is 0.05.
+    verbose : boolean, optional
+       Print the results.  Default is True.
+
+    Returns
+    -------
+    results : table
+       One row per engine with the median differences, the number of stars,
+         the run time and whether the engine passed.
+
+    Example
+    -------
+
+    res = checkengines()
+
+    """
+    from astropy.table import Table
+    from . import synth, prometheus as pm
+    if engines is None:
+        engines = [e for e in ENGINES[1:] if available(e)]
+    state = np.random.get_state()
+    np.random.seed(seed)
+    image = synth.makeimage(nstars=nstars,nx=nx,ny=ny)
+    np.random.set_state(state)
+
+    rows = []
+    t0 = time.time()
+    ref,refmodel,_,refpsf = pm.run(image.copy(),psfname='gaussian',engine='python')
+    dtref = time.time()-t0
+    rows.append(('python',len(ref),len(ref),0.0,0.0,0.0,dtref,True))
+    refim = model(refpsf,ref,image.shape,engine='python')
+    for eng in engines:
+        t0 = time.time()
+        out,_,_,psf = pm.run(image.copy(),psfname='gaussian',engine=eng)
+        dt = time.time()-t0
+        # Match the stars
+        dist = np.hypot(np.array(out['x'])[:,None]-np.array(ref['x'])[None,:],
+                        np.array(out['y'])[:,None]-np.array(ref['y'])[None,:])
+        ind2 = np.argmin(dist,axis=1)
+        ind1, = np.where(dist[np.arange(len(out)),ind2] < 1.0)
+        ind2 = ind2[ind1]
+        dmag = np.median(np.abs(out['psfmag'][ind1]-ref['psfmag'][ind2]))
+        dpos = np.median(np.hypot(out['x'][ind1]-ref['x'][ind2],out['y'][ind1]-ref['y'][ind2]))
+        # Render the python solution with this engine
+        im = model(refpsf,ref,image.shape,engine=eng)
+        dmodel = np.max(np.abs(im-refim))/np.max(refim)
+        passed = (len(ind1)>=0.9*len(ref) and dmag<=magtol and dpos<=postol and dmodel<1e-6)
+        rows.append((eng,len(out),len(ind1),dmag,dpos,dmodel,dt,passed))
+    dt = np.dtype([('engine',str,10),('nstars',int),('nmatch',int),('dmag',float),
+                   ('dpos',float),('dmodel',float),('time',float),('passed',bool)])
+    results = Table(np.array(rows,dtype=dt))
+    if verbose:
+        for r in results:
+            print('%-7s %4d stars %4d matched  dmag=%.4f  dpos=%.4f  dmodel=%.1e  %6.2f sec  %s' %
+                  (r['engine'],r['nstars'],r['nmatch'],r['dmag'],r['dpos'],r['dmodel'],r['time'],
+                   'PASSED' if r['passed'] else 'FAILED'))
+    return results
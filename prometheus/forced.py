@@ -10,14 +10,14 @@ from astropy.time import Time
 from astropy.table import Table,vstack,hstack
 from scipy import optimize
 import astropy.units as u
-from . import groupfit,allfit,models,leastsquares as lsq
+from . import groupfit,allfit,models,utils,multifit,leastsquares as lsq
 from .ccddata import CCDData
 
 # ALLFRAME-like forced photometry
 
 # also see multifit.py
 
-def getimageinfo(files):
+def getimageinfo(files,verbose=False):
     """
     Gather information about the images.
 
@@ -26,6 +26,8 @@ def getimageinfo(files):
     files : list
        List of image FITS files.  There should be associated _prometheus.fits
         that include the PSF and source catalog.
+    verbose : bool, optional
+       Verbose output to the screen.  Default is False.
 
     Returns
     -------
@@ -44,19 +46,22 @@ def getimageinfo(files):
     iminfo = []
     nfiles = len(files)
     for i in range(nfiles):
-        print('Image {:d}  {:s}'.format(i+1,files[i]))
+        if verbose:
+            print('Image {:d}  {:s}'.format(i+1,files[i]))
         if os.path.exists(files[i])==False:
-            print(files[i],' not found')
+            if verbose:
+                print(files[i],' not found')
             continue
         prfile = files[i].replace('.fits','_prometheus.fits')            
         if os.path.exists(prfile)==False:
-            print(prfile,' not found')
+            if verbose:
+                print(prfile,' not found')
             continue
         # Load header
         head1 = fits.getheader(files[i],0)
         wcs1 = WCS(head1)
         # Load source table and PSF model from prometheus output file
-        tab1 = Table.read(prfile,1)
+        tab1 = utils.loadcatalog(prfile)
         for c in tab1.colnames: tab1[c].name = c.lower()
         psf1 = models.read(prfile,4)
         dateobs = head1['DATE-OBS']
@@ -75,9 +80,147 @@ def getimageinfo(files):
 
     return iminfo
     
-def makemastertab(images,dcr=1.0,mindet=2):
+class SkyIndex(object):
+    """
+    Spatial index of sky positions that new positions can be appended to.
+    The unit vectors are kept in a short list of KD-trees of geometrically
+    decreasing size.  Appending makes a new small tree and merges it with
+    the last trees while they are of similar size, so each position is only
+    re-indexed O(log N) times and a query only searches O(log N) trees.
+
+    Example
+    -------
+
+    index = SkyIndex()
+    index.append(ra,dec)
+    dist,ind = index.query(ra2,dec2,1.0)
+
+    """
+
+    def __init__(self):
+        self.trees = []    # (KD-tree, index of its first position)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return 'SkyIndex('+str(self.size)+' positions, '+str(len(self.trees))+' trees)'
+
+    def append(self,ra,dec):
+        """ Append positions, their indices continue from the current size."""
+        from scipy.spatial import cKDTree
+        xyz = radec2xyz(ra,dec)
+        if len(xyz)==0:
+            return
+        self.trees.append((cKDTree(xyz),self.size))
+        self.size += len(xyz)
+        # Merge the last trees while they are of similar size
+        while len(self.trees)>1 and self.trees[-2][0].n <= 2*self.trees[-1][0].n:
+            tree2,start2 = self.trees.pop()
+            tree1,start1 = self.trees.pop()
+            self.trees.append((cKDTree(np.vstack((tree1.data,tree2.data))),start1))
+
+    def query(self,ra,dec,dcr,k=4):
+        """
+        Find the nearest indexed positions.
+
+        Parameters
+        ----------
+        ra : numpy array
+           Right ascension in degrees.
+        dec : numpy array
+           Declination in degrees.
+        dcr : float
+           Maximum distance in arcsec.
+        k : int, optional
+           Number of nearest positions to return.  Default is 4.
+
+        Returns
+        -------
+        dist : numpy array
+           Distances in arcsec [N,k], inf if there is no match.
+        ind : numpy array
+           Indices of the positions [N,k], -1 if there is no match.
+
+        """
+        xyz = radec2xyz(ra,dec)
+        n = len(xyz)
+        dist = np.zeros((n,0),float)
+        ind = np.zeros((n,0),int)
+        maxchord = 2*np.sin(np.deg2rad(dcr/3600.0)/2)
+        for tree,start in self.trees:
+            k1 = np.minimum(k,tree.n)
+            d1,i1 = tree.query(xyz,k=k1,distance_upper_bound=maxchord)
+            d1 = d1.reshape(n,k1)
+            i1 = i1.reshape(n,k1)
+            i1 = np.where(np.isfinite(d1),i1+start,-1)
+            dist = np.hstack((dist,d1))
+            ind = np.hstack((ind,i1))
+        # Keep the k nearest overall
+        si = np.argsort(dist,axis=1,kind='stable')[:,:k]
+        dist = np.take_along_axis(dist,si,axis=1)
+        ind = np.take_along_axis(ind,si,axis=1)
+        good = np.isfinite(dist)
+        # chord to arcsec
+        dist[good] = np.rad2deg(2*np.arcsin(np.minimum(dist[good]/2,1)))*3600
+        if dist.shape[1]<k:
+            pad = k-dist.shape[1]
+            dist = np.hstack((dist,np.zeros((n,pad))+np.inf))
+            ind = np.hstack((ind,np.zeros((n,pad),int)-1))
+        return dist,ind
+
+
+def uniquematches(dist,ind):
+    """
+    Greedy one-to-one matches, closest pairs first.
+
+    Parameters
+    ----------
+    dist : numpy array
+       Distances of the candidate matches [N,k], inf if none.
+    ind : numpy array
+       Indices of the candidate matches [N,k].
+
+    Returns
+    -------
+    ind1 : numpy array
+       Indices of the matched inputs (rows).
+    ind2 : numpy array
+       The indices they are matched to.
+
+    Example
+    -------
+
+    ind1,ind2 = uniquematches(dist,ind)
+
+    """
+    row,col = np.where(np.isfinite(dist))
+    pdist = dist[row,col]
+    pind = ind[row,col]
+    si = np.argsort(pdist,kind='stable')
+    row,pind = row[si],pind[si]
+    ind1 = np.zeros(0,int)
+    ind2 = np.zeros(0,int)
+    while len(row)>0:
+        # The closest candidate of each row and of each match
+        _,first1 = np.unique(row,return_index=True)
+        _,first2 = np.unique(pind,return_index=True)
+        ok = np.intersect1d(first1,first2)
+        ind1 = np.concatenate((ind1,row[ok]))
+        ind2 = np.concatenate((ind2,pind[ok]))
+        left = ~np.isin(row,row[ok]) & ~np.isin(pind,pind[ok])
+        row,pind = row[left],pind[left]
+    return ind1,ind2
+
+
+def makemastertab(images,dcr=1.0,mindet=2,verbose=False):
     """
     Make master star list from individual image star catalogs.
+    The catalogs are cross-matched one at a time to the objects found so
+    far, using the first detection of each object, with an appendable
+    spatial index (SkyIndex).  The mean coordinates, amplitudes and fluxes
+    are accumulated as the catalogs are added.
 
     Parameters
     ----------
@@ -89,6 +232,8 @@ def makemastertab(images,dcr=1.0,mindet=2):
     mindet : int, optional
        Minimum number of detections to be counted in master list.
         Default is 2.
+    verbose : bool, optional
+       Verbose output to the screen.  Default is False.
 
     Returns
     -------
@@ -106,63 +251,140 @@ def makemastertab(images,dcr=1.0,mindet=2):
 
     objdt = [('objid',int),('ra',float),('dec',float),('amp',float),
              ('flux',float),('nmeas',int)]
+
+    # Growable arrays of the first-detection coordinates and the sums
+    index = SkyIndex()
+    nobj = 0
+    size = 1024
+    ra0 = np.zeros(size,float)
+    dec0 = np.zeros(size,float)
+    sumdra = np.zeros(size,float)
+    sumddec = np.zeros(size,float)
+    sumamp = np.zeros(size,float)
+    sumflux = np.zeros(size,float)
+    nmeas = np.zeros(size,int)
     
     # Loop over the images
     for i in range(nimages):
         tab1 = images[i]['table']
         tab1['objid'] = -1
         tab1['ra'].unit = None   # no units
-        tab1['dec'].unit = None        
-        # First catalog
-        if i==0:
-            tab1['objid'] = np.arange(len(tab1))+1
-            meas = tab1.copy()
-            obj = Table(np.zeros(len(meas),dtype=np.dtype(objdt)))
-            for c in ['ra','dec']: obj[c] = meas[c]
-            obj['nmeas'] = 1
-        # 2nd and later catalog, need to crossmatch
-        else:
-            # Cross-match
-            ind1,ind2,dist = coords.xmatch(obj['ra'],obj['dec'],
-                                           tab1['ra'],tab1['dec'],dcr,unique=True)
-            # Some matches
-            if len(ind1)>0:
-                tab1['objid'][ind2] = obj['objid'][ind1]
-                obj['nmeas'][ind1] += 1
-            # Some left, add them to object table
-            if len(ind1) < len(tab1):
-                leftind = np.arange(len(tab1))
-                leftind = np.delete(leftind,ind2)
-                tab1['objid'][leftind] = np.arange(len(leftind))+len(obj)+1
-                meas = vstack((meas,tab1))
-                newobj = Table(np.zeros(len(leftind),dtype=np.dtype(objdt)))
-                for c in ['ra','dec']: newobj[c] = tab1[leftind][c]
-                newobj['nmeas'] = 1
-                obj = vstack((obj,newobj))
-
-    # Get mean ra, dec and flux from the measurements
-    measindex = dln.create_index(meas['objid'])
-    obj['flux'] = 0.0
-    for i in range(len(measindex['value'])):
-        objid = measindex['value'][i]
-        ind = measindex['index'][measindex['lo'][i]:measindex['hi'][i]+1]
-        nind = len(ind)
-        obj['ra'][objid-1] = np.mean(meas['ra'][ind])
-        obj['dec'][objid-1] = np.mean(meas['dec'][ind])
-        obj['amp'][objid-1] = np.mean(meas['psfamp'][ind])
-        obj['flux'][objid-1] = np.mean(meas['psfflux'][ind])
+        tab1['dec'].unit = None
+        ntab1 = len(tab1)
+        if ntab1==0:
+            continue
+        ra1 = np.array(tab1['ra'],float)
+        dec1 = np.array(tab1['dec'],float)
+        objind = np.zeros(ntab1,int)-1
+        # Cross-match to the objects so far
+        if nobj>0:
+            dist,ind = index.query(ra1,dec1,dcr)
+            ind1,ind2 = uniquematches(dist,ind)
+            objind[ind1] = ind2
+        # Add the unmatched sources as new objects
+        left, = np.where(objind<0)
+        if len(left)>0:
+            if nobj+len(left) > size:
+                newsize = np.maximum(2*size,nobj+len(left))
+                ra0,dec0,sumdra,sumddec,sumamp,sumflux,nmeas = \
+                    [np.concatenate((a,np.zeros(newsize-size,a.dtype)))
+                     for a in [ra0,dec0,sumdra,sumddec,sumamp,sumflux,nmeas]]
+                size = newsize
+            newind = np.arange(len(left))+nobj
+            ra0[newind] = ra1[left]
+            dec0[newind] = dec1[left]
+            index.append(ra1[left],dec1[left])
+            objind[left] = newind
+            nobj += len(left)
+        tab1['objid'] = objind+1
+        # Accumulate, RA offsets are wrapped so the means work across RA=0
+        nmeas += np.bincount(objind,minlength=size)
+        sumdra += np.bincount(objind,weights=(ra1-ra0[objind]+180) % 360 - 180,minlength=size)
+        sumddec += np.bincount(objind,weights=dec1-dec0[objind],minlength=size)
+        sumamp += np.bincount(objind,weights=np.array(tab1['psfamp'],float),minlength=size)
+        sumflux += np.bincount(objind,weights=np.array(tab1['psfflux'],float),minlength=size)
 
     # Impose minimum number of detections
-    if mindet is not None:
-        gdobj, = np.where(obj['nmeas'] >= mindet)
-        if len(gdobj)==0:
+    if mindet is None:
+        mindet = 1
+    gdobj, = np.where(nmeas[:nobj] >= np.maximum(mindet,1))
+    if len(gdobj)==0:
+        if verbose:
             print('No objects passed the minimum number of detections threshold of '+str(mindet))
-            return []
-        obj = obj[gdobj]
+        return []
+
+    # Mean ra, dec and flux from the measurements
+    obj = Table(np.zeros(len(gdobj),dtype=np.dtype(objdt)))
+    obj['objid'] = gdobj+1
+    obj['nmeas'] = nmeas[gdobj]
+    obj['ra'] = (ra0[gdobj]+sumdra[gdobj]/nmeas[gdobj]) % 360
+    obj['dec'] = dec0[gdobj]+sumddec[gdobj]/nmeas[gdobj]
+    obj['amp'] = sumamp[gdobj]/nmeas[gdobj]
+    obj['flux'] = sumflux[gdobj]/nmeas[gdobj]
 
     return obj
 
-def initialize_catalogs(iminfo,mastertab):
+
+def footprintmembers(ra,dec,iminfo,tree=None):
+    """
+    Find the objects that fall inside each image's footprint.  A KD-tree of the
+    object unit vectors is used to get the candidates inside a cap around each
+    image (from its center and corner coordinates), and only those candidates
+    are checked against the image WCS.
+
+    Parameters
+    ----------
+    ra : numpy array
+       Right ascension of the objects in degrees.
+    dec : numpy array
+       Declination of the objects in degrees.
+    iminfo : list
+       List of information on the image files, with wcs, nx, ny, cenra,
+         cendec, vra and vdec (see getimageinfo()).
+    tree : cKDTree, optional
+       KD-tree of the object unit vectors, if it was already made.
+
+    Returns
+    -------
+    members : list
+       List of sorted index arrays of the objects in each image.
+
+    Example
+    -------
+
+    members = footprintmembers(objtab['cenra'],objtab['cendec'],iminfo)
+
+    """
+    from scipy.spatial import cKDTree
+    ra = np.asarray(ra,float)
+    dec = np.asarray(dec,float)
+    if tree is None:
+        tree = cKDTree(radec2xyz(ra,dec))
+    members = []
+    for info in iminfo:
+        # Cap around the footprint, the corner pixel centers plus a margin
+        #  for the pixel edges
+        cenvec = radec2xyz(info['cenra'],info['cendec'])[0]
+        cornvec = radec2xyz(info['vra'],info['vdec'])
+        chord = np.max(np.linalg.norm(cornvec-cenvec,axis=1))
+        chord = chord*(1+2.0/np.minimum(info['nx'],info['ny']))+1e-6
+        cand = np.sort(np.array(tree.query_ball_point(cenvec,chord),int))
+        if len(cand)>0:
+            coo = SkyCoord(ra=ra[cand]*u.deg,dec=dec[cand]*u.deg,frame='icrs')
+            cand = cand[coo.contained_by(info['wcs'])]
+        members.append(cand)
+    return members
+
+
+def radec2xyz(ra,dec):
+    """ Convert RA/DEC in degrees to unit vectors."""
+    ra = np.deg2rad(np.atleast_1d(ra))
+    dec = np.deg2rad(np.atleast_1d(dec))
+    xyz = np.vstack((np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec))).T
+    return xyz
+
+
+def initialize_catalogs(iminfo,mastertab,verbose=False):
     """
     Initialize the object and measurement array.
 
@@ -171,7 +393,11 @@ def initialize_catalogs(iminfo,mastertab):
     iminfo : list
        List of information on the image files.
     mastertab : table
-       Master list of sources.
+       Master list of sources.  Optional pmra/pmdec columns (mas/yr, pmra
+        includes the cos(dec) factor) are used as the initial proper motions,
+        the ra/dec must then be at the reference epoch of forced().
+    verbose : bool, optional
+       Verbose output to the screen.  Default is False.
 
     Returns
     -------
@@ -206,21 +432,28 @@ def initialize_catalogs(iminfo,mastertab):
     objtab['cendec'] = objtab['dec'].copy()    
     objtab['cenpmra'] = 0.0
     objtab['cenpmdec'] = 0.0
+    # Start from the catalog proper motions, if there are any
+    if 'pmra' in objtab.colnames and 'pmdec' in objtab.colnames:
+        objtab['cenpmra'] = np.nan_to_num(np.array(objtab['pmra'],float))
+        objtab['cenpmdec'] = np.nan_to_num(np.array(objtab['pmdec'],float))
     objtab['nmeas'] = 0
     objtab['converged'] = False
+    objtab['niter'] = 0     # iteration it converged at
     objtab['chisq'] = np.nan
     
-    # Initial master list coordinates
-    coo0 = SkyCoord(ra=objtab['cenra']*u.deg,dec=objtab['cendec']*u.deg,frame='icrs')
+    # Objects in each image footprint, from the initial master list coordinates
+    members = footprintmembers(objtab['cenra'],objtab['cendec'],iminfo)
     
     # Get overlap and measurement indices for the images
     meascount = 0
     for i in range(nimages):
-        isin = coo0.contained_by(iminfo[i]['wcs'])
+        isin = members[i]
+        iminfo[i]['members'] = isin
         iminfo[i]['startmeas'] = meascount
-        iminfo[i]['nmeas'] = np.sum(isin)
+        iminfo[i]['nmeas'] = len(isin)
         meascount += iminfo[i]['nmeas']
-        print('Image {:d} - {:d} stars overlap'.format(i+1,np.sum(isin)))
+        if verbose:
+            print('Image {:d} - {:d} stars overlap'.format(i+1,len(isin)))
         
     # Initialize the measurement table
     dt = [('objid',int),('objindex',int),('imindex',int),('jd',float),
@@ -233,8 +466,7 @@ def initialize_catalogs(iminfo,mastertab):
     meastab = Table(np.zeros(nmeas,dtype=np.dtype(dt)))
     meascount = 0
     for i in range(nimages):
-        contained = coo0.contained_by(iminfo[i]['wcs'])
-        isin, = np.where(contained)
+        isin = members[i]
         nisin = len(isin)
         objtab['nmeas'][isin] += 1 
         if nisin > 0:
@@ -425,15 +657,344 @@ def solveone(psf,im,cat,method='qr',bounds=None,fitradius=None,
         perror = np.sqrt(np.diag(cov))
         newamp_error = perror[0]
     
-    #import pdb; pdb.set_trace()
-    
-    #if recenter:
-    #    import pdb; pdb.set_trace()
-    
     return newamp,newamp_error,deltax,deltay,chisq,npix
 
 
-def solve(psf,resid,meastab,fitradius=None,recenter=True,verbose=False):
+def footprintcolors(x,y,dist):
+    """
+    Greedy colouring of the footprint overlap graph.  Two sources conflict
+    if their x or y offset is less than dist, i.e. the model of one touches
+    the fitting pixels of the other.  Sources of the same colour do not
+    conflict and can be solved at the same time.  Isolated sources are
+    all colour 0.
+
+    Parameters
+    ----------
+    x : numpy array
+       X-coordinates of the sources.
+    y : numpy array
+       Y-coordinates of the sources.
+    dist : float
+       Distance in pixels below which two sources conflict.
+
+    Returns
+    -------
+    colors : numpy array
+       Colour (0 to ncolors-1) of each source.
+
+    Example
+    -------
+
+    colors = footprintcolors(x,y,30.0)
+
+    """
+    from scipy.spatial import cKDTree
+    nsources = len(x)
+    colors = np.zeros(nsources,int)
+    if nsources<2:
+        return colors
+    tree = cKDTree(np.vstack((x,y)).T)
+    pairs = tree.query_pairs(dist,p=np.inf,output_type='ndarray')
+    if len(pairs)==0:
+        return colors
+    # Neighbour lists
+    ind1 = np.concatenate((pairs[:,0],pairs[:,1]))
+    ind2 = np.concatenate((pairs[:,1],pairs[:,0]))
+    si = np.argsort(ind1,kind='stable')
+    ind1,ind2 = ind1[si],ind2[si]
+    lo = np.searchsorted(ind1,np.arange(nsources+1))
+    colors[:] = -1
+    colors[lo[:-1]==lo[1:]] = 0      # isolated
+    for i in np.where(colors<0)[0]:
+        used = colors[ind2[lo[i]:lo[i+1]]]
+        used = np.unique(used[used>=0])
+        # lowest colour not used by the neighbours
+        free, = np.where(used!=np.arange(len(used)))
+        colors[i] = free[0] if len(free)>0 else len(used)
+    return colors
+
+
+def footprintpixels(x,y,radius,shape):
+    """
+    Pixels of the square footprints of many sources.  The footprints are the
+    same as psf.starbbox() gives, padded to a common size.
+
+    Parameters
+    ----------
+    x : numpy array
+       X-coordinates of the sources.
+    y : numpy array
+       Y-coordinates of the sources.
+    radius : float
+       Footprint radius in pixels.
+    shape : tuple
+       Image shape (ny,nx).
+
+    Returns
+    -------
+    xx : numpy array
+       X-values of the footprint pixels [Nsources,Npix,Npix].
+    yy : numpy array
+       Y-values of the footprint pixels [Nsources,Npix,Npix].
+    valid : numpy array
+       Boolean mask of the pixels that are inside the footprint and the image.
+
+    Example
+    -------
+
+    xx,yy,valid = footprintpixels(x,y,3.0,image.shape)
+
+    """
+    ny,nx = shape   # python images are (Y,X)
+    npix = int(np.ceil(2*radius))+3
+    off = np.arange(npix)
+    xlo = np.floor(x-radius).astype(int)
+    ylo = np.floor(y-radius).astype(int)
+    xhi = np.minimum(np.ceil(x+radius+1).astype(int),nx)
+    yhi = np.minimum(np.ceil(y+radius+1).astype(int),ny)
+    xx = xlo.reshape(-1,1)+off
+    yy = ylo.reshape(-1,1)+off
+    xvalid = (xx>=0) & (xx<xhi.reshape(-1,1))
+    yvalid = (yy>=0) & (yy<yhi.reshape(-1,1))
+    valid = yvalid[:,:,None] & xvalid[:,None,:]
+    xx = np.broadcast_to(np.clip(xx,0,nx-1)[:,None,:],valid.shape)
+    yy = np.broadcast_to(np.clip(yy,0,ny-1)[:,:,None],valid.shape)
+    return xx,yy,valid
+
+
+def unitmodels(psf,xx,yy,xcen,ycen,deriv=False):
+    """
+    Unit-amplitude PSF models, and optionally their x/y derivatives, of many
+    sources.  For the analytic PSFs all sources are evaluated in one call
+    using the coordinates relative to their centers.
+
+    Parameters
+    ----------
+    psf : PSF object
+       The PSF model.
+    xx : numpy array
+       X-values of the pixels [Nsources,Npix,Npix].
+    yy : numpy array
+       Y-values of the pixels [Nsources,Npix,Npix].
+    xcen : numpy array
+       X-coordinates of the sources.
+    ycen : numpy array
+       Y-coordinates of the sources.
+    deriv : boolean, optional
+       Return the x/y derivatives as well.  Default is False.
+
+    Returns
+    -------
+    model : numpy array
+       Unit-amplitude models [Nsources,Npix,Npix].
+    dmdx, dmdy : numpy array
+       The x and y derivatives if deriv=True.
+
+    Example
+    -------
+
+    m,dmdx,dmdy = unitmodels(psf,xx,yy,x,y,deriv=True)
+
+    """
+    shape = xx.shape
+    # The lookup table and empirical PSFs can vary across the image
+    if psf.haslookup is False and type(psf).__name__!='PSFEmpirical':
+        xrel = (xx-xcen.reshape(-1,1,1)).ravel()
+        yrel = (yy-ycen.reshape(-1,1,1)).ravel()
+        out = psf(xrel,yrel,pars=[1.0,0.0,0.0],deriv=deriv,nderiv=3)
+        if deriv==False:
+            return out.reshape(shape)
+        return out[0].reshape(shape),out[1][1].reshape(shape),out[1][2].reshape(shape)
+    model = np.zeros(shape,float)
+    if deriv:
+        dmdx = np.zeros(shape,float)
+        dmdy = np.zeros(shape,float)
+    for i in range(shape[0]):
+        out = psf(xx[i],yy[i],pars=[1.0,xcen[i],ycen[i]],deriv=deriv,nderiv=3)
+        if deriv==False:
+            model[i] = out
+        else:
+            model[i],dmdx[i],dmdy[i] = out[0],out[1][1],out[1][2]
+    if deriv==False:
+        return model
+    return model,dmdx,dmdy
+
+
+def addmodels(psf,data,amp,x,y,scale=1.0,maxpix=4000000):
+    """
+    Add the PSF models of many sources to an image in place.  The models
+    are computed and added in chunks of nearby sources.
+
+    Parameters
+    ----------
+    psf : PSF object
+       The PSF model.
+    data : numpy array
+       The image, modified in place.
+    amp : numpy array
+       Amplitudes of the sources.
+    x : numpy array
+       X-coordinates of the sources.
+    y : numpy array
+       Y-coordinates of the sources.
+    scale : float, optional
+       Scale factor of the models, use -1 to subtract them.  Default is 1.
+    maxpix : int, optional
+       Maximum number of model pixels to compute at once.  Default is 4,000,000.
+
+    Returns
+    -------
+    data : numpy array
+       The image with the models added.
+
+    Example
+    -------
+
+    data = addmodels(psf,resid.data,amp,x,y,scale=-1)
+
+    """
+    ny,nx = data.shape
+    gd, = np.where(amp!=0)
+    if len(gd)==0:
+        return data
+    # Sort by y so each chunk only covers a strip of the image
+    gd = gd[np.argsort(y[gd],kind='stable')]
+    npix = int(np.ceil(2*psf.radius))+3
+    nchunk = np.maximum(maxpix//(npix*npix),1)
+    for lo in range(0,len(gd),nchunk):
+        ind = gd[lo:lo+nchunk]
+        xx,yy,valid = footprintpixels(x[ind],y[ind],psf.radius,data.shape)
+        model = unitmodels(psf,xx,yy,x[ind],y[ind])
+        model *= (scale*amp[ind]).reshape(-1,1,1)
+        xx,yy,model = xx[valid],yy[valid],model[valid]
+        y0,y1 = np.min(yy),np.max(yy)+1
+        im = np.bincount((yy-y0)*nx+xx,weights=model,minlength=(y1-y0)*nx)
+        data[y0:y1] += im.reshape(y1-y0,nx)
+    return data
+
+
+def solvebatch(psf,data,error,x,y,amp,fitradius,recenter=True,normal=False):
+    """
+    Solve for the flux and centroid corrections of many sources at once.
+    This is one Gauss-Newton step per source, like solveone(), but for all
+    sources together with array operations.  The sources should not overlap
+    (see footprintcolors()) and their models should already be added back
+    into the residual image.
+
+    Parameters
+    ----------
+    psf : PSF object
+       The PSF model.
+    data : numpy array
+       Residual image with the models of these sources added back in.
+    error : numpy array
+       Uncertainty image.
+    x : numpy array
+       X-coordinates of the sources.
+    y : numpy array
+       Y-coordinates of the sources.
+    amp : numpy array
+       Current amplitudes of the sources.
+    fitradius : float
+       Fitting radius in pixels.
+    recenter : boolean, optional
+       Fit the centroid corrections.  Default is True.
+    normal : boolean, optional
+       Also return the normal equations of each source for multifit.multistarfit().
+         Default is False.
+
+    Returns
+    -------
+    newamp : numpy array
+       New amplitudes.
+    newamp_error : numpy array
+       Uncertainties in newamp.
+    deltax : numpy array
+       The offsets in x.
+    deltay : numpy array
+       The offsets in y.
+    chisq : numpy array
+       Reduced chi-squared of the fits.
+    npix : numpy array
+       Number of pixels fitted.
+    hess : numpy array
+       J^T W J of the x, y and amplitude of each source [Nsources,3,3],
+         at the current positions and amplitudes.  Only if normal=True.
+    grad : numpy array
+       J^T W resid of each source [Nsources,3].  Only if normal=True.
+
+    Example
+    -------
+
+    newamp,newamp_error,dx,dy,chisq,npix = solvebatch(psf,resid.data,resid.error,x,y,amp,2.0)
+
+    """
+    ny,nx = data.shape
+    nsources = len(x)
+    xx,yy,valid = footprintpixels(x,y,fitradius,data.shape)
+    flux = np.where(valid,data[yy,xx],0.0).reshape(nsources,-1)
+    wt = np.where(valid,1.0/np.maximum(error[yy,xx],1)**2,0.0).reshape(nsources,-1)  # weights
+    npix = np.sum(valid,axis=(1,2))
+    valid = valid.reshape(nsources,-1)
+
+    # Only fit amplitude, no recenter
+    if recenter==False:
+        m = unitmodels(psf,xx,yy,x,y).reshape(nsources,-1)*valid
+        # Non-negative linear least-squares, unweighted like solveone()
+        mm = np.sum(m*m,axis=1)
+        newamp = np.sum(m*flux,axis=1)/np.maximum(mm,1e-30)
+        newamp = np.maximum(newamp,0)
+        deltax = np.zeros(nsources,float)
+        deltay = np.zeros(nsources,float)
+        jac = m.reshape(nsources,-1,1)
+    # Fit amplitude and get centroid correction terms
+    else:
+        m,dmdx,dmdy = unitmodels(psf,xx,yy,x,y,deriv=True)
+        m = m.reshape(nsources,-1)*valid
+        amp0 = np.where(amp==0,1.0,amp)
+        jac = np.stack((m,amp0.reshape(-1,1)*dmdx.reshape(nsources,-1),
+                        amp0.reshape(-1,1)*dmdy.reshape(nsources,-1)),axis=2)
+        dy = flux-amp0.reshape(-1,1)*m
+        # Solve the 3x3 normal equations of all sources
+        hess = np.einsum('npi,np,npj->nij',jac,wt,jac)
+        grad = np.einsum('npi,np->ni',jac,wt*dy)
+        # x, y and amplitude order of multifit
+        normhess = hess[:,[1,2,0]][:,:,[1,2,0]]
+        normgrad = grad[:,[1,2,0]]
+        try:
+            dbeta = np.linalg.solve(hess,grad[:,:,None])[:,:,0]
+        except np.linalg.LinAlgError:
+            dbeta = np.einsum('nij,nj->ni',np.linalg.pinv(hess),grad)
+        dbeta[~np.isfinite(dbeta)] = 0.0  # deal with NaNs
+        # Limit the steps to the maximum step sizes and boundaries, see psf.steps()
+        damp = np.clip(dbeta[:,0],-0.5*amp0,0.5*amp0)
+        deltax = np.clip(x+np.clip(dbeta[:,1],-0.5,0.5),0,nx-1)-x
+        deltay = np.clip(y+np.clip(dbeta[:,2],-0.5,0.5),0,ny-1)-y
+        newamp = np.maximum(amp0+damp,0)  # amp cannot be negative
+
+    # Chi-squared with only the new flux
+    newdy = flux-newamp.reshape(-1,1)*m
+    chisqsum = np.sum(newdy**2*wt,axis=1)
+    chisq = chisqsum/np.maximum(npix,1)
+
+    # Calculate uncertainties, see lsq.jac_covariance()
+    nfit = jac.shape[2]
+    hess = np.einsum('npi,np,npj->nij',jac,wt,jac)
+    try:
+        cov = np.linalg.inv(hess)
+    except np.linalg.LinAlgError:
+        cov = np.linalg.pinv(hess)
+    newamp_error = np.sqrt(np.abs(cov[:,0,0])*chisqsum/np.maximum(npix-nfit,1))
+
+    if normal:
+        if recenter==False:
+            normhess = np.zeros((nsources,3,3),float)
+            normgrad = np.zeros((nsources,3),float)
+        return newamp,newamp_error,deltax,deltay,chisq,npix,normhess,normgrad
+    return newamp,newamp_error,deltax,deltay,chisq,npix
+
+
+def solve(psf,resid,meastab,fitradius=None,recenter=True,batch=True,normal=False,verbose=False):
     """
     Solve for the flux and find corrections for x and y.
 
@@ -449,6 +1010,15 @@ def solve(psf,resid,meastab,fitradius=None,recenter=True,verbose=False):
        The fitting radius in pixels.  The default is 0.5*psf.fwhm().
     recenter : boolean, optional
        Allow the centroids to be fit.  Default is True.
+    batch : boolean, optional
+       Solve the sources in batches with solvebatch().  The unconverged sources
+         are split into non-overlapping sets with footprintcolors(), each set
+         is solved at once and the residual image updated once per set.
+         Default is True.  Otherwise, the sources are solved one at a time
+         with solveone().
+    normal : boolean, optional
+       Add the normal equations of the sources ("hess" and "grad" columns) to
+         the output table, see solvebatch().  Only with batch=True.  Default is False.
     verbose : bool, optional
        Verbose output to the screen.  Default is False.
 
@@ -470,6 +1040,46 @@ def solve(psf,resid,meastab,fitradius=None,recenter=True,verbose=False):
     nmeas = len(meastab)
     out = meastab.copy()
 
+    if batch:
+        if normal:
+            out['hess'] = np.zeros((nmeas,3,3),float)
+            out['grad'] = np.zeros((nmeas,3),float)
+        ind, = np.where(np.array(meastab['converged'])==False)
+        if len(ind)==0:
+            return out,resid
+        x = np.array(meastab['x'],float)[ind]
+        y = np.array(meastab['y'],float)[ind]
+        amp = np.array(meastab['amp'],float)[ind]
+        error = resid.error
+        # Sources conflict if the model of one reaches the fitting pixels
+        #  of the other
+        colors = footprintcolors(x,y,psf.radius+fitradius+1)
+        ncolors = np.max(colors)+1
+        if verbose:
+            print('Solving {:d} sources in {:d} batches'.format(len(ind),ncolors))
+        for c in range(ncolors):
+            cind, = np.where(colors==c)
+            # Add the previous best-fit models back in to the image
+            #  this will be skipped on the first iterations since all amps are zero
+            addmodels(psf,resid.data,np.maximum(amp[cind],0),x[cind],y[cind])
+            # Solve all of the sources at once
+            res = solvebatch(psf,resid.data,error,x[cind],y[cind],amp[cind],fitradius,
+                             recenter=recenter,normal=normal)
+            newamp,newamp_error,dx,dy,chisq,npix = res[:6]
+            if normal:
+                out['hess'][ind[cind]] = res[6]
+                out['grad'][ind[cind]] = res[7]
+            # Save the results
+            out['amp'][ind[cind]] = newamp
+            out['amp_error'][ind[cind]] = newamp_error
+            out['dx'][ind[cind]] = dx
+            out['dy'][ind[cind]] = dy
+            out['chisq'][ind[cind]] = chisq
+            out['npix'][ind[cind]] = npix
+            # Subtract the new models
+            addmodels(psf,resid.data,newamp,x[cind],y[cind],scale=-1)
+        return out,resid
+
     # Have a version here that fits all simultaneously
     # use groupfit
     #gf = groupfit.GroupFitter(psf,image,meastab,fitradius=fitradius,verbose=(verbose>=2)) 
@@ -503,14 +1113,126 @@ def solve(psf,resid,meastab,fitradius=None,recenter=True,verbose=False):
 
             #print(i,newamp,dx,dy)
             
-        #import pdb; pdb.set_trace()
-        
     return out,resid
 
 
+def segmentmedian(vals,seg,nseg):
+    """
+    Median of the values in each segment.
+
+    Parameters
+    ----------
+    vals : numpy array
+       Values.
+    seg : numpy array
+       Segment (0 to nseg-1) of each value.
+    nseg : int
+       Number of segments.
+
+    Returns
+    -------
+    med : numpy array
+       Median of each segment, NaN for empty segments.
+
+    Example
+    -------
+
+    med = segmentmedian(resid,seg,nobj)
+
+    """
+    counts = np.bincount(seg,minlength=nseg)
+    med = np.zeros(nseg,float)+np.nan
+    gd, = np.where(counts>0)
+    if len(gd)==0:
+        return med
+    lo = (counts[gd]-1)//2
+    hi = counts[gd]//2
+    maxcount = np.max(counts)
+    # Few values per segment, sort the rows of a padded [Nseg,Nmax] array
+    if len(gd)*maxcount <= 4*len(vals)+1000:
+        si = np.argsort(seg,kind='stable')
+        starts = np.cumsum(counts)-counts
+        col = np.arange(len(vals))-starts[seg[si]]
+        rowind = np.zeros(nseg,int)
+        rowind[gd] = np.arange(len(gd))
+        arr = np.zeros((len(gd),maxcount),float)+np.inf
+        arr[rowind[seg[si]],col] = vals[si]
+        arr.sort(axis=1)
+        rows = np.arange(len(gd))
+        med[gd] = 0.5*(arr[rows,lo]+arr[rows,hi])
+    # Sort by value and then stably by segment, faster than np.lexsort()
+    else:
+        starts = np.cumsum(counts)-counts
+        si = np.argsort(vals)
+        si = si[np.argsort(seg[si],kind='stable')]
+        svals = vals[si]
+        med[gd] = 0.5*(svals[starts[gd]+lo]+svals[starts[gd]+hi])
+    return med
+
+
+def segmentlinefit(x,y,seg,nseg,niter=5,bisquare_limit=6.0):
+    """
+    Robust linear fits, y = intercept + slope*x, of many segments at once.
+    This is iteratively reweighted least-squares with Tukey's biweight, like
+    robust.linefit(), using segment sums so all segments are fit together.
+
+    Parameters
+    ----------
+    x : numpy array
+       X-values.
+    y : numpy array
+       Y-values.
+    seg : numpy array
+       Segment (0 to nseg-1) of each point.
+    nseg : int
+       Number of segments.
+    niter : int, optional
+       Number of reweighting iterations.  Default is 5.
+    bisquare_limit : float, optional
+       Residuals larger than this many robust sigma get zero weight.
+         Default is 6.0.
+
+    Returns
+    -------
+    slope : numpy array
+       Slope of each segment.
+    intercept : numpy array
+       Intercept of each segment.
+
+    Example
+    -------
+
+    slope,intercept = segmentlinefit(jd,ra,seg,nobj)
+
+    """
+    wt = np.ones(len(x),float)
+    for i in range(niter+1):
+        sw = np.bincount(seg,weights=wt,minlength=nseg)
+        sw = np.maximum(sw,1e-300)
+        # Center on the weighted means for numerical stability
+        xm = np.bincount(seg,weights=wt*x,minlength=nseg)/sw
+        ym = np.bincount(seg,weights=wt*y,minlength=nseg)/sw
+        dx = x-xm[seg]
+        dy = y-ym[seg]
+        sxx = np.bincount(seg,weights=wt*dx*dx,minlength=nseg)
+        sxy = np.bincount(seg,weights=wt*dx*dy,minlength=nseg)
+        slope = np.where(sxx>0,sxy/np.where(sxx>0,sxx,1),0.0)
+        intercept = ym-slope*xm
+        if i==niter:
+            break
+        # Tukey biweights from the robust sigma of the residuals
+        resid = y-(intercept[seg]+slope[seg]*x)
+        sigma = 1.4826*segmentmedian(np.abs(resid),seg,nseg)
+        sigma = np.where(sigma>0,sigma,np.inf)
+        u = resid/(bisquare_limit*sigma[seg])
+        wt = np.where(np.abs(u)<1,(1-u**2)**2,0.0)
+    return slope,intercept
+
+
 def update_object(objtab,meastab,objindex,refepoch,fitpm=False,minfitpm=10,mindeltat=1000):
     """
-    Determine the mean coordinates and proper motions of objects:
+    Determine the mean coordinates and proper motions of objects.  All objects
+    are done at once with segment sums over the measurements of each object.
 
     Parameters
     ----------
@@ -521,7 +1243,8 @@ def update_object(objtab,meastab,objindex,refepoch,fitpm=False,minfitpm=10,minde
         updated ra/dec and dra/ddec from the last round of fitting
         sources in the images.
     objindex : list
-       List of measurement indices for each object.
+       List of measurement indices for each object.  Only used if
+        meastab does not have an objindex column.
     refepoch : Time object
        The reference time to use.  Should be an astropy Time object.
     fitpm : boolean, optional
@@ -546,48 +1269,221 @@ def update_object(objtab,meastab,objindex,refepoch,fitpm=False,minfitpm=10,minde
 
     """
 
-    # Loop over object and calculate coordinate and proper motion corrections
     nobj = len(objtab)
-    for i in range(nobj):
-        cosdec = np.cos(np.deg2rad(objtab['cendec'][i]))
-        measind = objindex[i]
-        meas1 = meastab[measind]
-        jd0 = np.min(meas1['jd'])
-        jd = meas1['jd']-jd0
-        ra = meas1['ra']+meas1['dra']     # both in degrees
-        dec = meas1['dec']+meas1['ddec']
-        objtab['chisq'][i] = np.mean(meas1['chisq'])
-        # Fit proper motions
-        if fitpm and len(ra)>minfitpm and (np.max(jd)-np.min(jd)>mindeltat):
-            # Perform linear fit
-            # USE ROBUST WEIGHTED LINEAR FIT
-            racoef = robust.linefit(jd,ra)
-            deccoef = robust.linefit(jd,dec)
-            # Get coordinate at the reference epoch
-            refra = np.polyval(racoef,refepoch.jd-jd0)
-            refdec = np.polyval(deccoef,refepoch.jd-jd0)
-            # Calculate new proper motion
-            pmra = racoef[0] * (3600*1e3)*365.2425      # convert slope from deg/day to mas/yr
-            pmra *= cosdec                              # multiply by cos(dec) for true angle
-            pmdec = deccoef[0] * (3600*1e3)*365.2425
-            # update object cenra, cendec, cenpmra, cenpmdec
-            objtab['cenra'][i] = refra
-            objtab['cendec'][i] = refdec
-            objtab['cenpmra'][i] = pmra
-            objtab['cenpmdec'][i] = pmdec
-        # Only fit central coordinates
-        else:
-            # USE ROBUST WEIGHTED MEAN
-            refra = np.mean(ra)
-            refdec = np.mean(dec)
-            objtab['cenra'][i] = refra
-            objtab['cendec'][i] = refdec
-
-    #import pdb; pdb.set_trace()
+    # Object (segment) of each measurement
+    if 'objindex' in meastab.colnames:
+        measind = np.arange(len(meastab))
+        seg = np.array(meastab['objindex'])
+    else:
+        measind = np.concatenate([np.atleast_1d(np.array(ind,int)) for ind in objindex])
+        seg = np.repeat(np.arange(nobj),[len(ind) for ind in objindex])
+    nmeas = np.bincount(seg,minlength=nobj)
+    gdobj, = np.where(nmeas>0)
+    if len(gdobj)==0:
+        return objtab
+    # Sort the measurements by object once
+    si = np.argsort(seg,kind='stable')
+    measind,seg = measind[si],seg[si]
+    starts = np.cumsum(nmeas[gdobj])-nmeas[gdobj]
+    
+    jd = np.array(meastab['jd'])[measind]
+    ra = np.array(meastab['ra'])[measind]+np.array(meastab['dra'])[measind]     # both in degrees
+    dec = np.array(meastab['dec'])[measind]+np.array(meastab['ddec'])[measind]
+    chisq = np.array(meastab['chisq'])[measind]
+    jd0 = np.zeros(nobj,float)
+    jd0[gdobj] = np.minimum.reduceat(jd,starts)
+    jdmax = np.zeros(nobj,float)
+    jdmax[gdobj] = np.maximum.reduceat(jd,starts)
+    jd -= jd0[seg]
+    cosdec = np.cos(np.deg2rad(np.array(objtab['cendec'])))
+    
+    objtab['chisq'][gdobj] = np.add.reduceat(chisq,starts)/nmeas[gdobj]
+    
+    # Fit proper motions
+    if fitpm:
+        dopm = (nmeas>minfitpm) & (jdmax-jd0>mindeltat)
+    else:
+        dopm = np.zeros(nobj,bool)
+    pmobj, = np.where(dopm)
+    if len(pmobj)>0:
+        # USE ROBUST WEIGHTED LINEAR FIT
+        sel = dopm[seg]
+        racoef = segmentlinefit(jd[sel],ra[sel],seg[sel],nobj)
+        deccoef = segmentlinefit(jd[sel],dec[sel],seg[sel],nobj)
+        # Get coordinate at the reference epoch
+        refra = racoef[1]+racoef[0]*(refepoch.jd-jd0)
+        refdec = deccoef[1]+deccoef[0]*(refepoch.jd-jd0)
+        # Calculate new proper motion
+        pmra = racoef[0] * (3600*1e3)*365.2425      # convert slope from deg/day to mas/yr
+        pmra *= cosdec                              # multiply by cos(dec) for true angle
+        pmdec = deccoef[0] * (3600*1e3)*365.2425
+        # update object cenra, cendec, cenpmra, cenpmdec
+        objtab['cenra'][pmobj] = refra[pmobj]
+        objtab['cendec'][pmobj] = refdec[pmobj]
+        objtab['cenpmra'][pmobj] = pmra[pmobj]
+        objtab['cenpmdec'][pmobj] = pmdec[pmobj]
+        
+    # Only fit central coordinates, the measurements are moved to the
+    #  reference epoch with the current proper motions
+    cenobj, = np.where((dopm==False) & (nmeas>0))
+    if len(cenobj)>0:
+        dyr = (jd+jd0[seg]-refepoch.jd)/365.2425
+        ra -= np.array(objtab['cenpmra'],float)[seg]/cosdec[seg]*dyr/(3600*1e3)
+        dec -= np.array(objtab['cenpmdec'],float)[seg]*dyr/(3600*1e3)
+        refra = np.zeros(nobj,float)
+        refdec = np.zeros(nobj,float)
+        refra[gdobj] = np.add.reduceat(ra,starts)/nmeas[gdobj]
+        refdec[gdobj] = np.add.reduceat(dec,starts)/nmeas[gdobj]
+        objtab['cenra'][cenobj] = refra[cenobj]
+        objtab['cendec'][cenobj] = refdec[cenobj]
             
     return objtab
 
 
+def update_object_joint(objtab,meastab,objindex,refepoch,hess,grad,trans,fitpm=False,
+                        minfitpm=10,mindeltat=1000,maxstep=1.0):
+    """
+    Determine the coordinates and proper motions of objects with a joint
+    multi-epoch solve of all their measurements, see multifit.multistarfit().
+    This takes one Gauss-Newton step of the reference position, proper motion
+    and amplitudes of each object using the normal equations from the solve
+    of the images, instead of averaging the positions of the individual
+    measurements.  Objects without normal equations are updated with
+    update_object().
+
+    Parameters
+    ----------
+    objtab : table
+       Catalog of unique objects.
+    meastab : table
+       Catalog of individual measurements.
+    objindex : list
+       List of measurement indices for each object.
+    refepoch : Time object
+       The reference time to use.  Should be an astropy Time object.
+    hess : numpy array
+       J^T W J of the x, y and amplitude of each measurement [Nmeas,3,3],
+         all zero for measurements that were not solved.
+    grad : numpy array
+       J^T W resid of each measurement [Nmeas,3].
+    trans : numpy array
+       Pixel to sky transformation of each measurement in arcsec/pixel
+         [Nmeas,2,2], see pixeltrans().
+    fitpm : boolean, optional
+       Fit proper motions as well as central positions.
+         Default is False.
+    minfitpm : int, optional
+       Minimum number of measurements needed to fit proper motion.
+         Default is 10.
+    mindeltat : float, optional
+       Minimum time baseline of measurements needed to fit proper motion.
+         Default is 1000 days.
+    maxstep : float, optional
+       Maximum shift of any measurement of an object in one step in pixels.
+         Default is 1.0.
+
+    Returns
+    -------
+    objtab : table
+       Catalog of unique objects with cenra/cendec and pmra/pmdec updated.
+
+    Example
+    -------
+
+    objtab = update_object_joint(objtab,meastab,objindex,refepoch,hess,grad,trans)
+
+    """
+
+    nobj = len(objtab)
+    cenra = np.array(objtab['cenra'])
+    cendec = np.array(objtab['cendec'])
+    cenpmra = np.array(objtab['cenpmra'])
+    cenpmdec = np.array(objtab['cenpmdec'])
+    # Chi-squared and objects without any normal equations
+    objtab = update_object(objtab,meastab,objindex,refepoch,fitpm=fitpm,minfitpm=minfitpm,
+                           mindeltat=mindeltat)
+    
+    seg = np.array(meastab['objindex'])
+    jd = np.array(meastab['jd'])
+    mind, = np.where(hess[:,0,0]+hess[:,1,1] > 0)
+    if len(mind)==0:
+        return objtab
+    # Same proper motion criteria as update_object()
+    nmeas = np.bincount(seg,minlength=nobj)
+    jd0 = np.full(nobj,np.inf)
+    jdmax = np.full(nobj,-np.inf)
+    np.minimum.at(jd0,seg,jd)
+    np.maximum.at(jdmax,seg,jd)
+    if fitpm:
+        dopm = (nmeas>minfitpm) & (jdmax-jd0>mindeltat)
+    else:
+        dopm = np.zeros(nobj,bool)
+    
+    # Solve, corrections of the reference position in arcsec and the
+    #  proper motion in arcsec/year
+    deltat = (jd[mind]-refepoch.jd)/365.2425
+    pars,perror,_,_ = multifit.multistarfit(hess[mind],grad[mind],trans[mind],deltat,seg[mind],
+                                            nobj,fitpm=dopm)
+
+    # Scale down the steps that move a measurement by more than maxstep pixels
+    pixscale = np.sqrt(np.abs(np.linalg.det(trans[mind])))
+    shift = np.hypot(pars[seg[mind],0]+pars[seg[mind],2]*deltat,
+                     pars[seg[mind],1]+pars[seg[mind],3]*deltat)/pixscale
+    maxshift = np.zeros(nobj,float)
+    np.maximum.at(maxshift,seg[mind],shift)
+    pars *= np.minimum(maxstep/np.maximum(maxshift,1e-10),1.0).reshape(-1,1)
+    
+    # Update the objects with joint solutions
+    jobj = np.unique(seg[mind])
+    cosdec = np.cos(np.deg2rad(cendec[jobj]))
+    objtab['cenra'][jobj] = cenra[jobj] + pars[jobj,0]/3600/cosdec
+    objtab['cendec'][jobj] = cendec[jobj] + pars[jobj,1]/3600
+    pmobj = jobj[dopm[jobj]]
+    objtab['cenpmra'][pmobj] = cenpmra[pmobj] + pars[pmobj,2]*1e3   # mas/yr
+    objtab['cenpmdec'][pmobj] = cenpmdec[pmobj] + pars[pmobj,3]*1e3
+    
+    return objtab
+
+
+def pixeltrans(wcs,x,y):
+    """
+    Local transformation of pixel offsets into offsets on the sky in arcsec
+    (RA*cos(Dec), Dec), like the WCS CD matrix, at many positions.
+
+    Parameters
+    ----------
+    wcs : WCS object
+       The image WCS.
+    x : numpy array
+       X-coordinates.
+    y : numpy array
+       Y-coordinates.
+
+    Returns
+    -------
+    trans : numpy array
+       The transformation matrices [N,2,2] in arcsec/pixel.
+
+    Example
+    -------
+
+    trans = pixeltrans(wcs,x,y)
+
+    """
+    n = len(x)
+    trans = np.zeros((n,2,2),float)
+    if n==0:
+        return trans
+    ra,dec = wcs.pixel_to_world_values(np.concatenate((x+0.5,x-0.5,x,x)),
+                                       np.concatenate((y,y,y+0.5,y-0.5)))
+    ra,dec = ra.reshape(4,n),dec.reshape(4,n)
+    cosdec = np.cos(np.deg2rad(dec.mean(axis=0)))
+    dra = (ra[[0,2]]-ra[[1,3]]+180) % 360 - 180    # wrap
+    trans[:,0,:] = (dra*cosdec*3600).T
+    trans[:,1,:] = ((dec[[0,2]]-dec[[1,3]])*3600).T
+    return trans
+
+
 def make_magnitudes(meastab,iminfo,zeropoint=25.0):
     """
     Create measurement magnitudes corrected for exposure time.
@@ -849,12 +1745,471 @@ def check_convergence(objtab,meastab,objindex,last_obj,niter,fitpm=True):
     #    dy = meas1['dy']
     #
     #    # Check differences in chisq values
-            
-    #import pdb; pdb.set_trace()
 
     return objtab,meastab
 
-def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True):
+def residfiles(residfile):
+    """ Names of the .npy files of a residual image (data, error, mask and sky)."""
+    base = residfile[:-4] if residfile.endswith('.npy') else residfile
+    return {'data':base+'.npy', 'error':base+'_error.npy', 'mask':base+'_mask.npy',
+            'sky':base+'_sky.npy'}
+
+
+def saveresid(residfile,resid,static=True,sky=True):
+    """
+    Save a residual image to .npy files that can be memory-mapped.
+
+    Parameters
+    ----------
+    residfile : str
+       Name of the residual .npy file.  The error, mask and sky are saved
+         in files with _error, _mask and _sky added to the name.
+    resid : CCDData object
+       The residual image.  If the data are memory-mapped from residfile
+         (see loadresid()), only the changed pages are written out.
+    static : boolean, optional
+       Write the error and mask arrays.  They do not change during the
+         iterations, so only need to be written once.  Default is True.
+    sky : boolean, optional
+       Write the sky array.  Default is True.
+
+    Returns
+    -------
+    The residual image is written to the files.
+
+    Example
+    -------
+
+    saveresid(residfile,resid,static=False,sky=False)
+
+    """
+    names = residfiles(residfile)
+    data = resid.data
+    if isinstance(data,np.memmap) and data.filename is not None and \
+       os.path.abspath(data.filename)==os.path.abspath(names['data']):
+        data.flush()
+    else:
+        np.save(names['data'],np.asarray(data))
+    if static:
+        np.save(names['error'],np.asarray(resid.error))
+        if resid.mask is not None:
+            np.save(names['mask'],np.asarray(resid.mask))
+        elif os.path.exists(names['mask']):
+            os.remove(names['mask'])
+    if sky:
+        np.save(names['sky'],np.asarray(resid.sky))
+
+
+def loadresid(residfile):
+    """
+    Load a residual image saved with saveresid().  The data are memory-mapped
+    read/write so the model updates of solve() only touch the pages of the
+    changed pixels, and the error, mask and sky are memory-mapped read-only.
+
+    Parameters
+    ----------
+    residfile : str
+       Name of the residual .npy file.
+
+    Returns
+    -------
+    resid : CCDData object
+       The residual image.
+
+    Example
+    -------
+
+    resid = loadresid(residfile)
+
+    """
+    names = residfiles(residfile)
+    data = np.load(names['data'],mmap_mode='r+')
+    error = np.load(names['error'],mmap_mode='r')
+    mask = None
+    if os.path.exists(names['mask']):
+        mask = np.load(names['mask'],mmap_mode='c')   # copy-on-write
+    sky = np.load(names['sky'],mmap_mode='r')
+    resid = CCDData(data,error=error,mask=mask,sky=sky)
+    resid.skysubtracted = True
+    return resid
+
+
+def stampchisq(resid,x,y,radius):
+    """
+    Chi-squared sum of the residual image in the union of the stamps of
+    some stars.
+
+    Parameters
+    ----------
+    resid : CCDData object
+       Residual image.
+    x : numpy array
+       X-coordinates of the stars.
+    y : numpy array
+       Y-coordinates of the stars.
+    radius : float
+       Stamp radius in pixels.
+
+    Returns
+    -------
+    chisq : float
+       Sum of resid**2/error**2 over the unique stamp pixels.
+
+    Example
+    -------
+
+    chisq = stampchisq(resid,x,y,psf.radius)
+
+    """
+    if len(x)==0:
+        return 0.0
+    ny,nx = resid.shape
+    xx,yy,valid = footprintpixels(x,y,radius,resid.shape)
+    index = np.unique(yy[valid]*nx+xx[valid])
+    yind,xind = index//nx,index % nx
+    return np.sum(resid.data[yind,xind]**2/resid.error[yind,xind]**2)
+
+
+def solveimage(args):
+    """
+    Solve one image in a forced photometry iteration.  This only needs the
+    image's own residual image and the current object positions and proper
+    motions, so the images can be solved in parallel (see forced()).
+
+    Parameters
+    ----------
+    args : tuple
+       Tuple of (info, objtab, meastab, count, refepoch, recenter, imchisq, joint).
+         info is a dictionary with the image file, residfile, wcs, psf and jd.
+         objtab and meastab are the active (unconverged) objects and measurements
+         of this image, count is the iteration number (starting at 0), refepoch
+         the reference epoch, recenter whether to fit the centroids and imchisq
+         the image chi-squared of the last iteration.  When only a few stars are
+         active, the image chi-squared is updated from their stamps only.
+         joint adds the normal equations ("hess", "grad") and the pixel to
+         sky transformation ("trans") of the measurements to the output for
+         update_object_joint().
+
+    Returns
+    -------
+    result : dict
+       Dictionary with the solution of the measurements ("out", a dictionary of
+         amp, amp_error, ra, dec, x, y, dx, dy, dra, ddec and chisq arrays) and the
+         image chi-squared before ("imchisq0") and after ("imchisq"), the
+         mean ("srcchisq") and median ("medschisq") source chi-squared, and
+         whether the sky was recomputed ("newsky").
+
+    Example
+    -------
+
+    result = solveimage((info,objtab1,meastab1,count,refepoch,True,imchisq,False))
+
+    """
+    info,objtab1,meastab1,count,refepoch,recenter,lastimchisq,joint = args
+    normal = (joint and recenter)
+    wcs = info['wcs']
+    psf = info['psf']
+    residfile = info['residfile']
+    imtime = Time(info['jd'],format='jd')
+    meastab1 = meastab1.copy()
+    meastab1['converged'] = objtab1['converged']
+
+    # Check that meastab1 and objtab1 are ordered correctly
+    if np.sum(meastab1['objid'] != objtab1['objid']) > 0:
+        raise Exception('Image object and measurement tables are out of order')
+            
+    # Calculate x/y position for each object in this image
+    # using the current best overall on-sky position
+    # and proper motion
+    # Need to convert celestial values to x/y position in
+    # the image using the WCS.            
+    measra,measdec,measx,measy = compute_image_coordinates(objtab1,wcs,imtime,refepoch)
+    # The current models are subtracted at the positions of the last iteration
+    xlast,ylast = np.array(meastab1['x']),np.array(meastab1['y'])
+    meastab1['ra'] = measra
+    meastab1['dec'] = measdec
+    meastab1['x'] = measx
+    meastab1['y'] = measy
+            
+    # Initialize or load the residual image
+    if count==0:
+        resid = CCDData.read(info['file'])
+        resid.skysubtracted = False
+    else:
+        resid = loadresid(residfile)
+                
+    # Subtract sky
+    if count % 5 == 0:
+        if count==0:
+            resid.data -= resid.sky   # subtract the sky
+            resid.skysubtracted = True
+        else:
+            # Add "current" sky image back in
+            resid.data += resid.sky
+            # Force the sky to be recomputed
+            if hasattr(resid,'_sky'):
+                resid._sky = None
+            resid.data -= resid.sky  # subtract new sky
+            resid.skysubtracted = True                    
+
+    # Fit the fluxes while holding the positions fixed
+    #  only fit measurements that have not converged yet
+    #  the image chi-squared only changes in the stamps of the active stars
+    #  the models are moved to the new positions first, otherwise solve()
+    #  would add them back in at a different position than they were subtracted
+    x,y = np.array(meastab1['x']),np.array(meastab1['y'])
+    amp = np.maximum(np.array(meastab1['amp']),0)
+    npix = (2*psf.radius+3)**2
+    if count % 5 == 0 or len(meastab1)*npix > resid.size:
+        imchisq0 = np.sum(resid.data**2/resid.error**2)/resid.size
+        addmodels(psf,resid.data,amp,xlast,ylast)
+        addmodels(psf,resid.data,amp,x,y,scale=-1)
+        out,resid = solve(psf,resid,meastab1,recenter=recenter,normal=normal)
+        imchisq = np.sum(resid.data**2/resid.error**2)/resid.size
+    else:
+        stampchisq0 = stampchisq(resid,np.concatenate((x,xlast)),np.concatenate((y,ylast)),psf.radius)
+        addmodels(psf,resid.data,amp,xlast,ylast)
+        addmodels(psf,resid.data,amp,x,y,scale=-1)
+        out,resid = solve(psf,resid,meastab1,recenter=recenter,normal=normal)
+        imchisq0 = lastimchisq
+        stampchisq1 = stampchisq(resid,np.concatenate((x,xlast)),np.concatenate((y,ylast)),psf.radius)
+        imchisq = lastimchisq+(stampchisq1-stampchisq0)/resid.size
+    srcchisq = np.sum(out['chisq']*out['npix'])/np.sum(out['npix'])
+    medschisq = np.median(out['chisq'])
+            
+    # Convert dx/dy to dra/ddec
+    #  these will be used later to compute proper motions
+    coo2 = wcs.pixel_to_world(meastab1['x']+out['dx'],meastab1['y']+out['dy'])
+    dra = coo2.ra.deg - meastab1['ra']
+    ddec = coo2.dec.deg - meastab1['dec']
+    out['dra'] = dra    # in degrees of RA (not true angle)
+    out['ddec'] = ddec  # in degrees
+            
+    # Save the residual file, the error and mask only change on the
+    #  first iteration and the sky when it is recomputed
+    saveresid(residfile,resid,static=(count==0),sky=(count % 5 == 0))
+
+    # allframe operates on the residual map, with the best-fit model subtracted
+            
+    # allframe derives flux and centroid corrections for each object
+    # the flux corrections are applied immediately while the centroid
+    # corrections are saved.
+
+    # there are no groups in allframe
+    # the least-squares design matrix is completely diagonalized: the
+    # incremental brightness and position corrections are derived for
+    # each star separately!  this may add a few more iterations for the
+    # badly blended stars, but it does *not* affect the accuracy of the
+    # final results.
+
+    # Once a star has converged, it's best-fit model is subtracted from
+    # the residual map and its parameters are fixed.
+            
+    # when no further infinitesimal change to a star's parameters
+    # produces any reduction in the robust estimate of the mean-square
+    # brightness residual inside that star's fitting region, the
+    # maximum-likelihood solution has been achieved.
+
+    # Only send back the columns that are needed
+    outcols = ['amp','amp_error','ra','dec','x','y','dx','dy','dra','ddec','chisq']
+    if normal:
+        outcols += ['hess','grad']
+    result = {'out':{c:np.array(out[c]) for c in outcols},'imchisq0':imchisq0,
+              'imchisq':imchisq,'srcchisq':srcchisq,'medschisq':medschisq,
+              'newsky':(count % 5 == 0)}
+    if normal:
+        result['out']['trans'] = pixeltrans(wcs,np.array(meastab1['x']),np.array(meastab1['y']))
+    return result
+
+
+def linearsolve(psf,data,error,x,y,mask=None,skyorder=1,tilesize=1024):
+    """
+    Solve for the amplitudes of many sources at fixed positions with one
+    sparse linear least-squares solve.  The design matrix has the PSF
+    stamps of the sources and low-order polynomial sky terms.  Large
+    images are solved in tiles, each one padded so that the sources near
+    the tile edges are fit together with their neighbors.
+
+    Parameters
+    ----------
+    psf : PSF object
+       The PSF model.
+    data : numpy array
+       The sky-subtracted image.
+    error : numpy array
+       Uncertainty image.
+    x : numpy array
+       X-coordinates of the sources.
+    y : numpy array
+       Y-coordinates of the sources.
+    mask : numpy array, optional
+       Boolean mask of bad pixels.  Default is no mask.
+    skyorder : int, optional
+       Order of the polynomial sky terms in each tile, -1 for no sky terms.
+         Default is 1 (constant plus linear terms).
+    tilesize : int, optional
+       Size of the tiles in pixels.  Default is 1024.
+
+    Returns
+    -------
+    amp : numpy array
+       Amplitudes of the sources.
+    amp_error : numpy array
+       Uncertainties in amp.
+    resid : numpy array
+       Residual image with the best-fit models and sky terms subtracted.
+
+    Example
+    -------
+
+    amp,amp_error,resid = linearsolve(psf,image.data,image.error,x,y,mask=image.mask)
+
+    """
+    from scipy import sparse
+    from scipy.sparse import linalg as slinalg
+    ny,nx = data.shape
+    nsources = len(x)
+    amp = np.zeros(nsources,float)
+    amp_error = np.zeros(nsources,float)
+    resid = np.array(data,float)
+    # Same weights as solvebatch()
+    wt = 1.0/np.maximum(error,1)**2
+    if mask is not None:
+        wt[np.asarray(mask,bool)] = 0.0
+    wt[~np.isfinite(data)] = 0.0
+    resid[~np.isfinite(data)] = 0.0
+    # Sky polynomial terms, x**i * y**j with i+j<=skyorder
+    skyterms = [(i,j) for i in range(skyorder+1) for j in range(skyorder+1-i)]
+    nsky = len(skyterms)
+    rad = int(np.ceil(psf.radius))
+    xcen = np.floor(x+0.5)
+    ycen = np.floor(y+0.5)
+    for ty0 in range(0,ny,tilesize):
+        for tx0 in range(0,nx,tilesize):
+            ty1,tx1 = np.minimum(ty0+tilesize,ny),np.minimum(tx0+tilesize,nx)
+            # Sources of this tile, only their results are kept
+            core, = np.where((xcen>=tx0) & (xcen<tx1) & (ycen>=ty0) & (ycen<ty1))
+            if len(core)==0:
+                continue
+            # Fitted pixels, the tile padded by the PSF radius
+            px0,px1 = np.maximum(tx0-rad,0),np.minimum(tx1+rad,nx)
+            py0,py1 = np.maximum(ty0-rad,0),np.minimum(ty1+rad,ny)
+            wx,wy = px1-px0,py1-py0
+            # All the sources whose models reach the fitted pixels
+            ind, = np.where((xcen>=px0-rad) & (xcen<px1+rad) & (ycen>=py0-rad) & (ycen<py1+rad))
+            nind = len(ind)
+            xx,yy,valid = footprintpixels(x[ind],y[ind],psf.radius,data.shape)
+            model = unitmodels(psf,xx,yy,x[ind],y[ind])
+            valid &= (xx>=px0) & (xx<px1) & (yy>=py0) & (yy<py1)
+            rows = ((yy-py0)*wx+(xx-px0))[valid]
+            cols = np.broadcast_to(np.arange(nind).reshape(-1,1,1),valid.shape)[valid]
+            vals = model[valid]
+            # Sky terms, coordinates scaled to [-1,1] over the fitted pixels
+            if nsky>0:
+                ypix,xpix = np.mgrid[py0:py1,px0:px1]
+                xs = (2.0*(xpix.ravel()-px0)/np.maximum(wx-1,1)-1.0)
+                ys = (2.0*(ypix.ravel()-py0)/np.maximum(wy-1,1)-1.0)
+                skyrows = np.arange(wx*wy)
+                rows = np.concatenate([rows]+nsky*[skyrows])
+                cols = np.concatenate([cols]+[np.full(wx*wy,nind+k) for k in range(nsky)])
+                vals = np.concatenate([vals]+[xs**i*ys**j for i,j in skyterms])
+            sqwt = np.sqrt(wt[py0:py1,px0:px1]).ravel()
+            amat = sparse.csr_matrix((vals*sqwt[rows],(rows,cols)),shape=(wx*wy,nind+nsky))
+            bvec = sqwt*resid[py0:py1,px0:px1].ravel()
+            # Normal equations, drop columns without any weighted pixels
+            ata = (amat.T @ amat).tocsc()
+            atb = amat.T @ bvec
+            diag = ata.diagonal()
+            good, = np.where(diag>0)
+            ata = ata[good][:,good]
+            lu = slinalg.splu(ata+sparse.diags(1e-12*diag[good]).tocsc())
+            sol = np.zeros(nind+nsky,float)
+            sol[good] = lu.solve(atb[good])
+            # Diagonal of the covariance matrix for the core sources
+            covdiag = np.zeros(nind+nsky,float)
+            keep, = np.where(good<nind)
+            keep = keep[np.isin(ind[good[keep]],core)]
+            for lo in range(0,len(keep),256):
+                kk = keep[lo:lo+256]
+                rhs = np.zeros((len(good),len(kk)),float)
+                rhs[kk,np.arange(len(kk))] = 1.0
+                covdiag[good[kk]] = lu.solve(rhs)[kk,np.arange(len(kk))]
+            isin = np.isin(ind,core)
+            amp[ind[isin]] = sol[:nind][isin]
+            amp_error[ind[isin]] = np.sqrt(np.abs(covdiag[:nind][isin]))
+            # Subtract the sky terms of this tile from its own pixels
+            if nsky>0:
+                ypix,xpix = np.mgrid[ty0:ty1,tx0:tx1]
+                xs = 2.0*(xpix-px0)/np.maximum(wx-1,1)-1.0
+                ys = 2.0*(ypix-py0)/np.maximum(wy-1,1)-1.0
+                for k,(i,j) in enumerate(skyterms):
+                    resid[ty0:ty1,tx0:tx1] -= sol[nind+k]*xs**i*ys**j
+    # Subtract the models of all the sources
+    addmodels(psf,resid,amp,x,y,scale=-1)
+    return amp,amp_error,resid
+
+
+def linearimage(args):
+    """
+    Forced photometry of one image at fixed positions with linearsolve().
+
+    Parameters
+    ----------
+    args : tuple
+       Tuple of (info, objtab, meastab, refepoch, skyorder, tilesize, fitradius).
+         info is a dictionary with the image file, residfile, wcs, psf and jd.
+         objtab and meastab are the objects and measurements of this image.
+
+    Returns
+    -------
+    result : dict
+       Dictionary with "out", the solved columns of the measurements, the
+         image chi-squared ("imchisq") and the source chi-squared ("srcchisq").
+
+    Example
+    -------
+
+    result = linearimage((info,objtab1,meastab1,refepoch,1,1024,None))
+
+    """
+    info,objtab1,meastab1,refepoch,skyorder,tilesize,fitradius = args
+    wcs = info['wcs']
+    psf = info['psf']
+    imtime = Time(info['jd'],format='jd')
+    if fitradius is None:
+        fitradius = 0.5*psf.fwhm()
+
+    # Positions of the objects at the epoch of this image
+    measra,measdec,measx,measy = compute_image_coordinates(objtab1,wcs,imtime,refepoch)
+    measx,measy = np.array(measx,float),np.array(measy,float)
+
+    # Load the image and subtract the sky, the error is estimated
+    #  from the image with the sky in it
+    resid = CCDData.read(info['file'])
+    error = resid.error
+    resid.data -= resid.sky
+    resid.skysubtracted = True
+    amp,amp_error,resid.data = linearsolve(psf,resid.data,resid.error,measx,measy,mask=resid.mask,
+                                           skyorder=skyorder,tilesize=tilesize)
+
+    # Chi-squared in the fitting radius of each source, like solvebatch()
+    xx,yy,valid = footprintpixels(measx,measy,fitradius,resid.shape)
+    wt = np.where(valid,1.0/np.maximum(resid.error[yy,xx],1)**2,0.0)
+    npix = np.sum(valid,axis=(1,2))
+    chisq = np.sum(np.where(valid,resid.data[yy,xx],0.0)**2*wt,axis=(1,2))/np.maximum(npix,1)
+    imchisq = np.sum(resid.data**2/resid.error**2)/resid.size
+    srcchisq = np.sum(chisq*npix)/np.maximum(np.sum(npix),1)
+
+    # Save the residual image
+    saveresid(info['residfile'],resid)
+
+    out = {'amp':amp,'amp_error':amp_error,'ra':measra,'dec':measdec,'x':measx,'y':measy,
+           'chisq':chisq,'npix':npix}
+    return {'out':out,'imchisq':imchisq,'srcchisq':srcchisq}
+
+
+def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,nproc=1,mode='iterative',
+           joint=False,skyorder=1,tilesize=1024,verbose=True):
     """
     ALLFRAME-like forced photometry.
 
@@ -863,17 +2218,40 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
     files : list
        List of image filenames.
     mastertab : table
-       Master table of objects.
+       Master table of objects.  If it has pmra/pmdec columns (mas/yr, pmra
+         includes the cos(dec) factor) those are the initial proper motions
+         (and the fixed ones for mode="linear" or fitpm=False).
     fitpm : boolean, optional
        Fit proper motions as well as central positions.
          Default is True.
     refepoch : Time object, optional
        The reference time to use.  Should be an astropy Time object.
-         By default, the mean JD of all images is used.
+         By default, the mean JD of all images is used.  If mastertab has
+         proper motions, refepoch must be given and be the epoch of the
+         mastertab coordinates (e.g. J2016.0 for Gaia DR3).
     maxiter : int, optional
        Maximum iterations.  Default is 50.
+    nproc : int, optional
+       Number of processes to solve the images with in each iteration.
+         Default is 1.
+    mode : str, optional
+       "iterative" fits the fluxes, positions and proper motions with ALLFRAME-like
+         iterations.  "linear" holds the positions fixed at the mastertab
+         coordinates (moved to each image epoch with the mastertab proper
+         motions, if any) and solves all the amplitudes of each image in one sparse
+         linear least-squares solve, see linearsolve().  Default is "iterative".
+    joint : boolean, optional
+       Update the object positions and proper motions in the iterations with a
+         joint multi-epoch solve of the normal equations of all their measurements,
+         see update_object_joint().  Otherwise the positions of the individual
+         measurements are averaged with update_object().  Default is False.
+    skyorder : int, optional
+       Order of the polynomial sky terms of each tile for mode="linear".
+         Default is 1.
+    tilesize : int, optional
+       Tile size in pixels for mode="linear".  Default is 1024.
     verbose : bool, optional
-       Verbose output to the screen.  Default is False.
+       Verbose output to the screen.  Default is True.
 
     Returns
     -------
@@ -906,8 +2284,11 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
     # an open HDUList() and it will refresh the mmap and free up the
     # virtual memory.
     
+    if mode not in ['iterative','linear']:
+        raise ValueError('mode must be "iterative" or "linear"')
     nfiles = len(files)
-    print('Running forced photometry on {:d} images'.format(nfiles))
+    if verbose:
+        print('Running forced photometry on {:d} images'.format(nfiles))
 
 
     # Do NOT load all of the images at once, only the headers and WCS objects
@@ -915,11 +2296,13 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
     # run prometheus if the _prometheus.fits file does not exist
     
     # Load images headers and WCS
-    print('Loading image headers, WCS, and catalogs')
-    iminfo = getimageinfo(files)
+    if verbose:
+        print('Loading image headers, WCS, and catalogs')
+    iminfo = getimageinfo(files,verbose=verbose)
     nimages = len(iminfo)
     if nimages==0:
-        print('No images to process')
+        if verbose:
+            print('No images to process')
         return
     
     # Load the master star table if necessary
@@ -932,10 +2315,12 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
     # No master star table input, make one from the
     #  individual catalogs
     else:
-        print('Creating master list')
-        mastertab = makemastertab(iminfo)
+        if verbose:
+            print('Creating master list')
+        mastertab = makemastertab(iminfo,verbose=verbose)
     nobj = len(mastertab)
-    print('Master list has {:d} stars'.format(nobj))
+    if verbose:
+        print('Master list has {:d} stars'.format(nobj))
         
     # Make sure we have the necessary columns
     for c in mastertab.colnames: mastertab[c].name = c.lower()
@@ -943,20 +2328,20 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
         raise ValueError('ra and dec columns must exist in mastertab')
 
     # Initialize the array of positions and proper motions
-    objtab,meastab,objindex,iminfo = initialize_catalogs(iminfo,mastertab)
-    
-    # Initial master list coordinates
-    coo0 = SkyCoord(ra=objtab['cenra']*u.deg,dec=objtab['cendec']*u.deg,frame='icrs')
+    objtab,meastab,objindex,iminfo = initialize_catalogs(iminfo,mastertab,verbose=verbose)
     
     # Some stars have zero measurements
     zeromeas, = np.where(objtab['nmeas']==0)
     if len(zeromeas)>0:
-        print('{:d} objects have zero measurements'.format(len(zeromeas)))
+        if verbose:
+            print('{:d} objects have zero measurements'.format(len(zeromeas)))
 
     # Reference epoch
     if refepoch is not None:
         if isinstance(refepoch,Time)==False:
             raise ValueError('refepoch must be an astropy Time object')
+    elif np.any(objtab['cenpmra']!=0) or np.any(objtab['cenpmdec']!=0):
+        raise ValueError('refepoch must be the epoch of the mastertab coordinates when it has proper motions')
     else:
         # Default reference epoch is mean JD
         refepoch = Time(np.mean([f['jd'] for f in iminfo]),format='jd')
@@ -966,157 +2351,138 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
            ('cenpmdec',float),('chisq',float)]
     last_obj = np.zeros(len(objtab),dtype=np.dtype(ldt))
         
+    # Process pool for solving the images
+    nproc = np.minimum(np.maximum(int(nproc),1),nimages)
+    pool = None
+    if nproc>1:
+        import multiprocessing as mp
+        if verbose:
+            print('Solving the images with {:d} processes'.format(nproc))
+        pool = mp.Pool(nproc)
+        
     # Iterate until convergence has been reached
     count = 0
     flag = 0
+
+    # Linear mode, the positions are fixed and each image is solved once
+    if mode=='linear':
+        if verbose:
+            print('Solving the amplitudes at fixed positions')
+        tasks = []
+        for i in range(nimages):
+            contained = iminfo[i]['members']
+            if len(contained)==0:
+                continue
+            msbeg = iminfo[i]['startmeas']
+            msend = msbeg + iminfo[i]['nmeas']
+            info = {k:iminfo[i][k] for k in ['file','residfile','wcs','psf','jd']}
+            tasks.append((i,(info,objtab[contained],meastab[msbeg:msend],refepoch,skyorder,tilesize,None)))
+        if pool is None:
+            results = map(linearimage,[t[1] for t in tasks])
+        else:
+            results = pool.imap(linearimage,[t[1] for t in tasks])
+        for (i,_),res in zip(tasks,results):
+            out = res['out']
+            msbeg = iminfo[i]['startmeas']
+            msend = msbeg + iminfo[i]['nmeas']
+            psf = iminfo[i]['psf']
+            iminfo[i]['imchisq'] = res['imchisq']
+            iminfo[i]['srcchisq'] = res['srcchisq']
+            if verbose:
+                print('Image {:d}  {:d} stars  image chisq {:.3f}  source chisq {:.3f}'.format(i+1,iminfo[i]['nmeas'],
+                                                                                           res['imchisq'],res['srcchisq']))
+            meastab['amp'][msbeg:msend] = out['amp']
+            meastab['amp_error'][msbeg:msend] = out['amp_error']
+            meastab['flux'][msbeg:msend] = out['amp']*psf.flux()
+            meastab['fluxerr'][msbeg:msend] = out['amp_error']*psf.flux()
+            for c in ['ra','dec','x','y','chisq','npix']:
+                meastab[c][msbeg:msend] = out[c]
+        meastab['converged'] = True
+        objtab['converged'] = True
+        objtab['niter'] = 1
+        flag = 1
+        
     #lastvalues = np.zeros(len(meastab),dtype=np.dtype([('flux',float),('dx',float),('dy',float)]))
     while (flag==0):
 
-        print('----- Iteration {:d} -----'.format(count+1))
-
-        if count % 5 == 0:
-            print('Recomputing and subtracting the sky')
+        if verbose:
+            print('----- Iteration {:d} -----'.format(count+1))
 
         # On first iteration, only fit amplitude (not centroid)
         if count==0:
             recenter = False
-            print('NOT recentering')
+            if verbose:
+                print('NOT recentering')
         else:
             recenter = True
-            print('Recentering')
-
-        # Loop over the images:
+            if verbose:
+                print('Recentering')
+
+        # Solve the images, each one only needs its own residual image and
+        #  the current object positions and proper motions
+        #  Active-set scheduling: only the unconverged measurements are
+        #  solved and images without any are skipped.  The models of the
+        #  converged stars stay subtracted in the residual images and their
+        #  measurements are frozen.
+        tasks = []
+        activeind = []
         for i in range(nimages):
-            wcs = iminfo[i]['wcs']
-            psf = iminfo[i]['psf']
-            residfile = iminfo[i]['residfile']
-            imtime = Time(iminfo[i]['jd'],format='jd')
-            
-            # Get the objects and measurements that overlap this image
-            contained = coo0.contained_by(iminfo[i]['wcs'])
-            objtab1 = objtab[contained]
+            # Get the objects and measurements that overlap this image,
+            #  the membership is fixed by the initial master list coordinates
+            contained = iminfo[i]['members']
+            active, = np.where(np.array(objtab['converged'][contained])==False)
+            if len(active)==0:
+                continue
             msbeg = iminfo[i]['startmeas']
-            msend = msbeg + iminfo[i]['nmeas']
-            meastab1 = meastab[msbeg:msend]
-            meastab1['converged'] = objtab1['converged']
-            print('Image {:d}  {:d} stars'.format(i+1,iminfo[i]['nmeas']))
-
-            # Check that meastab1 and objtab1 are ordered correctly
-            if np.sum(meastab1['objid'] != objtab1['objid']) > 0:
-                raise Exception('Image object and measurement tables are out of order')
-            
-            # Calculate x/y position for each object in this image
-            # using the current best overall on-sky position
-            # and proper motion
-            # Need to convert celestial values to x/y position in
-            # the image using the WCS.            
-            measra,measdec,measx,measy = compute_image_coordinates(objtab1,wcs,imtime,refepoch)
-            meastab1['ra'] = measra
-            meastab1['dec'] = measdec
-            meastab1['x'] = measx
-            meastab1['y'] = measy
-            
-            # Initialize or load the residual image
-            if count==0:
-                im = CCDData.read(iminfo[i]['file'])
-                resid = im.copy()
-                resid.skysubtracted = False
-            else:
-                resid = dln.unpickle(residfile)
-                
-            # Subtract sky
-            if count % 5 == 0:
-                print('Subtracting the sky')
-                if count==0:
-                    resid.data -= resid.sky   # subtract the sky
-                    resid.skysubtracted = True
-                else:
-                    # Add "current" sky image back in
-                    resid.data += resid.sky
-                    # Force the sky to be recomputed
-                    if hasattr(resid,'_sky'):
-                        resid._sky = None
-                    resid.data -= resid.sky  # subtract new sky
-                    resid.skysubtracted = True                    
-
-            # only fit measurements that have not converged yet
-            
-            # Fit the fluxes while holding the positions fixed
-            imchisq0 = np.sum(resid.data**2/resid.error**2)/resid.size
-            out,resid = solve(psf,resid,meastab1,recenter=recenter,verbose=verbose)
-
-            imchisq = np.sum(resid.data**2/resid.error**2)/resid.size
-            iminfo[i]['imchisq'] = imchisq
-            srcchisq = np.sum(out['chisq']*out['npix'])/np.sum(out['npix'])
-            medschisq = np.median(out['chisq'])
-            iminfo[i]['srcchisq'] = srcchisq
-            print('image chisq',imchisq0,imchisq)
-            print('source chisq',srcchisq)
-            print('median source chisq',medschisq)
-
-            #if imchisq>imchisq0:
-            #    import pdb; pdb.set_trace()            
-            
-            # I THINK THIS IS SLOW BECAUSE IT IS DOING ONE STAR AT A TIME AND
-            # USING A LOOP IN PYTHON.  Try to jaxify it!
-            
-            # Convert dx/dy to dra/ddec
-            #  these will be used later to compute proper motions
-            coo2 = wcs.pixel_to_world(meastab1['x']+out['dx'],meastab1['y']+out['dy'])
-            dra = coo2.ra.deg - meastab1['ra']
-            ddec = coo2.dec.deg - meastab1['dec']
-            out['dra'] = dra    # in degrees of RA (not true angle)
-            out['ddec'] = ddec  # in degrees
-            
-            # Save the residual file
-            dln.pickle(residfile,resid)
-            
-            # SOMETHING IS WRONG, I THINK THE PSF MIGHT NOT BE GOOD
-
-            #from dlnpyutils import plotting as pl 
-            #import pdb; pdb.set_trace()
-            
-            # Stuff the information back in
-            meastab['damp'][msbeg:msend] = out['amp']-meastab['amp'][msbeg:msend]
-            meastab['amp'][msbeg:msend] = out['amp']
-            meastab['flux'][msbeg:msend] = out['amp']*psf.flux()
-            meastab['fluxerr'][msbeg:msend] = out['amp_error']*psf.flux()  
-            meastab['ra'][msbeg:msend] = out['ra']
-            meastab['dec'][msbeg:msend] = out['dec']
-            meastab['dx'][msbeg:msend] = out['dx']
-            meastab['dy'][msbeg:msend] = out['dy']
-            meastab['dra'][msbeg:msend] = out['dra']
-            meastab['ddec'][msbeg:msend] = out['ddec']
-            meastab['chisq'][msbeg:msend] = out['chisq']            
-            
-            # allframe operates on the residual map, with the best-fit model subtracted
-            
-            # allframe derives flux and centroid corrections for each object
-            # the flux corrections are applied immediately while the centroid
-            # corrections are saved.
-
-            # there are no groups in allframe
-            # the least-squares design matrix is completely diagonalized: the
-            # incremental brightness and position corrections are derived for
-            # each star separately!  this may add a few more iterations for the
-            # badly blended stars, but it does *not* affect the accuracy of the
-            # final results.
-
-            # Once a star has converged, it's best-fit model is subtracted from
-            # the residual map and its parameters are fixed.
-            
-            # when no further infinitesimal change to a star's parameters
-            # produces any reduction in the robust estimate of the mean-square
-            # brightness residual inside that star's fitting region, the
-            # maximum-likelihood solution has been achieved.
-            
-            # Calculate dx/dy residuals for each source
-            # convert from pixel to world offset using image wcs
-
-            # need to save the residual image and uncertainties
-            # that's all we need to solve the least-squares problem.
+            info = {k:iminfo[i][k] for k in ['file','residfile','wcs','psf','jd']}
+            tasks.append((info,objtab[contained[active]],meastab[msbeg+active],count,
+                          refepoch,recenter,iminfo[i]['imchisq'],joint))
+            activeind.append((i,msbeg+active))
+        nactive = np.sum([len(a[1]) for a in activeind])
+        if verbose:
+            print('Active: {:d} of {:d} measurements in {:d} of {:d} images'.format(nactive,len(meastab),
+                                                                                 len(tasks),nimages))
+        if pool is None:
+            results = map(solveimage,tasks)
+        else:
+            results = pool.imap(solveimage,tasks)
+
+        # Stuff the information back in
+        meastab['damp'] = 0.0
+        if joint and recenter:
+            hess = np.zeros((len(meastab),3,3),float)
+            grad = np.zeros((len(meastab),3),float)
+            trans = np.zeros((len(meastab),2,2),float)
+        for (i,measind),res in zip(activeind,results):
+            out = res['out']
+            psf = iminfo[i]['psf']
+            iminfo[i]['imchisq'] = res['imchisq']
+            iminfo[i]['srcchisq'] = res['srcchisq']
+            if verbose:
+                print('Image {:d}  {:d} active stars'.format(i+1,len(measind)))
+                if res['newsky']:
+                    print('Recomputed and subtracted the sky')
+                print('image chisq',res['imchisq0'],res['imchisq'])
+                print('source chisq',res['srcchisq'])
+                print('median source chisq',res['medschisq'])
+            meastab['damp'][measind] = out['amp']-meastab['amp'][measind]
+            meastab['amp'][measind] = out['amp']
+            meastab['flux'][measind] = out['amp']*psf.flux()
+            meastab['fluxerr'][measind] = out['amp_error']*psf.flux()  
+            meastab['ra'][measind] = out['ra']
+            meastab['dec'][measind] = out['dec']
+            meastab['x'][measind] = out['x']
+            meastab['y'][measind] = out['y']
+            meastab['dx'][measind] = out['dx']
+            meastab['dy'][measind] = out['dy']
+            meastab['dra'][measind] = out['dra']
+            meastab['ddec'][measind] = out['ddec']
+            meastab['chisq'][measind] = out['chisq']            
+            if joint and recenter:
+                hess[measind] = out['hess']
+                grad[measind] = out['grad']
+                trans[measind] = out['trans']
 
-            
         # Calculate new coordinates and proper motions based on the x/y residuals
         # the accumulated centroid corrections are projected through the individual
         # frames' geometric transformations to the coordinate system of the master list
@@ -1128,9 +2494,13 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
         # corrections derived for stars in each input image.
 
         # Update the central coordinates and proper motions
-        print('Updating object coordinates and proper motions')
+        if verbose:
+            print('Updating object coordinates and proper motions')
         objtab1 = objtab.copy()
-        objtab = update_object(objtab,meastab,objindex,refepoch,fitpm=fitpm)
+        if joint and recenter:
+            objtab = update_object_joint(objtab,meastab,objindex,refepoch,hess,grad,trans,fitpm=fitpm)
+        else:
+            objtab = update_object(objtab,meastab,objindex,refepoch,fitpm=fitpm)
 
         # ONLY FIT PROPER MOTION EVERY FEW ITERATIONS!!
         
@@ -1140,7 +2510,8 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
             objtab,meastab = check_convergence(objtab,meastab,objindex,last_obj,count+1,fitpm=fitpm)
 
         nconverged = np.sum(objtab['converged'])
-        print('Nconverged = {:d}'.format(nconverged))
+        if verbose:
+            print('Nconverged = {:d}'.format(nconverged))
 
         if (len(objtab)-nconverged)==0 or (count+1)>=maxiter:
             flag = 1
@@ -1154,9 +2525,11 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
 
         # Increment iteration counter
         count += 1
-            
-        #import pdb; pdb.set_trace()
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+        
     # Create magnitudes, corrected for exposure time
     meastab = make_magnitudes(meastab,iminfo)
         
@@ -1165,8 +2538,7 @@ def forced(files,mastertab=None,fitpm=True,refepoch=None,maxiter=50,verbose=True
     objtab = average_photometry(objtab,meastab,objindex,iminfo)
 
     dt = time.time()-t0
-    print('dt = {:.1f} sec'.format(dt))
-    
-    import pdb; pdb.set_trace()
-        
+    if verbose:
+        print('dt = {:.1f} sec'.format(dt))
+
     return objtab,meastab
@@ -24,7 +24,6 @@ from scipy.spatial import cKDTree
 import copy
 import logging
 import time
-import matplotlib
 import sep
 from . import leastsquares as lsq,models,utils
 from .ccddata import CCDData
@@ -303,7 +302,7 @@ def subtractnei(image,allcat,psfcat,psf):
     nnei = len(indnei)
 
     flux = image.data-image.sky
-    resid = image.copy()
+    resid = image.datacopy()
     fitradius = psf.fwhm()*0.5
     
     # Loop over neighboring stars and fit just the core
@@ -382,8 +381,8 @@ class PSFFitter(object):
         xlist = []
         ylist = []
         pixstart = []
-        imflatten = np.zeros(self.nstars*(2*self.nfitpix+1)**2,float)
-        errflatten = np.zeros(self.nstars*(2*self.nfitpix+1)**2,float)
+        imflatten = np.zeros(self.nstars*(2*self.nfitpix+1)**2,image.data.dtype)
+        errflatten = np.zeros(self.nstars*(2*self.nfitpix+1)**2,image.data.dtype)
         count = 0
         for i in range(self.nstars):
             xcen = self.starxcen[i]
@@ -1064,7 +1063,7 @@ def getpsf(psf,image,cat,fitradius=None,lookup=False,lorder=0,method='qr',subnei
     flag = 0
     nrejstar = 100
     fitrad = fitradius
-    useimage = image.copy()
+    useimage = image
     while (flag==0):
         if verbose:
             print('--- Iteration '+str(nrejiter+1)+' ---')                
@@ -1095,8 +1094,8 @@ def getpsf(psf,image,cat,fitradius=None,lookup=False,lorder=0,method='qr',subnei
                 # Find the neighbors in allcat
                 # Fit the neighbors and PSF stars
                 # Subtract neighbors from the image
-                useimage = image.copy()  # start with original image
-                useimage = subtractnei(useimage,allcat,cat,curpsf)
+                # start with original image
+                useimage = subtractnei(image,allcat,cat,curpsf)
                 
         # Fitting the PSF to the stars
         #-----------------------------
@@ -1,6 +1,7 @@
 import os
 import numpy as np
-from numba import njit,types,from_dtype
+from numba import types,from_dtype
+from .compiled import njit   # njit with on-disk caching
 from numba.experimental import jitclass
 from numba_kdtree import KDTree
 from . import models_numba as mnb, utils_numba as utils
@@ -24,10 +24,7 @@ from dlnpyutils import utils as dln, bindata
 import copy
 import logging
 import time
-import matplotlib
 import sep
-from photutils.aperture import CircularAnnulus
-from astropy.stats import sigma_clipped_stats
 from . import leastsquares as lsq,utils
 from .ccddata import CCDData,BoundingBox
 
@@ -238,6 +235,8 @@ class GroupFitter(object):
     
     def sky(self,method='sep',rin=None,rout=None):
         """ (Re)calculate the sky."""
+        from photutils.aperture import CircularAnnulus
+        from astropy.stats import sigma_clipped_stats
         # Remove the current best-fit model
         resid = self.image.data-self.modelim  # remove model
         # SEP smoothly varying background
@@ -1102,6 +1101,9 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
     #  and didn't have starniter set
     gf.starniter[gf.starniter==0] = gf.niter
     
+    # Stars that were frozen as converged
+    frozen = gf.freezestars.copy()
+    
     # Make final model
     gf.unfreeze()
     model = CCDData(gf.modelim,bbox=image.bbox,unit=image.unit)
@@ -1123,7 +1125,7 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
     dt = np.dtype([('id',int),('amp',float),('amp_error',float),('x',float),
                    ('x_error',float),('y',float),('y_error',float),('sky',float),
                    ('flux',float),('flux_error',float),('mag',float),('mag_error',float),
-                   ('rms',float),('chisq',float),('niter',int)])
+                   ('rms',float),('chisq',float),('niter',int),('frozen',bool)])
     outcat = np.zeros(nstars,dtype=dt)
     if 'id' in cat.keys():
         outcat['id'] = cat['id']
@@ -1141,6 +1143,7 @@ def fit(psf,image,cat,method='qr',fitradius=None,recenter=True,maxiter=10,minper
     outcat['mag'] = -2.5*np.log10(np.maximum(outcat['flux'],1e-10))+25.0
     outcat['mag_error'] = (2.5/np.log(10))*outcat['flux_error']/outcat['flux']
     outcat['niter'] = gf.starniter  # what iteration it converged on
+    outcat['frozen'] = frozen       # converged before maxiter
     outcat = Table(outcat)
 
     # Relculate chi-squared and RMS of fit
@@ -9,16 +9,18 @@ __version__ = '20210826'  # yyyymmdd
 
 
 import numpy as np
-from numba import njit,types,from_dtype
+from numba import types,from_dtype
+from .compiled import njit   # njit with on-disk caching
 from numba.experimental import jitclass
 from numba_kdtree import KDTree
 from . import models_numba as mnb, utils_numba as utils, getpsf_numba as gnb
-from .clock_numba import clock
+# clock_numba.clock() is not used, ctypes pointers can't be cached and it would
+#  keep groupfit() from running without the GIL in threads
 
 # Fit a PSF model to multiple stars in an image
 
 
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def getstarinfo(imshape,mask,xcen,ycen,hpsfnpix,fitradius,skyradius):
     """ Return a star's full footprint, fitted pixels, and sky pixels data."""
@@ -68,7 +70,7 @@ def getstarinfo(imshape,mask,xcen,ycen,hpsfnpix,fitradius,skyradius):
                     count += 1
     return (fravelindex,fcount,ravelindex,count,skyravelindex,skycount)
 
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def collatestarsinfo(imshape,mask,starx,stary,hpsfnpix,fitradius,skyradius):
     """ Get full footprint, fitted pixels, and sky pixels data for all stars."""
@@ -104,7 +106,7 @@ def collatestarsinfo(imshape,mask,starx,stary,hpsfnpix,fitradius,skyradius):
     skyravelindex = skyravelindex[:,:maxskyn]
     return (fravelindex,fndata,ravelindex,ndata,skyravelindex,skyndata)
 
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def initstararrays(image,error,mask,tab,psfnpix,fitradius,skyradius,skyfit):
     """ Initialize all of the star arrays."""
@@ -230,8 +232,7 @@ def initstararrays(image,error,mask,tab,psfnpix,fitradius,skyradius,skyfit):
         x1 = xflat[i]
         y1 = yflat[i]
         for j in range(nstars):
-            pars1 = pars[3*i:3*i+3]
-            r = np.sqrt((xflat[i]-pars[1])**2 + (yflat[i]-pars[2])**2)
+            r = np.sqrt((x1-pars[3*j+1])**2 + (y1-pars[3*j+2])**2)
             if r <= psfnpix:
                 starflat_index[j,starflat_ndata[j]] = i
                 starflat_ndata[j] += 1
@@ -243,7 +244,7 @@ def initstararrays(image,error,mask,tab,psfnpix,fitradius,skyradius,skyfit):
             xflat,yflat,indflat,imflat,errflat,resflat,ntotpix,
             starfitinvindex,starflat_index,starflat_ndata)
 
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def sky(image,modelim,method='sep',rin=None,rout=None):
     """ (Re)calculate the sky."""
@@ -280,7 +281,7 @@ def sky(image,modelim,method='sep',rin=None,rout=None):
     #     else:
     #         raise ValueError("Sky method "+method+" not supported")
 
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def psf(xdata,pars,psfdata):
     """ Thin wrapper for getting a PSF model for a single star."""
@@ -290,7 +291,7 @@ def psf(xdata,pars,psfdata):
                     imshape,deriv=False,verbose=False)
     return im1
         
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def psfjac(xdata,pars,psfdata):
     """ Thin wrapper for getting the PSF model and Jacobian for a single star."""
@@ -300,7 +301,7 @@ def psfjac(xdata,pars,psfdata):
                        imshape,deriv=True,verbose=False)
     return im1,jac1
     
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def model(psfdata,freezedata,flatdata,pars,trim=False,allparams=False,verbose=False):
     """ Calculate the model for the stars and pixels we are fitting."""
@@ -359,7 +360,7 @@ def model(psfdata,freezedata,flatdata,pars,trim=False,allparams=False,verbose=Fa
         
     return allim
 
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def fullmodel(psfdata,stardata,pars):
     """ Calculate the model for all the stars and the full footprint."""
@@ -387,7 +388,7 @@ def fullmodel(psfdata,stardata,pars):
         
     return im
 
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit  
 def jac(psfdata,freezedata,flatdata,pars,trim=False,allparams=False):
     """ Calculate the jacobian for the pixels and parameters we are fitting"""
@@ -472,7 +473,7 @@ def jac(psfdata,freezedata,flatdata,pars,trim=False,allparams=False):
         
     return im,jac
 
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def chisqflat(freezedata,flatdata,psfdata,resflat,errflat,pars):
     """ Return chi-squared of the flat data"""
@@ -481,7 +482,7 @@ def chisqflat(freezedata,flatdata,psfdata,resflat,errflat,pars):
     chisq = np.sum(resflat**2/errflat**2)
     return chisq
 
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def cov(psfdata,freezedata,covflatdata,pars):
     """ Determine the covariance matrix."""
@@ -520,7 +521,7 @@ def cov(psfdata,freezedata,covflatdata,pars):
         
     return cov
 
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def dofreeze(frzpars,pars,freezedata,flatdata,psfdata,resid,resflat):
     """ Freeze par/stars."""
@@ -569,7 +570,7 @@ def dofreeze(frzpars,pars,freezedata,flatdata,psfdata,resid,resflat):
     return freezepars,freezestars,resid,resflat
 
     
-@njit(cache=True)
+@njit(cache=True,nogil=True)
 #@njit
 def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
              image,error,mask,tab,fitradius,maxiter=10,
@@ -631,8 +632,6 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     out,model,sky = groupfit(psf,image,error,mask,tab)
     
     """
-    start = clock()
-    
     nstars = len(tab)
     skyradius = psfnpix//2 + 10
     ny,nx = image.shape                             # save image dimensions, python images are (Y,X)
@@ -705,7 +704,7 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     for i in range(nstars):
         pars1 = pars[3*i:3*i+3]
         n1 = starndata[i]
-        ravelind1 = starravelindex[i]
+        ravelind1 = starravelindex[i,:n1]
         xind1 = xx[ravelind1]
         yind1 = yy[ravelind1]
         xdata1 = (xind1,yind1)
@@ -757,8 +756,6 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     #   keep looping until: (a) reached max iterations, (b) changes are tiny
     #                      or (c) there are no free stars left
     while (niter<maxiter and maxpercdiff>minpercdiff and nfreestars>0):
-        start0 = clock()
-
         # bestpar: current best values for the free parameters
         # pars: current best values for ALL parameters
         
@@ -861,9 +858,6 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
             resid[:] -= skyim   # subtract smooth sky
             resflat = resid[indflat]
             skyflat = skyim[indflat]
-            
-        if verbose:
-            print('iter dt =',(clock()-start0)/1e9,'sec.')
                 
         niter += 1     # increment counter
         
@@ -876,7 +870,7 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     freezepars[:] = False
     freezestars[:] = False
     # Make final model
-    finalmodel = fullmodel(psfdata,stardata,pars).copy().reshape(imshape[0],imshape[0])
+    finalmodel = fullmodel(psfdata,stardata,pars).copy().reshape(imshape[0],imshape[1])
     
     # Estimate uncertainties
     #   calculate covariance matrix
@@ -889,13 +883,12 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
         print('Best-fitting parameters: ',pars)
         print('Errors: ',perror)
 
-    # # Calculate smooth sky value for each star
-    # #  use center position
-    # for i in range(nstars):
-    #     x1 = int(np.round(starxcen[i]))
-    #     y1 = int(np.round(starycen[i]))
-    #     sind1 = utils.ravel_multi_index((y1,x1),imshape)
-    #     starsky[i] = skyim[sind1]
+    # Calculate smooth sky value for each star
+    #  use center position
+    for i in range(nstars):
+        x1 = int(np.minimum(np.maximum(np.round(pars[3*i+1]),0),imshape[1]-1))
+        y1 = int(np.minimum(np.maximum(np.round(pars[3*i+2]),0),imshape[0]-1))
+        starsky[i] = skyim[y1*imshape[1]+x1]
     
     # Put in catalog
     outtab = np.zeros((nstars,15),np.float64)
@@ -939,7 +932,12 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
         rms1 = np.sqrt(np.mean(((flux1-sky1-model1)/pars1[0])**2))
         outtab[i,12] = rms1
 
-    if verbose:
-        print('dt =',(clock()-start)/1e9,'sec.')
+    # The stars were sorted by amp in initstararrays(), put them
+    #  back in the order of the input table
+    si = np.argsort(tab[:,1])[::-1]
+    sorttab = outtab.copy()
+    for i in range(nstars):
+        outtab[si[i],:] = sorttab[i,:]
+    outtab[:,0] = tab[:,0]                        # id
  
     return outtab,finalmodel,skyim
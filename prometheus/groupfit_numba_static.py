@@ -251,8 +251,7 @@ def initstararrays(image,error,mask,tab,psfnpix,fitradius,skyradius,skyfit):
         x1 = xflat[i]
         y1 = yflat[i]
         for j in range(nstars):
-            pars1 = pars[3*i:3*i+3]
-            r = np.sqrt((xflat[i]-pars[1])**2 + (yflat[i]-pars[2])**2)
+            r = np.sqrt((x1-pars[3*j+1])**2 + (y1-pars[3*j+2])**2)
             if r <= psfnpix:
                 starflat_index[j,starflat_ndata[j]] = i
                 starflat_ndata[j] += 1
@@ -757,7 +756,7 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     for i in range(nstars):
         pars1 = pars[3*i:3*i+3]
         n1 = starndata[i]
-        ravelind1 = starravelindex[i]
+        ravelind1 = starravelindex[i,:n1]
         xind1 = xx[ravelind1]
         yind1 = yy[ravelind1]
         xdata1 = (xind1,yind1)
@@ -942,7 +941,7 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
     freezepars[:] = False
     freezestars[:] = False
     # Make final model
-    finalmodel = fullmodel(psfdata,stardata,pars).copy().reshape(imshape[0],imshape[0])
+    finalmodel = fullmodel(psfdata,stardata,pars).copy().reshape(imshape[0],imshape[1])
     
     # Estimate uncertainties
     #   calculate covariance matrix
@@ -955,13 +954,12 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
         print('Best-fitting parameters: ',pars)
         print('Errors: ',perror)
 
-    # # Calculate smooth sky value for each star
-    # #  use center position
-    # for i in range(nstars):
-    #     x1 = int(np.round(starxcen[i]))
-    #     y1 = int(np.round(starycen[i]))
-    #     sind1 = utils.ravel_multi_index((y1,x1),imshape)
-    #     starsky[i] = skyim[sind1]
+    # Calculate smooth sky value for each star
+    #  use center position
+    for i in range(nstars):
+        x1 = int(np.minimum(np.maximum(np.round(pars[3*i+1]),0),imshape[1]-1))
+        y1 = int(np.minimum(np.maximum(np.round(pars[3*i+2]),0),imshape[0]-1))
+        starsky[i] = skyim[y1*imshape[1]+x1]
     
     # Put in catalog
     outtab = np.zeros((nstars,15),np.float64)
@@ -1005,6 +1003,14 @@ def groupfit(psftype,psfparams,psfnpix,psflookup,psfflux,
         rms1 = np.sqrt(np.mean(((flux1-sky1-model1)/pars1[0])**2))
         outtab[i,12] = rms1
 
+    # The stars were sorted by amp in initstararrays(), put them
+    #  back in the order of the input table
+    si = np.argsort(tab[:,1])[::-1]
+    sorttab = outtab.copy()
+    for i in range(nstars):
+        outtab[si[i],:] = sorttab[i,:]
+    outtab[:,0] = tab[:,0]                        # id
+
     #if verbose:
     #    print('dt =',(clock()-start)/1e9,'sec.')
  
@@ -265,6 +265,12 @@ def jac_solve(jac,resid,method=None,weight=None):
         badpars = []
         usejac = jac
 
+    # Always solve in double precision, the pixel arrays can be float32
+    usejac = np.asarray(usejac,float)
+    resid = np.asarray(resid,float)
+    if weight is not None:
+        weight = np.asarray(weight,float)
+        
     # Solve the problem
     if method=='qr':
         dbeta = qr_jac_solve(usejac,resid,weight=weight)
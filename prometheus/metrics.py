@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""METRICS.PY - Per-stage timing, counters and memory metrics of a run
+
+"""
+
+__authors__ = 'David Nidever <dnidever@montana.edu?'
+__version__ = '20261019'  # yyyymmdd
+
+
+import os
+import sys
+import time
+import json
+import contextlib
+import numpy as np
+
+# The metrics files have one JSON record per line so that many processes
+#  can append to the same file and it can be read incrementally
+
+
+def maxrss():
+    """
+    Peak resident set size (high-water mark) of this process in MB.
+    None if it cannot be measured on this platform.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform=='darwin':
+        return rss/1024.0**2
+    return rss/1024.0
+
+
+def jsonvalue(val):
+    """ Convert numpy values to something json can serialize."""
+    if isinstance(val,dict):
+        return {str(k):jsonvalue(v) for k,v in val.items()}
+    if isinstance(val,(list,tuple,np.ndarray)):
+        return [jsonvalue(v) for v in val]
+    if isinstance(val,np.integer):
+        return int(val)
+    if isinstance(val,np.floating):
+        return float(val)
+    if isinstance(val,np.bool_):
+        return bool(val)
+    return val
+
+
+def allfitcounts(out):
+    """
+    Counters of the PSF photometry of all stars.
+
+    Parameters
+    ----------
+    out : table
+       Output table of allfit, with niter, frozen and (python engine)
+         group_id/ngroup columns.
+
+    Returns
+    -------
+    counts : dict
+       Number of stars, groups, the group-size histogram ({size: number of groups}),
+         the total/maximum solver iterations and the number of stars that
+         were frozen as converged before the maximum number of iterations.
+
+    Example
+    -------
+
+    counts = allfitcounts(out)
+
+    """
+    counts = {'nstars':len(out)}
+    if 'group_id' in out.colnames and len(out)>0:
+        _,ind = np.unique(np.array(out['group_id']),return_index=True)
+        sizes = np.array(out['ngroup'])[ind]
+        counts['ngroups'] = len(ind)
+        vals,num = np.unique(sizes,return_counts=True)
+        counts['grouphist'] = {int(v):int(n) for v,n in zip(vals,num)}
+    if 'niter' in out.colnames and len(out)>0:
+        niter = np.array(out['niter'])
+        counts['niter'] = int(np.sum(niter))
+        counts['maxniter'] = int(np.max(niter))
+    if 'frozen' in out.colnames:
+        counts['nfrozen'] = int(np.sum(np.array(out['frozen'],bool)))
+    return counts
+
+
+class Metrics(object):
+    """
+    Collect the wall time, CPU time, peak RSS increase and counters of the
+    stages of a run.
+
+    Parameters
+    ----------
+    info : keywords
+       Information on the run to add to the record, e.g. engine or image name.
+
+    Example
+    -------
+
+    met = Metrics(engine='python')
+    with met.stage('detection') as st:
+        objects = detection.detect(image)
+        st['ndetections'] = len(objects)
+    record = met.record()
+
+    """
+
+    def __init__(self,**info):
+        self.info = dict(info)
+        self.stages = []
+        self.t0 = time.time()
+        self.cpu0 = time.process_time()
+        self.rss0 = maxrss()
+
+    @contextlib.contextmanager
+    def stage(self,name,**counts):
+        """
+        Context manager that times a stage.  It yields a dictionary that
+        the counters of the stage can be added to.
+        """
+        counts = dict(counts)
+        t0 = time.time()
+        cpu0 = time.process_time()
+        rss0 = maxrss()
+        try:
+            yield counts
+        finally:
+            rss1 = maxrss()
+            rec = {'stage':name, 'wall':time.time()-t0, 'cpu':time.process_time()-cpu0,
+                   'rss_delta':(rss1-rss0 if rss0 is not None else None)}
+            rec.update(counts)
+            self.stages.append(rec)
+
+    def record(self,**info):
+        """
+        Return the metrics record of the run.
+
+        Parameters
+        ----------
+        info : keywords
+           Extra information to add to the record, e.g. number of stars.
+
+        Returns
+        -------
+        record : dict
+           The run information, the total wall/CPU time, the peak RSS and
+             the list of stage records.
+
+        Example
+        -------
+
+        record = met.record(nstars=len(cat))
+
+        """
+        rss = maxrss()
+        rec = {'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'host':os.uname()[1] if hasattr(os,'uname') else None,
+               'pid':os.getpid()}
+        rec.update(self.info)
+        rec.update(info)
+        rec['wall'] = time.time()-self.t0
+        rec['cpu'] = time.process_time()-self.cpu0
+        rec['maxrss'] = rss
+        rec['rss_delta'] = (rss-self.rss0 if rss is not None else None)
+        rec['stages'] = list(self.stages)
+        return jsonvalue(rec)
+
+    def __repr__(self):
+        return 'Metrics('+str(len(self.stages))+' stages, %.2f sec)' % (time.time()-self.t0)
+
+
+def writemetrics(filename,record):
+    """
+    Append a metrics record to a file, one JSON record per line.
+
+    Parameters
+    ----------
+    filename : str
+       Name of the metrics file.
+    record : dict
+       Metrics record from Metrics.record().
+
+    Returns
+    -------
+    The record is appended to the file.
+
+    Example
+    -------
+
+    writemetrics('metrics.jsonl',record)
+
+    """
+    line = json.dumps(jsonvalue(record))+'\n'
+    # A single write to a file opened in append mode is not interleaved
+    #  with the writes of other processes
+    with open(filename,'a') as f:
+        f.write(line)
+
+
+def readmetrics(filename):
+    """
+    Read the records of a metrics file.
+
+    Parameters
+    ----------
+    filename : str
+       Name of the metrics file.
+
+    Returns
+    -------
+    records : list
+       List of the metrics records (dictionaries).
+
+    Example
+    -------
+
+    records = readmetrics('metrics.jsonl')
+
+    """
+    records = []
+    with open(filename,'r') as f:
+        for line in f:
+            line = line.strip()
+            if line=='':
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue   # skip lines cut by an interrupted run
+    return records
+
+
+def summary(records):
+    """
+    Total the wall and CPU time of each stage over many records.
+
+    Parameters
+    ----------
+    records : list
+       Metrics records, e.g. from readmetrics().
+
+    Returns
+    -------
+    tab : table
+       Table with the stage name, number of calls and total/median wall and
+         CPU time.
+
+    Example
+    -------
+
+    tab = summary(readmetrics('metrics.jsonl'))
+
+    """
+    from astropy.table import Table
+    stages = {}
+    for rec in records:
+        for st in rec.get('stages',[]):
+            stages.setdefault(st['stage'],[]).append((st['wall'],st['cpu']))
+    dt = np.dtype([('stage',str,20),('ncalls',int),('wall',float),('cpu',float),
+                   ('medwall',float),('medcpu',float)])
+    tab = np.zeros(len(stages),dtype=dt)
+    for i,name in enumerate(stages):
+        vals = np.array(stages[name])
+        tab[i] = (name,len(vals),np.sum(vals[:,0]),np.sum(vals[:,1]),
+                  np.median(vals[:,0]),np.median(vals[:,1]))
+    return Table(tab)
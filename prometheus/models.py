@@ -17,14 +17,12 @@ from astropy.table import Table
 import astropy.units as u
 from scipy.optimize import curve_fit, least_squares, line_search, root_scalar
 from scipy.interpolate import interp1d
-from skimage import measure
 from dlnpyutils import utils as dln, bindata, ladfit, coords
 from scipy.interpolate import RectBivariateSpline
 from scipy.special import gamma, gammaincinv, gammainc
 import copy
 import logging
 import time
-import matplotlib
 from . import getpsf, utils
 from .ccddata import BoundingBox,CCDData
 from . import leastsquares as lsq
@@ -91,6 +89,7 @@ def contourfwhm(im):
     fwhm = contourfwhm(im)
 
     """
+    from skimage import measure
     # get contour at half max and then get average radius
     ny,nx = im.shape
     xcen = nx//2
@@ -647,7 +646,9 @@ def gaussian2d_integrate(x, y, pars, deriv=False, nderiv=None, osamp=4):
         if nderiv>=4:
             cost = np.cos(theta)
             sint = np.sin(theta)
-            xstd3 = pars[1] ** 3
+            xdiff2 = xdiff ** 2
+            ydiff2 = ydiff ** 2
+            xstd3 = pars[3] ** 3
             da_dx_stddev = -cost2 / xstd3
             db_dx_stddev = -sin2t / xstd3
             dc_dx_stddev = -sint2 / xstd3        
@@ -656,7 +657,7 @@ def gaussian2d_integrate(x, y, pars, deriv=False, nderiv=None, osamp=4):
                                   dc_dx_stddev * ydiff2))
             derivative.append(np.sum(np.sum(dg_dx_stddev,axis=0),axis=0)/osamp2)
         if nderiv>=5:
-            ystd3 = pars[2] ** 3            
+            ystd3 = pars[4] ** 3            
             da_dy_stddev = -sint2 / ystd3
             db_dy_stddev = sin2t / ystd3
             dc_dy_stddev = -cost2 / ystd3        
@@ -948,40 +949,11 @@ def moffat2d_integrate(x, y, pars, deriv=False, nderiv=None, osamp=4):
     x2 = np.tile(x,(osamp,osamp,1)) + np.tile(dx2.T,(nx,1,1)).T
     y2 = np.tile(y,(osamp,osamp,1)) + np.tile(dx2,(nx,1,1)).T
         
-    rr_gg = ((x2 - pars[1]) ** 2 + (y2 - pars[2]) ** 2) / pars[3] ** 2
-    g = pars[0] * (1 + rr_gg) ** (-pars[4])
-
-
-    # Compute derivative as well
+    # Evaluate the Moffat on the subpixel grid
     if deriv is True:
-
-        # How many derivative terms to return
-        if nderiv is not None:
-            if nderiv <=0:
-                nderiv = 5
-        else:
-            nderiv = 5
-        
-        derivative = []
-        if nderiv>=1:
-            d_A = g/pars[0]
-            derivative.append(np.sum(np.sum(d_A,axis=0),axis=0)/osamp2)
-        if nderiv>=2:
-            d_x_0 = (2 * pars[0] * pars[4] * d_A * (x2 - pars[1]) /
-                     (pars[3] ** 2 * (1 + rr_gg)))
-            derivative.append(np.sum(np.sum(d_x_0,axis=0),axis=0)/osamp2)        
-        if nderiv>=3:
-            d_y_0 = (2 * pars[0] * pars[4] * d_A * (y2 - pars[2]) /
-                     (pars[3] ** 2 * (1 + rr_gg)))
-            derivative.append(np.sum(np.sum(d_y_0,axis=0),axis=0)/osamp2)  
-        if nderiv>=4:
-            d_sigma = (2 * pars[0] * pars[4] * d_A * rr_gg /
-                       (pars[3] * (1 + rr_gg)))
-            derivative.append(np.sum(np.sum(d_sigma,axis=0),axis=0)/osamp2)
-        if nderiv>=5:            
-            d_beta = -pars[0] * d_A * np.log(1 + rr_gg)
-            derivative.append(np.sum(np.sum(d_beta,axis=0),axis=0)/osamp2)  
-
+        g,dg = moffat2d(x2.ravel(),y2.ravel(),pars,deriv=True,nderiv=nderiv)
+        g = g.reshape(x2.shape)
+        derivative = [np.sum(np.sum(d.reshape(x2.shape),axis=0),axis=0)/osamp2 for d in dg]
         g = np.sum(np.sum(g,axis=0),axis=0)/osamp2
 
         # Reshape
@@ -993,6 +965,7 @@ def moffat2d_integrate(x, y, pars, deriv=False, nderiv=None, osamp=4):
 
     # No derivative
     else:
+        g = moffat2d(x2.ravel(),y2.ravel(),pars).reshape(x2.shape)
         g = np.sum(np.sum(g,axis=0),axis=0)/osamp2
         # Reshape
         if ndim>1:
@@ -1306,117 +1279,28 @@ def penny2d_integrate(x, y, pars, deriv=False, nderiv=None, osamp=4):
     dx2 = np.tile(dx,(osamp,1))
     x2 = np.tile(x,(osamp,osamp,1)) + np.tile(dx2.T,(nx,1,1)).T
     y2 = np.tile(y,(osamp,osamp,1)) + np.tile(dx2,(nx,1,1)).T
-    
-    xdiff = x2 - pars[1]
-    ydiff = y2 - pars[2]
-    amp = pars[0]
-    xsig = pars[3]
-    ysig = pars[4]
-    theta = pars[5]
-    cost2 = np.cos(theta) ** 2
-    sint2 = np.sin(theta) ** 2
-    sin2t = np.sin(2. * theta)
-    xsig2 = xsig ** 2
-    ysig2 = ysig ** 2
-    a = ((cost2 / xsig2) + (sint2 / ysig2))
-    b = ((sin2t / xsig2) - (sin2t / ysig2))    
-    c = ((sint2 / xsig2) + (cost2 / ysig2))
-    relamp = np.minimum(np.maximum(pars[6],0),1.0)  # 0<relamp<1
 
-    # Gaussian component
-    g = amp * (1-relamp) * np.exp(-0.5*((a * xdiff ** 2) + (b * xdiff*ydiff) +
-                                        (c * ydiff ** 2)))
-    # Add Lorentzian/Moffat beta=1.2 wings
-    sigma = np.maximum(pars[7],0)
-    rr_gg = (xdiff ** 2 + ydiff ** 2) / sigma ** 2
-    beta = 1.2
-    l = amp * relamp / (1 + rr_gg)**(beta)
-    # Sum of Gaussian + Lorentzian
-    f = g + l
-
-   
-    # Compute derivative as well
+    # Evaluate the Penny on the subpixel grid
     if deriv is True:
-
-        # How many derivative terms to return
-        if nderiv is not None:
-            if nderiv <=0:
-                nderiv = 8
-        else:
-            nderiv = 8
-            
-        derivative = []
-        if nderiv>=1:
-            df_dA = f / amp
-            derivative.append(np.sum(np.sum(df_dA,axis=0),axis=0)/osamp2)
-        if nderiv>=2:
-            #df_dx_mean = ( g * 0.5*((2 * a * xdiff) + (b * ydiff)) +
-            #               2*l*xdiff/(sigma**2 * (1+rr_gg)) )
-            df_dx_mean = ( g * 0.5*((2 * a * xdiff) + (b * ydiff)) +                           
-                           2*beta*l*xdiff/(sigma**2 * (1+rr_gg)) )            
-            derivative.append(np.sum(np.sum(df_dx_mean,axis=0),axis=0)/osamp2)
-        if nderiv>=3:
-            #df_dy_mean = ( g * 0.5*((2 * c * ydiff) + (b * xdiff)) +
-            #               2*l*ydiff/(sigma**2 * (1+rr_gg)) )
-            df_dy_mean = ( g * 0.5*((2 * c * ydiff) + (b * xdiff)) +
-                           2*beta*l*ydiff/(sigma**2 * (1+rr_gg)) )            
-            derivative.append(np.sum(np.sum(df_dy_mean,axis=0),axis=0)/osamp2)
-        if nderiv>=4:
-            xdiff2 = xdiff ** 2
-            ydiff2 = ydiff ** 2
-            xsig3 = xsig ** 3
-            da_dxsig = -cost2 / xsig3
-            db_dxsig = -sin2t / xsig3            
-            dc_dxsig = -sint2 / xsig3            
-            df_dxsig = g * (-(da_dxsig * xdiff2 +
-                              db_dxsig * xdiff * ydiff +
-                              dc_dxsig * ydiff2))
-            derivative.append(np.sum(np.sum(df_dxsig,axis=0),axis=0)/osamp2)
-        if nderiv>=5:
-            ysig3 = ysig ** 3
-            da_dysig = -sint2 / ysig3
-            db_dysig = sin2t / ysig3            
-            dc_dysig = -cost2 / ysig3            
-            df_dysig = g * (-(da_dysig * xdiff2 +
-                              db_dysig * xdiff * ydiff +
-                              dc_dysig * ydiff2))
-            derivative.append(np.sum(np.sum(df_dysig,axis=0),axis=0)/osamp2)
-        if nderiv>=6:
-            sint = np.sin(theta)
-            cost = np.cos(theta)
-            cos2t = np.cos(2.0*theta)
-            da_dtheta = (sint * cost * ((1. / ysig2) - (1. / xsig2)))
-            db_dtheta = (cos2t / xsig2) - (cos2t / ysig2)            
-            dc_dtheta = -da_dtheta            
-            df_dtheta = g * (-(da_dtheta * xdiff2 +
-                               db_dtheta * xdiff * ydiff +
-                               dc_dtheta * ydiff2))
-            derivative.append(np.sum(np.sum(df_dtheta,axis=0),axis=0)/osamp2)
-        if nderiv>=7:
-            df_drelamp = -g/(1-relamp) + l/relamp
-            derivative.append(df_drelamp)
-        if nderiv>=8:
-            #df_dsigma = l/(1+rr_gg) * 2*rr_gg/sigma
-            df_dsigma = beta*l/(1+rr_gg) * 2*(xdiff2+ydiff2)/sigma**3 
-            derivative.append(np.sum(np.sum(df_dsigma,axis=0),axis=0)/osamp2)
-
-        f = np.sum(np.sum(g,axis=0),axis=0)/osamp2
+        g,dg = penny2d(x2.ravel(),y2.ravel(),pars,deriv=True,nderiv=nderiv)
+        g = np.sum(np.sum(g.reshape(x2.shape),axis=0),axis=0)/osamp2
+        derivative = [np.sum(np.sum(d.reshape(x2.shape),axis=0),axis=0)/osamp2 for d in dg]
 
         # Reshape
         if ndim>1:
-            f = f.reshape(shape)
+            g = g.reshape(shape)
             derivative = [d.reshape(shape) for d in derivative]
-        
-        return f,derivative
+
+        return g,derivative
 
     # No derivative
     else:
-        f = np.sum(np.sum(f,axis=0),axis=0)/osamp2
+        g = penny2d(x2.ravel(),y2.ravel(),pars).reshape(x2.shape)
+        g = np.sum(np.sum(g,axis=0),axis=0)/osamp2
         # Reshape
         if ndim>1:
-            f = f.reshape(shape)
-        return f
-
+            g = g.reshape(shape)
+        return g
 
 
 def gausspow2d(x, y, pars, deriv=False, nderiv=None):
@@ -1509,10 +1393,10 @@ def gausspow2d(x, y, pars, deriv=False, nderiv=None):
             dg_dA = g / amp
             derivative.append(dg_dA)
         if nderiv>=2:
-            dg_dx_0 = g * (1+beta4*z2+0.5*beta6*z2**2)*(2*a*xdiff+b*ydiff) / gxy
+            dg_dx_0 = 0.5 * g * (1+beta4*z2+0.5*beta6*z2**2)*(2*a*xdiff+b*ydiff) / gxy
             derivative.append(dg_dx_0)            
         if nderiv>=3:
-            dg_dy_0 = g * (1+beta4*z2+0.5*beta6*z2**2)*(2*c*ydiff+b*xdiff) / gxy            
+            dg_dy_0 = 0.5 * g * (1+beta4*z2+0.5*beta6*z2**2)*(2*c*ydiff+b*xdiff) / gxy            
             derivative.append(dg_dy_0)
         if nderiv>=4:
             xsig3 = xsig ** 3
@@ -1725,101 +1609,29 @@ def gausspow2d_integrate(x, y, pars, deriv=False, nderiv=None, osamp=4):
     x2 = np.tile(x,(osamp,osamp,1)) + np.tile(dx2.T,(nx,1,1)).T
     y2 = np.tile(y,(osamp,osamp,1)) + np.tile(dx2,(nx,1,1)).T    
 
-    # pars = [amplitude, x0, y0, sigx, sigy, theta, beta4, beta6]    
-    xdiff = x2 - pars[1]
-    ydiff = y2 - pars[2]
-    amp = pars[0]
-    xsig = pars[3]
-    ysig = pars[4]
-    theta = pars[5]
-    beta4 = pars[6]
-    beta6 = pars[7]
-    xdiff2 = xdiff**2
-    ydiff2 = ydiff**2
-
-    # convert sigx, sigy and theta to a, b, c terms
-    cost2 = np.cos(theta) ** 2
-    sint2 = np.sin(theta) ** 2
-    sin2t = np.sin(2. * theta)
-    xsig2 = xsig ** 2
-    ysig2 = ysig ** 2
-    a = ((cost2 / xsig2) + (sint2 / ysig2))
-    b = ((sin2t / xsig2) - (sin2t / ysig2))    
-    c = ((sint2 / xsig2) + (cost2 / ysig2))
-    
-    z2 = 0.5*(a*xdiff2 + b*xdiff*ydiff + c*ydiff2)
-    gxy = (1+z2+0.5*beta4*z2**2+(1.0/6.0)*beta6*z2**3)
-    g = amp / gxy
-
-    
-    # Compute derivative as well
+    # Evaluate the Gausspow on the subpixel grid
     if deriv is True:
-
-        # How many derivative terms to return
-        if nderiv is not None:
-            if nderiv <=0:
-                nderiv = 8
-        else:
-            nderiv = 8
-        
-        derivative = []
-        if nderiv>=1:
-            dg_dA = g / amp
-            derivative.append(np.sum(np.sum(dg_dA,axis=0),axis=0)/osamp2)
-        if nderiv>=2:
-            dg_dx_0 = g * (1+beta4*z2+0.5*beta6*z2**2)*(2*a*xdiff+b*ydiff) / gxy
-            derivative.append(np.sum(np.sum(dg_dx_0,axis=0),axis=0)/osamp2)
-        if nderiv>=3:
-            dg_dy_0 = g * (1+beta4*z2+0.5*beta6*z2**2)*(2*c*ydiff+b*xdiff) / gxy            
-            derivative.append(np.sum(np.sum(dg_dy_0,axis=0),axis=0)/osamp2)
-        if nderiv>=4:
-            xsig3 = xsig ** 3
-            da_dxsig = -cost2 / xsig3
-            db_dxsig = -sin2t / xsig3            
-            dc_dxsig = -sint2 / xsig3         
-            dg_dxsig = -g * (1+beta4*z2+0.5*beta6*z2**2)*(da_dxsig*xdiff2+db_dxsig*xdiff*ydiff+dc_dxsig*ydiff2) / gxy     
-            derivative.append(np.sum(np.sum(dg_dxsig,axis=0),axis=0)/osamp2)
-        if nderiv>=5:
-            ysig3 = ysig ** 3
-            da_dysig = -sint2 / ysig3
-            db_dysig = sin2t / ysig3            
-            dc_dysig = -cost2 / ysig3        
-            dg_dysig = -g * (1+beta4*z2+0.5*beta6*z2**2)*(da_dysig*xdiff2+db_dysig*xdiff*ydiff+dc_dysig*ydiff2) / gxy     
-            derivative.append(np.sum(np.sum(dg_dysig,axis=0),axis=0)/osamp2)
-        if nderiv>=6:
-            sint = np.sin(theta)
-            cost = np.cos(theta)
-            cos2t = np.cos(2.0*theta)
-            da_dtheta = (sint * cost * ((1. / ysig2) - (1. / xsig2)))
-            db_dtheta = (cos2t / xsig2) - (cos2t / ysig2)            
-            dc_dtheta = -da_dtheta 
-            dg_dtheta = -g * (1+beta4*z2+0.5*beta6*z2**2)*(da_dtheta*xdiff2+db_dtheta*xdiff*ydiff+dc_dtheta*ydiff2) / gxy     
-            derivative.append(np.sum(np.sum(dg_dtheta,axis=0),axis=0)/osamp2)
-        if nderiv>=7:            
-            dg_dbeta4 = -g * (0.5*z2**2) / gxy
-            derivative.append(np.sum(np.sum(dg_dbeta4,axis=0),axis=0)/osamp2)
-        if nderiv>=8:            
-            dg_dbeta6 = -g * ((1.0/6.0)*z2**3) / gxy
-            derivative.append(np.sum(np.sum(dg_dbeta6,axis=0),axis=0)/osamp2)
-            
-        g = np.sum(np.sum(g,axis=0),axis=0)/osamp2
+        g,dg = gausspow2d(x2.ravel(),y2.ravel(),pars,deriv=True,nderiv=nderiv)
+        g = np.sum(np.sum(g.reshape(x2.shape),axis=0),axis=0)/osamp2
+        derivative = [np.sum(np.sum(d.reshape(x2.shape),axis=0),axis=0)/osamp2 for d in dg]
 
         # Reshape
         if ndim>1:
             g = g.reshape(shape)
             derivative = [d.reshape(shape) for d in derivative]
-            
+
         return g,derivative
 
     # No derivative
     else:
+        g = gausspow2d(x2.ravel(),y2.ravel(),pars).reshape(x2.shape)
         g = np.sum(np.sum(g,axis=0),axis=0)/osamp2
         # Reshape
         if ndim>1:
             g = g.reshape(shape)
         return g
 
-   
+
 def sersic2d(x, y, pars, deriv=False, nderiv=None):
     """
     Sersic profile and can be elliptical and rotated.
@@ -2520,6 +2332,9 @@ def psfmodel(name,pars=None,**kwargs):
 # PSF base class
 class PSFBase:
 
+    # Number of PSF model evaluations by all PSF objects, see metrics.py
+    nevaluations = 0
+
     def __init__(self,mpars,npix=51,binned=False,verbose=False):
         """
         Initialize the PSF model object.
@@ -2680,6 +2495,7 @@ class PSFBase:
 
         # Evaluate
         out = self.evaluate(x,y,inpars,deriv=deriv,**kwargs)
+        PSFBase.nevaluations += 1
 
         # Add the lookup component
         if self.haslookup and nolookup==False:
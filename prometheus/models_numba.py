@@ -7,7 +7,8 @@ from scipy.optimize import root_scalar
 #import numba_special  # The import generates Numba overloads for special
 from dlnpyutils import utils as dln
 import numba
-from numba import jit,njit,types
+from numba import jit,types
+from .compiled import njit   # njit with on-disk caching
 from numba.experimental import jitclass
 from . import leastsquares as lsq, utils_numba as utils
 
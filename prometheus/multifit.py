@@ -91,7 +91,7 @@ def applytrans(trans,data):
     """
 
     outdata = data.copy()
-    outdata[:,0] = trans[0,0] * data[:,0] + trans[1,0] * data[:,1]
+    outdata[:,0] = trans[0,0] * data[:,0] + trans[0,1] * data[:,1]
     outdata[:,1] = trans[1,0] * data[:,0] + trans[1,1] * data[:,1]
     return outdata
 
@@ -111,7 +111,7 @@ def starfit(data,reftime=None):
           RESID: Residuals of the best model-fit and the data (data-model) [Npix].
           WEIGHT: The weights (i.e., 1/sigma^2) of the pixels.
           META:  Dictionary of meta-data.  This should the exposure timestamp information
-                  (either DATE-TIME, JD or MJD). And TRANS, the transformation of the X/Y positions
+                  (MJD). And TRANS, the transformation of the X/Y positions
                   in this exposure and at the position of this star, into the reference frame
                   (normally RA/DEC in arcsec).  This must be a 2 x 2 rotation and scaling matrix
                   (like the standard WCS CD matrix).
@@ -136,75 +136,179 @@ def starfit(data,reftime=None):
 
     nexp = len(data)
 
-    # Construct the "global" arrays
-    #   JAC : Jacobian matrix [Npix total, 4 + Nexposures] for all of the pixels across all
-    #            of the exposures and the parameters Xref, Yref, mu_x, mu_y, and amplitudes
-    #            for all Nexp exposures.
-    #   RESID : residuals of all pixels of all exposures concatenated.
-    #   WEIGHT : weights of all pixels of all exposures concatenated.
-
     # Reference time
     if reftime is None:
         reftime = data[0]['META']['MJD']
-    
-    # Initialize the global arrays
-    npix = np.sum([len(d['RESID']) for d in data])  # add up total number of pixels
-    npar = 4 + nexp
-    jac = np.zeros([npix,npar],float)
-    resid = np.zeros(npix,float)
-    weight = np.zeros(npix,float)
-
-    # Loop over the exposures
-    pixcount = 0
+
+    # The pixels of the exposures are independent, so the normal equations
+    #  of the "global" problem are sums over the exposure-level normal
+    #  equations, see multistarfit()
+    hess = np.zeros((nexp,3,3),float)
+    grad = np.zeros((nexp,3),float)
+    trans = np.zeros((nexp,2,2),float)
+    deltat = np.zeros(nexp,float)
     for i in range(nexp):
         data1 = data[i]
-        jac1 = data1['JAC']
-        resid1 = data1['RESID']
-        weight1 = data1['WEIGHT']
+        jac1 = np.asarray(data1['JAC'],float)
+        resid1 = np.asarray(data1['RESID'],float)
+        weight1 = np.asarray(data1['WEIGHT'],float)
         meta1 = data1['META']
-        time1 = meta1['MJD']
-        trans1 = meta['TRANS']
-        npix1 = len(resid1)
-
+        hess[i] = jac1.T @ (weight1.reshape(-1,1)*jac1)
+        grad[i] = jac1.T @ (weight1*resid1)
+        trans[i] = meta1['TRANS']
         # Delta time, time since reference epoch
-        delta_time = time1 - reftime   # MJD, days
-        delta_time /= 365.2425         # convert to years
-        
-        # Concatenate RESID and WEIGHT
-        resid[count:count+npix1] = resid1
-        weight[count:count+npix1] = weight1
-            
-        # Translate X/Y into the reference frame
-        tjac1 = jac1.copy()        
-        transjac2 = applytrans(trans1,jac[:,0:2])  # transform X/Y into reference frame
-        tjac1[:,0:2] = transjac2
-
-        # Fill in the Global Jacobian
-        # Convert X and Y derivatives from the exposure-level jacobian
-        #   to the global Xref, Yref, mu_x, and mu_y parameters
-        # Xref and Yref derivatives are the same as the X/Y derivatives
-        jac[count:count+npix1,0] = tjac1[:,0]              # Xref derivative
-        jac[count:count+npix1,1] = tjac1[:,1]              # Yref derivative
-        # mu_x and mu_y derivatives are just X derivatives * delta_time        
-        jac[count:count+npix1,2] = tjac1[:,0]*delta_time   # mu_x derivative (arcsec/year)
-        jac[count:count+npix1,3] = tjac1[:,1]*delta_time   # mu_y derivative (arcsec/year)
-
-        # Amplitude/flux derivatives
-        jac[count:count+npix1,i] = jac1[:,2]      # amplitude
-        
-        # Increment pixcount
-        pixcount += npix1
-
-    # Now solve the matrix
-
-    #par = sparse.linalg.lsqr(A,dy2,atol=1e-4,btol=1e-4)
-    # pars = lsq.cholesky_jac_sparse_solve(jac,resid,weight)
-
-    # Solve Jacobian
-    #  these are the correction terms, no the final parameters themselves
-    pars = lsq.jac_solve(jac,resid,method='qr',weight=weight)
-    cov = lsq.jac_covariance(jac,resid,weight)
-    perror = np.sqrt(np.diag(cov))
+        deltat[i] = (meta1['MJD'] - reftime)/365.2425   # convert days to years
+
+    pars,perror,amp,amperror = multistarfit(hess,grad,trans,deltat,np.zeros(nexp,int),1)
+    pars = np.concatenate((pars[0],amp))
+    perror = np.concatenate((perror[0],amperror))
 
     return pars,perror
-    
+
+
+def multistarfit(hess,grad,trans,deltat,starindex,nstars=None,fitpm=None,maxpars=20000000):
+    """
+    Solve the multi-epoch astrometric problem of many stars at once.  Each
+    star has the parameters Xref, Yref, mu_x, mu_y and one amplitude per
+    exposure.  The system of each star is assembled from the exposure-level
+    normal equations of the (x, y, amplitude) parameters, and the systems of
+    all stars are solved with batched dense solves.
+
+    Parameters
+    ----------
+    hess : numpy array
+       Exposure-level normal matrices J^T W J of each measurement [Nmeas,3,3],
+         for the x position, y position and amplitude.
+    grad : numpy array
+       Exposure-level J^T W resid of each measurement [Nmeas,3].
+    trans : numpy array
+       Transformation of the X/Y positions of each measurement into the
+         reference frame (e.g. RA/DEC in arcsec) [Nmeas,2,2], like the
+         WCS CD matrix.
+    deltat : numpy array
+       Time since the reference epoch of each measurement, normally in years.
+    starindex : numpy array
+       Index of the star of each measurement.
+    nstars : int, optional
+       Number of stars.  By default, this is max(starindex)+1.
+    fitpm : numpy array, optional
+       Boolean array of the stars to fit proper motions for.  The proper
+         motion corrections of the other stars are held at zero.  By default,
+         all stars with measurements at more than one epoch are fit.
+    maxpars : int, optional
+       Maximum number of matrix elements to solve at once.  Default is 20,000,000.
+
+    Returns
+    -------
+    pars : numpy array
+       Correction terms for Xref, Yref, mu_x, mu_y of each star [Nstars,4].
+    perror : numpy array
+       Uncertainties in pars [Nstars,4].
+    amp : numpy array
+       Correction terms for the amplitude of each measurement [Nmeas].
+    amperror : numpy array
+       Uncertainties in amp [Nmeas].
+
+    Example
+    -------
+
+    pars,perror,amp,amperror = multistarfit(hess,grad,trans,deltat,starindex)
+
+    """
+
+    starindex = np.asarray(starindex,int)
+    deltat = np.asarray(deltat,float)
+    nmeas = len(starindex)
+    if nstars is None:
+        nstars = np.max(starindex)+1 if nmeas>0 else 0
+    pars = np.zeros((nstars,4),float)
+    perror = np.zeros((nstars,4),float)
+    amp = np.zeros(nmeas,float)
+    amperror = np.zeros(nmeas,float)
+    if nmeas==0:
+        return pars,perror,amp,amperror
+
+    # The exposure-level x/y derivatives are converted to the reference frame
+    #  with the inverse transformation, dx = Tinv . dXref and the proper
+    #  motion derivatives are the same times the time since the reference epoch
+    tinv = np.linalg.inv(trans)
+    proj = np.concatenate((tinv,tinv*deltat.reshape(-1,1,1)),axis=2)   # [Nmeas,2,4]
+    hxx = hess[:,0:2,0:2]
+    hxa = hess[:,0:2,2]
+    haa = hess[:,2,2]
+    astblock = np.einsum('nji,njk,nkl->nil',proj,hxx,proj)     # [Nmeas,4,4]
+    astamp = np.einsum('nji,nj->ni',proj,hxa)                  # [Nmeas,4]
+    astgrad = np.einsum('nji,nj->ni',proj,grad[:,0:2])         # [Nmeas,4]
+
+    # Exposure number of each measurement within its star
+    si = np.argsort(starindex,kind='stable')
+    nexp = np.bincount(starindex,minlength=nstars)
+    starts = np.cumsum(nexp)-nexp
+    expnum = np.zeros(nmeas,int)
+    expnum[si] = np.arange(nmeas)-starts[starindex[si]]
+
+    if fitpm is None:
+        tlo = np.full(nstars,np.inf)
+        thi = np.full(nstars,-np.inf)
+        np.minimum.at(tlo,starindex,deltat)
+        np.maximum.at(thi,starindex,deltat)
+        fitpm = (nexp>1) & (thi>tlo)
+    fitpm = np.asarray(fitpm,bool)
+
+    # Solve stars with similar numbers of exposures together so the
+    #  systems are padded as little as possible
+    order = np.argsort(nexp,kind='stable')
+    order = order[nexp[order]>0]
+    nchunk = np.maximum(maxpars//((4+np.max(nexp))**2),1)
+    lo = 0
+    while lo<len(order):
+        hi = lo+nchunk
+        # all the stars of this chunk use the size of the largest one
+        size = 4+nexp[order[np.minimum(hi,len(order))-1]]
+        stars = order[lo:hi]
+        nst = len(stars)
+        local = np.full(nstars,-1,int)
+        local[stars] = np.arange(nst)
+        mind, = np.where(local[starindex]>=0)
+        lind = local[starindex[mind]]
+        eind = 4+expnum[mind]
+        # Assemble the systems [Nstars,4+Nexp,4+Nexp]
+        amat = np.zeros((nst,size,size),float)
+        bvec = np.zeros((nst,size),float)
+        ast = np.zeros((nst,4,4),float)
+        np.add.at(ast,lind,astblock[mind])
+        amat[:,0:4,0:4] = ast
+        astg = np.zeros((nst,4),float)
+        np.add.at(astg,lind,astgrad[mind])
+        bvec[:,0:4] = astg
+        amat[lind,0:4,eind] = astamp[mind]
+        amat[lind,eind,0:4] = astamp[mind]
+        amat[lind,eind,eind] = haa[mind]
+        bvec[lind,eind] = grad[mind,2]
+        # Unused amplitudes and proper motions that are not fit
+        diag = np.einsum('nii->ni',amat)
+        diag[np.arange(size).reshape(1,-1)>=4+nexp[stars].reshape(-1,1)] = 1.0
+        nopm, = np.where(fitpm[stars]==False)
+        for k in [2,3]:
+            amat[nopm,k,:] = 0.0
+            amat[nopm,:,k] = 0.0
+            amat[nopm,k,k] = 1.0
+            bvec[nopm,k] = 0.0
+        # Stars with no information in a parameter, e.g. zero amplitude
+        diag = np.einsum('nii->ni',amat)
+        diag[diag==0] = 1.0
+        try:
+            cov = np.linalg.inv(amat)
+        except np.linalg.LinAlgError:
+            cov = np.linalg.pinv(amat)
+        sol = np.einsum('nij,nj->ni',cov,bvec)
+        err = np.sqrt(np.abs(np.einsum('nii->ni',cov)))
+        sol[nopm,2:4] = 0.0
+        err[nopm,2:4] = 0.0
+        pars[stars] = sol[:,0:4]
+        perror[stars] = err[:,0:4]
+        amp[mind] = sol[lind,eind]
+        amperror[mind] = err[lind,eind]
+        lo = hi
+
+    return pars,perror,amp,amperror
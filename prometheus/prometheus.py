@@ -17,8 +17,9 @@ from astropy.table import Table,vstack
 import logging
 import time
 from dlnpyutils import utils as dln
-from . import detection, aperture, models, getpsf, allfit, utils
+from . import detection, aperture, models, getpsf, allfit, utils, engine as eng
 from .ccddata import CCDData
+from .metrics import Metrics,writemetrics,allfitcounts
 try:
     import __builtin__ as builtins # Python 2
 except ImportError:
@@ -29,7 +30,7 @@ except ImportError:
 def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthresh=5,
         psfsubnei=False,psffitradius=None,fitradius=None,npsfpix=51,binned=False,
         lookup=False,lorder=0,psftrim=None,recenter=True,reject=False,apcorr=False,
-        timestamp=False,verbose=False):
+        dtype=None,engine='python',nthreads=None,metrics=False,timestamp=False,verbose=False):
     """
     Run PSF photometry on an image.
 
@@ -75,6 +76,27 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
        When constructin the PSF, reject PSF stars with high RMS values.  Default is False.
     apcorr : boolean, optional
        Apply aperture correction.  Default is False.
+    dtype : data-type, optional
+       Data type of the image-sized arrays (data, error, sky, model) and the pixel
+         vectors used in the fitting, e.g. np.float32 to halve the memory use.
+         The least-squares solves are always done in double precision.  With float32
+         the PSF magnitudes agree with the float64 ones to better than 0.001 mag.
+         By default the data type of the input image is kept (float64 when reading
+         a file).
+    engine : str, optional
+       Compute engine: "python", "numba" or "static" (the AOT-compiled numba
+         modules).  Each stage uses the requested engine if it is available and
+         supports the inputs, otherwise it falls back to a slower one (see
+         engine.py).  Default is "python".
+    nthreads : int, optional
+       Number of threads to use for the PSF photometry of all stars with the
+         numba/static engines.  By default, the stars are fit serially.
+    metrics : boolean or str, optional
+       Collect the wall time, CPU time, peak RSS increase and counters
+         (detections, groups, PSF evaluations, iterations, ...) of each stage
+         (see metrics.py).  If True, the metrics record is returned as a fifth
+         output.  If it is a filename, the record is appended to that file as
+         one line of JSON.  Default is False.
     timestamp : boolean, optional
          Add timestamp in verbose output (if verbose=True). Default is False.       
     verbose : boolean, optional
@@ -90,6 +112,8 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
        The background sky image used for the image.
     psf : PSF object
        The best-fitting PSF model.
+    metrics : dict
+       The metrics record, only if metrics=True.
 
     Example
     -------
@@ -107,20 +131,28 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
 
     start = time.time()        
     print = utils.getprintfunc() # Get print function to be used locally, allows for easy logging   
+    met = Metrics(engine=engine,psfname=psfname,nthreads=nthreads,
+                  image=(image if isinstance(image,str) else None))
+    neval0 = models.PSFBase.nevaluations
     
     # Load the file
     if isinstance(image,str):
         filename = image
         if verbose:
             print('Loading image from "'+filename+'"')
-        image = CCDData.read(filename)
+        with met.stage('read'):
+            image = CCDData.read(filename,dtype=(float if dtype is None else dtype))
     if isinstance(image,CCDData) is False:
         raise ValueError('Input image must be a filename or CCDData object')
+    if dtype is not None and image.data.dtype != np.dtype(dtype):
+        image = image.datacopy(dtype=dtype)
 
     if verbose:
         print('Image shape ',image.shape)
     
-    residim = image.copy()
+    # Detect on the original image, only make a residual
+    #  image if iterating detection
+    residim = image
     
     # Processing steps
     #-----------------
@@ -133,9 +165,11 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
         #-------------
         if verbose:
             print('Step 1: Detection')
-        objects = detection.detect(residim,method=detmethod,
-                                   nsigma=ndetsigma,verbose=verbose)
-        objects['ndetiter'] = niter+1
+        with met.stage('detection',iter=niter+1) as st:
+            objects = eng.detect(residim,engine=engine,method=detmethod,
+                                 nsigma=ndetsigma,verbose=verbose)
+            objects['ndetiter'] = niter+1
+            st['ndetections'] = len(objects)
         if verbose:
             print(str(len(objects))+' objects detected')
     
@@ -143,8 +177,10 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
         #-----------------------
         if verbose:
             print('Step 2: Aperture photometry')    
-        objects = aperture.aperphot(residim,objects)
-        nobjects = len(objects)
+        with met.stage('aperphot',iter=niter+1) as st:
+            objects = aperture.aperphot(residim,objects)
+            nobjects = len(objects)
+            st['nobjects'] = nobjects
         # Bright and faint limit, use 5th and 95th percentile
         if niter==0:
             minmag, maxmag = np.nanpercentile(objects['mag_auto'],(5,95))
@@ -153,8 +189,13 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
 
         # Imposing S/N cut
         gd, = np.where((objects['snr'] >= snrthresh) & np.isfinite(objects['mag_auto']))
+        met.stages[-1]['nsnrcut'] = len(gd)
         if len(gd)==0:
             print('No objects passed S/N cut')
+            if metrics is True:
+                return None,None,None,None,met.record(nstars=0)
+            if isinstance(metrics,str):
+                writemetrics(metrics,met.record(nstars=0))
             return None,None,None,None
         objects = objects[gd]
         objects['id'] = np.arange(len(objects))+1  # renumber
@@ -170,12 +211,15 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
                 print('Step 3: Construct the PSF')
             # 3a) Estimate FWHM
             #------------------
-            fwhm = utils.estimatefwhm(objects,verbose=verbose)
+            with met.stage('estimatefwhm') as st:
+                fwhm = utils.estimatefwhm(objects,verbose=verbose)
+                st['fwhm'] = fwhm
     
             # 3b) Pick PSF stars
             #------------------
-            psfobj = utils.pickpsfstars(objects,fwhm,verbose=verbose)
-
+            with met.stage('pickpsfstars') as st:
+                psfobj = utils.pickpsfstars(objects,fwhm,verbose=verbose)
+                st['npsfstars'] = len(psfobj)
             
             # 3c) Construct the PSF iteratively
             #---------------------------------
@@ -185,9 +229,15 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
             else:
                 initpsf = models.psfmodel(psfname,npix=npsfpix,imshape=image.shape,order=lorder)
             # run getpsf
-            psf,psfpars,psfperror,psfcat = getpsf.getpsf(initpsf,image,psfobj,fitradius=psffitradius,
-                                                         lookup=lookup,lorder=lorder,subnei=psfsubnei,
-                                                         allcat=objects,reject=reject,verbose=(verbose>=2))
+            with met.stage('getpsf') as st:
+                neval1 = models.PSFBase.nevaluations
+                psf,psfpars,psfperror,psfcat = eng.getpsf(initpsf,image,psfobj,engine=engine,
+                                                          fitradius=psffitradius,lookup=lookup,lorder=lorder,
+                                                          subnei=psfsubnei,allcat=objects,reject=reject,
+                                                          verbose=verbose)
+                st['npsfstars'] = len(psfcat)
+                st['nrejected'] = int(np.sum(psfcat['reject']!=0)) if 'reject' in psfcat.colnames else 0
+                st['npsfeval'] = models.PSFBase.nevaluations-neval1
 
             # Trim the PSF
             if psftrim is not None:
@@ -218,12 +268,16 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
                 
         if verbose:
             print('Step 4: Get PSF photometry for all '+str(len(allobjects))+' objects')
-        psfout,model,sky = allfit.fit(psf,image,allobjects,fitradius=fitradius,
-                                      recenter=recenter,verbose=(verbose>=2))
+        with met.stage('allfit',iter=niter+1) as st:
+            neval1 = models.PSFBase.nevaluations
+            psfout,model,sky = eng.allfit(psf,image,allobjects,engine=engine,fitradius=fitradius,
+                                          recenter=recenter,nthreads=nthreads,verbose=verbose)
+            st.update(allfitcounts(psfout))
+            st['npsfeval'] = models.PSFBase.nevaluations-neval1
         
         # Construct residual image
         if iterdet>0:
-            residim = image.copy()
+            residim = image.datacopy(sky=False)
             residim.data -= model.data
             
         # Combine aperture and PSF columns
@@ -255,7 +309,8 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
     if apcorr:
         if verbose:
             print('Step 5: Applying aperture correction')
-        outobj,grow,cgrow = aperture.apercorr(psf,image,outobj,psfcat,verbose=verbose)
+        with met.stage('apercorr'):
+            outobj,grow,cgrow = aperture.apercorr(psf,image,outobj,psfcat,verbose=verbose)
 
     # Add exposure time correction
     exptime = image.header.get('exptime')
@@ -269,9 +324,10 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
         if image.wcs.has_celestial:
             if verbose:
                 print('Adding RA/DEC coordinates to catalog')
-            skyc = image.wcs.pixel_to_world(outobj['x'],outobj['y'])
-            outobj['ra'] = skyc.ra
-            outobj['dec'] = skyc.dec     
+            with met.stage('wcs'):
+                skyc = image.wcs.pixel_to_world(outobj['x'],outobj['y'])
+                outobj['ra'] = skyc.ra
+                outobj['dec'] = skyc.dec     
         
     if verbose:
         print('dt = %.2f sec' % (time.time()-start))
@@ -279,5 +335,13 @@ def run(image,psfname='gaussian',detmethod='sep',iterdet=0,ndetsigma=1.5,snrthre
     # Breakdown logger
     if timestamp and verbose:
         del builtins.logger
+
+    # Metrics record
+    if metrics is not False and metrics is not None:
+        record = met.record(shape=list(image.shape),nstars=len(outobj),
+                            npsfeval=models.PSFBase.nevaluations-neval0)
+        if metrics is True:
+            return outobj,model,sky,psf,record
+        writemetrics(metrics,record)
         
     return outobj,model,sky,psf
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+"""SERVICE.PY - Long-lived Prometheus worker service with a spool directory
+
+"""
+
+__authors__ = 'David Nidever <dnidever@montana.edu?'
+__version__ = '20261018'  # yyyymmdd
+
+
+import os
+import time
+import json
+import uuid
+import traceback
+import numpy as np
+import multiprocessing as mp
+from . import batch
+
+# The spool directory has these subdirectories:
+#  queue/    new jobs, written by submit()
+#  running/  jobs that a server has claimed (renamed from queue/)
+#  done/     status records of finished jobs, read by submit()
+# A file named STOP in the spool directory shuts down the server.
+
+
+def spooldirs(spooldir):
+    """ Create the spool subdirectories and return their names."""
+    dirs = [os.path.join(spooldir,d) for d in ['queue','running','done']]
+    for d in dirs:
+        if os.path.exists(d) is False:
+            os.makedirs(d,exist_ok=True)
+    return dirs
+
+
+def _writejson(filename,data):
+    """ Write a JSON file atomically."""
+    tmpfile = filename+'.'+str(os.getpid())+'.tmp'
+    with open(tmpfile,'w') as f:
+        json.dump(data,f)
+    os.replace(tmpfile,filename)
+
+
+def warmup(engines=None,verbose=0):
+    """
+    Run Prometheus once on a small synthetic image with each engine so that
+    all of the modules are imported and the kernels are compiled (or the
+    static modules are loaded).
+
+    Parameters
+    ----------
+    engines : list, optional
+       Compute engines to warm up, see engine.py.  The numba and static
+         engines are also run with threads to compile the parallel allfit.
+         Default is all of the engines that are available.
+    verbose : int, optional
+       Verbose output to the screen.  Default is 0.
+
+    Example
+    -------
+
+    warmup(['python','numba'])
+
+    """
+    from . import synth, engine as eng, prometheus as pm
+    t0 = time.time()
+    if engines is None:
+        engines = [e for e in eng.ENGINES if eng.available(e)]
+    if isinstance(engines,str):
+        engines = [engines]
+    state = np.random.get_state()
+    np.random.seed(1)
+    image = synth.makeimage(nstars=50,nx=256,ny=256)
+    np.random.set_state(state)
+    for e in engines:
+        if eng.available(e) is False:
+            if verbose>0:
+                print('Engine '+str(e)+' is not available, not warming it up')
+            continue
+        for nthreads in ([None] if e=='python' else [None,2]):
+            try:
+                pm.run(image,psfname='gaussian',engine=e,nthreads=nthreads,verbose=False)
+            except Exception:
+                if verbose>0:
+                    traceback.print_exc()
+    if verbose>0:
+        print('Worker %d warmed up %s in %.2f sec' % (os.getpid(),', '.join(engines),time.time()-t0))
+
+
+def initworker(sem,dowarmup=True,engines=None,verbose=0):
+    """ Initialize a service worker process."""
+    batch.initworker(sem)
+    if dowarmup:
+        warmup(engines,verbose)
+
+
+def submit(spooldir,files,wait=True,timeout=None,poll=0.5,outfile=None,outdir=None,
+           resume=False,manifest=None,saveopts=None,**kwargs):
+    """
+    Submit a job to a running Prometheus service.
+
+    Parameters
+    ----------
+    spooldir : str
+       Spool directory of the service.
+    files : list
+       List of image filenames.  Relative names are converted to absolute paths.
+    wait : bool, optional
+       Wait for the job to finish and return the status records.  Default is True.
+    timeout : float, optional
+       Maximum time to wait in seconds.  Default is to wait forever.
+    poll : float, optional
+       Polling interval in seconds.  Default is 0.5.
+    outfile : str, optional
+       Output filename, only used with a single image.
+    outdir : str, optional
+       Output directory.  By default, the directory of each image is used.
+    resume : bool, optional
+       Skip images that already have a complete output file.  Default is False.
+    manifest : str, optional
+       JSON-lines file that the server appends status records to.
+    saveopts : dict, optional
+       Output options passed to utils.saveoutput().
+    kwargs : dict
+       Other keyword arguments passed to prometheus.run().  They must be
+         JSON serializable, e.g. dtype='float32'.
+
+    Returns
+    -------
+    records : list
+       List of status records, one per image, if wait=True.  Otherwise,
+         the job ID.
+
+    Example
+    -------
+
+    records = submit('/tmp/prometheus',files,outdir='out')
+
+    """
+    qdir,rdir,ddir = spooldirs(spooldir)
+    if isinstance(files,str):
+        files = [files]
+    if len(files)==0:
+        raise ValueError('No files to submit')
+    absfile = lambda f: os.path.abspath(f) if f is not None and f!='' else f
+    jobid = time.strftime('%Y%m%d%H%M%S')+'-'+uuid.uuid4().hex[:8]
+    if 'dtype' in kwargs and kwargs['dtype'] is not None:
+        kwargs['dtype'] = np.dtype(kwargs['dtype']).name
+    job = {'jobid':jobid, 'files':[absfile(f) for f in files], 'outfile':absfile(outfile),
+           'outdir':absfile(outdir), 'resume':resume, 'manifest':absfile(manifest),
+           'saveopts':saveopts, 'runkw':kwargs}
+    _writejson(os.path.join(qdir,jobid+'.json'),job)
+    if wait is False:
+        return jobid
+
+    # Wait for the job to finish
+    t0 = time.time()
+    donefile = os.path.join(ddir,jobid+'.json')
+    while os.path.exists(donefile) is False:
+        if timeout is not None and time.time()-t0 > timeout:
+            raise TimeoutError('Job '+jobid+' did not finish in '+str(timeout)+' sec')
+        time.sleep(poll)
+    with open(donefile,'r') as f:
+        out = json.load(f)
+    os.remove(donefile)
+    return out['records']
+
+
+def stop(spooldir):
+    """ Tell a running Prometheus service to shut down."""
+    spooldirs(spooldir)
+    open(os.path.join(spooldir,'STOP'),'w').close()
+
+
+def serve(spooldir,nproc=1,poll=0.5,dowarmup=True,engines=None,maxlarge=None,
+          largepix=batch.LARGEPIX,verbose=0):
+    """
+    Run a Prometheus service that processes jobs from a spool directory.
+
+    A pool of worker processes is started once and kept alive, so the
+    cost of importing the modules and compiling the kernels is only paid
+    at startup and not for every image.  Jobs are JSON files written to
+    the queue/ subdirectory by submit().  A job is claimed by renaming it
+    to running/ and its status records are written to done/ when all of
+    its images are finished.  The images of all claimed jobs share the
+    worker pool.  Create a STOP file (see stop()) to shut down.
+
+    Parameters
+    ----------
+    spooldir : str
+       Spool directory.
+    nproc : int, optional
+       Number of worker processes.  Default is 1.
+    poll : float, optional
+       Polling interval for new jobs in seconds.  Default is 0.5.
+    dowarmup : bool, optional
+       Run each worker once on a small synthetic image at startup.  Default is True.
+    engines : list, optional
+       Compute engines to warm up in the workers, e.g. the engine the jobs
+         will use.  Default is all of the available engines.
+    maxlarge : int, optional
+       Maximum number of large images processed at the same time.  Default is nproc.
+    largepix : int, optional
+       Number of pixels above which an image counts as large.  Default is 4096*4096.
+    verbose : int, optional
+       Verbose output to the screen.  Default is 0.
+
+    Returns
+    -------
+    Runs until stopped.
+
+    Example
+    -------
+
+    serve('/tmp/prometheus',nproc=4)
+
+    """
+    qdir,rdir,ddir = spooldirs(spooldir)
+    stopfile = os.path.join(spooldir,'STOP')
+    if os.path.exists(stopfile): os.remove(stopfile)
+    nproc = max(int(nproc),1)
+    if maxlarge is None:
+        maxlarge = nproc
+    sem = mp.BoundedSemaphore(max(int(maxlarge),1))
+    pool = mp.Pool(nproc,initializer=initworker,initargs=(sem,dowarmup,engines,verbose))
+    if verbose>0:
+        print('Prometheus service running on '+spooldir+' with %d workers' % nproc)
+
+    jobs = {}      # claimed jobs
+    pending = []   # (jobid, index, AsyncResult)
+    try:
+        while os.path.exists(stopfile) is False:
+            # Claim new jobs
+            for jfile in sorted(os.listdir(qdir)):
+                if jfile.endswith('.json') is False:
+                    continue
+                runfile = os.path.join(rdir,jfile)
+                try:
+                    os.rename(os.path.join(qdir,jfile),runfile)
+                except OSError:
+                    continue   # another server got it
+                try:
+                    with open(runfile,'r') as f:
+                        job = json.load(f)
+                except Exception:
+                    if verbose>0:
+                        traceback.print_exc()
+                    os.remove(runfile)
+                    continue
+                jobid = job['jobid']
+                files = job['files']
+                runkw = job.get('runkw',{})
+                pkw = dict(runkw)
+                pkw.update({'outfile':job['outfile'] if len(files)==1 else None,
+                            'outdir':job['outdir'], 'resume':job['resume'], 'largepix':largepix,
+                            'saveopts':job.get('saveopts'), 'verbose':max(verbose-1,0)})
+                if pkw.get('dtype') is not None:
+                    pkw['dtype'] = np.dtype(pkw['dtype'])
+                jobs[jobid] = {'job':job, 'runfile':runfile, 'records':[None]*len(files),
+                               'nleft':len(files), 'mfile':None, 't0':time.time()}
+                # Nothing to do, finish the job right away
+                if len(files)==0:
+                    _writejson(os.path.join(ddir,jobid+'.json'),
+                               {'jobid':jobid, 'records':[], 'ttotal':0.0})
+                    os.remove(runfile)
+                    del jobs[jobid]
+                    continue
+                if job.get('manifest') is not None:
+                    jobs[jobid]['mfile'] = open(job['manifest'],'a')
+                for i,f in enumerate(files):
+                    pending.append((jobid,i,pool.apply_async(batch._processfile,((i,f,pkw),))))
+                if verbose>0:
+                    print('Job %s: %d images' % (jobid,len(files)))
+
+            # Collect finished images
+            stillpending = []
+            for jobid,i,res in pending:
+                if res.ready() is False:
+                    stillpending.append((jobid,i,res))
+                    continue
+                try:
+                    rec = res.get()[1]
+                except Exception:
+                    rec = batch.newrecord(jobs[jobid]['job']['files'][i],None)
+                    rec['status'] = 'failed'
+                    rec['error'] = traceback.format_exc()
+                jb = jobs[jobid]
+                jb['records'][i] = rec
+                jb['nleft'] -= 1
+                if jb['mfile'] is not None:
+                    jb['mfile'].write(json.dumps(rec)+'\n')
+                    jb['mfile'].flush()
+                # Job finished
+                if jb['nleft']==0:
+                    if jb['mfile'] is not None:
+                        jb['mfile'].close()
+                    _writejson(os.path.join(ddir,jobid+'.json'),
+                               {'jobid':jobid, 'records':jb['records'],
+                                'ttotal':time.time()-jb['t0']})
+                    os.remove(jb['runfile'])
+                    if verbose>0:
+                        status = [r['status'] for r in jb['records']]
+                        print('Job %s finished: %d done, %d failed in %.2f sec' %
+                              (jobid,status.count('done'),status.count('failed'),
+                               time.time()-jb['t0']))
+                    del jobs[jobid]
+            pending = stillpending
+            if len(pending)==0:
+                time.sleep(poll)
+            else:
+                time.sleep(min(poll,0.05))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
+        pool.join()
+        # Put unfinished jobs back in the queue
+        for jobid in jobs:
+            if jobs[jobid]['mfile'] is not None:
+                jobs[jobid]['mfile'].close()
+            if os.path.exists(jobs[jobid]['runfile']):
+                os.rename(jobs[jobid]['runfile'],os.path.join(qdir,jobid+'.json'))
+        if os.path.exists(stopfile): os.remove(stopfile)
+    if verbose>0:
+        print('Prometheus service stopped')
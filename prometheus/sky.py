@@ -44,3 +44,76 @@ def photutilsky(image, box_size=(50,50), filter_size=(3,3)):
     bkg = Background2D(image.data, box_size, mask=image.mask, filter_size=filter_size,
                        sigma_clip=sigma_clip)
     return bkg.background
+
+def meshnodes(n,box):
+    """ Pixel positions of the low-resolution sky mesh nodes along one axis."""
+    return np.unique(np.concatenate(([0],np.arange(box//2,n,box),[n-1])))
+
+def skymesh(sky,box_size=(64,64)):
+    """
+    Reduce a sky image to a low-resolution mesh.
+
+    The sky is sampled at the centers of the box_size cells (and at the
+    image edges), which is where sep and photutils put their mesh.  The
+    full sky image can be reconstructed with meshsky().
+
+    Parameters
+    ----------
+    sky : numpy array
+       The full-resolution sky image.
+    box_size : tuple, optional
+       Size of the mesh cells (ny,nx).  Default is (64,64).
+
+    Returns
+    -------
+    mesh : numpy array
+       The sky values at the mesh nodes.
+
+    Example
+    -------
+
+    mesh = skymesh(sky)
+
+    """
+    ny,nx = sky.shape
+    ynodes = meshnodes(ny,box_size[0])
+    xnodes = meshnodes(nx,box_size[1])
+    return sky[np.ix_(ynodes,xnodes)].copy()
+
+def meshsky(mesh,shape,box_size=(64,64),dtype=float):
+    """
+    Reconstruct a full sky image from a low-resolution mesh.
+
+    Parameters
+    ----------
+    mesh : numpy array
+       The sky values at the mesh nodes from skymesh().
+    shape : tuple
+       Shape of the full sky image (ny,nx).
+    box_size : tuple, optional
+       Size of the mesh cells (ny,nx).  Default is (64,64).
+    dtype : data-type, optional
+       Data type of the output sky image.  Default is float.
+
+    Returns
+    -------
+    sky : numpy array
+       The bicubic spline interpolated sky image.
+
+    Example
+    -------
+
+    sky = meshsky(mesh,(2048,2048))
+
+    """
+    from scipy.interpolate import RectBivariateSpline
+    ny,nx = shape
+    ynodes = meshnodes(ny,box_size[0])
+    xnodes = meshnodes(nx,box_size[1])
+    # spline degree along the y (first) and x (second) axes
+    k0 = min(3,len(ynodes)-1)
+    k1 = min(3,len(xnodes)-1)
+    if k0<1 or k1<1:
+        return np.zeros(shape,dtype)+np.mean(mesh)
+    spl = RectBivariateSpline(ynodes,xnodes,mesh,kx=k0,ky=k1)
+    return spl(np.arange(ny),np.arange(nx)).astype(dtype)
@@ -0,0 +1,25 @@
+import numpy as np
+from prometheus import engine
+
+def tests():
+    engine_tests()
+
+def engine_tests():
+    """  Testing that all of the available engines agree with python."""
+
+    ###############
+    # ENGINES
+    ###############
+
+    assert engine.available('python')
+    print('engine.available() okay')
+
+    # synth.makeimage() image run through prometheus.run() with every engine
+    engines = [e for e in engine.ENGINES[1:] if engine.available(e)]
+    res = engine.checkengines(engines=engines,verbose=True)
+    assert len(res)==len(engines)+1
+    assert list(res['engine'])==['python']+engines
+    for r in res:
+        assert r['passed'], 'engine '+r['engine']+' does not agree with python'
+        assert r['nstars'] > 0
+    print('engine.checkengines() okay')
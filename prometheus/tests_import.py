@@ -0,0 +1,18 @@
+from prometheus import utils
+
+def tests():
+    importtime_tests()
+
+def importtime_tests():
+    """  Testing that "import prometheus" stays below the 0.5 sec target."""
+
+    ###############
+    # IMPORT TIME
+    ###############
+
+    dt = utils.importtime('prometheus')
+    assert dt < 0.5, 'import prometheus took {:.3f} sec'.format(dt)
+    print('import prometheus {:.3f} sec okay'.format(dt))
+
+    assert utils.checkimporttime(['prometheus'],target=0.5,verbose=False)
+    print('utils.checkimporttime() okay')
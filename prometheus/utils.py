@@ -22,6 +22,7 @@ from scipy.spatial import cKDTree
 from dlnpyutils import utils as dln,ladfit
 from . import detection, models, getpsf, allfit, leastsquares as lsq
 from .ccddata import CCDData
+from .sky import skymesh, meshsky
 from . import __version__ as version
 
 try:
@@ -237,10 +238,32 @@ def refresh_mmap(hdulist):
         if hasattr(h,'data'):
             del h.data
 
-def saveoutput(filename,outfile,out,model,sky,psf):
+def _imagehdu(im,compress=None,dtype=None):
+    """ Convert an image to an HDU, optionally tile-compressed."""
+    hdu = im.tohdu() if hasattr(im,'tohdu') else fits.ImageHDU(im)
+    data = hdu.data
+    if compress is not None:
+        ctype = {'rice':'RICE_1','hcompress':'HCOMPRESS_1','gzip':'GZIP_1'}.get(compress.lower(),compress.upper())
+        data = data.astype(np.float32 if dtype is None else dtype)
+        hdr = hdu.header.copy()
+        for k in ['SIMPLE','EXTEND','BITPIX','NAXIS','NAXIS1','NAXIS2']:
+            if k in hdr: del hdr[k]
+        return fits.CompImageHDU(data,hdr,compression_type=ctype)
+    if dtype is not None and data.dtype != np.dtype(dtype):
+        hdu.data = data.astype(dtype)
+    return fits.ImageHDU(hdu.data,hdu.header)
+
+def saveoutput(filename,outfile,out,model,sky,psf,compress=None,dtype=None,
+               savemodel=True,skytype='full',skybox=(64,64),catformat='fits',catfile=None):
     """
     Save Prometheus output to a file.
 
+    The HDU layout is always the same: HDU1 source catalog, HDU2 model,
+    HDU3 sky and HDU4 PSF.  Omitted products are written as empty HDUs
+    with OMITTED=True and a Parquet catalog is written next to the FITS
+    file and referenced with the CATFILE keyword of HDU1.  Use
+    loadoutput() to read all of the formats back in.
+
     Parameters
     ----------
     filename : str
@@ -255,6 +278,28 @@ def saveoutput(filename,outfile,out,model,sky,psf):
        The background sky image used for the image.
     psf : PSF object
        The best-fitting PSF model.
+    compress : str, optional
+       Tile-compress the model and sky images with "rice", "hcompress" or
+         "gzip".  Compressed images are stored as float32 and are lossy
+         (quantized).  Default is no compression.
+    dtype : data-type, optional
+       Data type of the model and sky images.  By default, the type of
+         the arrays is kept (float32 with compression).
+    savemodel : bool, optional
+       Save the model image.  Default is True.
+    skytype : str, optional
+       How to save the sky: "full" image, low-resolution "mesh" (see
+         sky.skymesh()) or "none".  The mesh is only a good representation
+         of a smooth background, so pass the image background (image.sky)
+         and not the fitted sky from allfit with "mesh".  Default is "full".
+    skybox : tuple, optional
+       Size of the sky mesh cells (ny,nx) with skytype="mesh".  Default is (64,64).
+    catformat : str, optional
+       Format of the source catalog: "fits" (table in HDU1) or "parquet"
+         (separate .parquet file, needs pyarrow).  Default is "fits".
+    catfile : str, optional
+       Filename of the Parquet catalog.  By default, outfile with the
+         extension changed to .parquet.
     
     Returns
     -------
@@ -265,11 +310,30 @@ def saveoutput(filename,outfile,out,model,sky,psf):
 
     saveoutput(filename,outfile,out,model,sky,psf)
 
+    saveoutput(filename,outfile,out,model,sky,psf,compress='rice',skytype='mesh')
+
     """
+
+    skytype = str(skytype).lower()
+    catformat = str(catformat).lower()
+    if skytype not in ['full','mesh','none']:
+        raise ValueError('skytype must be full, mesh or none')
+    if catformat not in ['fits','parquet']:
+        raise ValueError('catformat must be fits or parquet')
     
     if os.path.exists(outfile): os.remove(outfile)
     hdulist = fits.HDUList()
-    hdulist.append(fits.table_to_hdu(out))  # table    
+    if catformat=='parquet':
+        if catfile is None:
+            catfile = os.path.splitext(outfile)[0]+'.parquet'
+        if os.path.exists(catfile): os.remove(catfile)
+        out.write(catfile,format='parquet')
+        hdulist.append(fits.BinTableHDU())
+        hdulist[1].header['CATFILE'] = os.path.basename(catfile)
+        hdulist[1].header['CATFMT'] = 'PARQUET'
+        hdulist[1].header['NSOURCES'] = len(out)
+    else:
+        hdulist.append(fits.table_to_hdu(out))  # table    
     hdulist[0].header['COMMENT']='Prometheus version '+str(version)
     hdulist[0].header['COMMENT']='Date '+datetime.now().ctime()
     hdulist[0].header['COMMENT']='File '+filename
@@ -278,10 +342,32 @@ def saveoutput(filename,outfile,out,model,sky,psf):
     hdulist[0].header['COMMENT']='HDU#2 : Model image'
     hdulist[0].header['COMMENT']='HDU#3 : Sky model image'
     hdulist[0].header['COMMENT']='HDU#4 : PSF model'
+    hdulist[1].header['EXTNAME'] = 'SOURCE TABLE'
     hdulist[1].header['COMMENT'] = 'Prometheus source catalog'
-    hdulist.append(model.tohdu())  # model
+    # model
+    if savemodel:
+        hdulist.append(_imagehdu(model,compress,dtype))
+    else:
+        hdulist.append(fits.ImageHDU())
+        hdulist[2].header['OMITTED'] = True
+    hdulist[2].header['EXTNAME'] = 'MODEL IMAGE'
     hdulist[2].header['COMMENT'] = 'Prometheus model image'
-    hdulist.append(sky.tohdu())    # sky
+    # sky
+    skyim = sky.data if hasattr(sky,'data') else sky
+    if skytype=='mesh':
+        mesh = skymesh(np.asarray(skyim),skybox)
+        hdulist.append(fits.ImageHDU(mesh.astype(skyim.dtype if dtype is None else dtype)))
+        hdulist[3].header['SKYTYPE'] = 'MESH'
+        hdulist[3].header['SKYNX'] = skyim.shape[1]
+        hdulist[3].header['SKYNY'] = skyim.shape[0]
+        hdulist[3].header['SKYBOXX'] = skybox[1]
+        hdulist[3].header['SKYBOXY'] = skybox[0]
+    elif skytype=='none':
+        hdulist.append(fits.ImageHDU())
+        hdulist[3].header['OMITTED'] = True
+    else:
+        hdulist.append(_imagehdu(sky,compress,dtype))
+    hdulist[3].header['EXTNAME'] = 'SKY MODEL IMAGE'
     hdulist[3].header['COMMENT'] = 'Prometheus sky image'
     psfhdu = psf.tohdu()
     # psf, could be 2 HDUs
@@ -289,10 +375,157 @@ def saveoutput(filename,outfile,out,model,sky,psf):
         for h in psfhdu:
             hdulist.append(h)
         hdulist[4].header['COMMENT'] = 'Prometheus PSF model'
-        hdulist[5].header['COMMENT'] = 'Prometheus PSF model lookup table'        
+        if len(psfhdu)>1:
+            hdulist[5].header['COMMENT'] = 'Prometheus PSF model lookup table'
     else:
         hdulist.append(psfhdu)     # psf
         hdulist[4].header['COMMENT'] = 'Prometheus PSF model'
     hdulist.writeto(outfile,overwrite=True)
     hdulist.close()
+
+def loadcatalog(outfile):
+    """
+    Load the source catalog from a Prometheus output file.
+
+    Parameters
+    ----------
+    outfile : str
+       Filename of the Prometheus output file.
+
+    Returns
+    -------
+    cat : table
+       The source catalog, from HDU1 or the Parquet file it references.
+
+    Example
+    -------
+
+    cat = loadcatalog(outfile)
+
+    """
+    head = fits.getheader(outfile,1)
+    catfile = head.get('CATFILE')
+    if catfile is not None:
+        catfile = os.path.join(os.path.dirname(outfile),catfile)
+        return Table.read(catfile,format='parquet')
+    return Table.read(outfile,1)
+
+def loadoutput(outfile,model=True,sky=True):
+    """
+    Load a Prometheus output file written by saveoutput().
+
+    Parameters
+    ----------
+    outfile : str
+       Filename of the Prometheus output file.
+    model : bool, optional
+       Load the model image.  Default is True.
+    sky : bool, optional
+       Load the sky image, a sky mesh is interpolated to the full image.
+         Default is True.
+
+    Returns
+    -------
+    cat : table
+       The source catalog.
+    model : numpy array
+       The model image, None if it was not saved or not requested.
+    sky : numpy array
+       The sky image, None if it was not saved or not requested.
+    psf : PSF object
+       The PSF model.
+
+    Example
+    -------
+
+    cat,model,sky,psf = loadoutput(outfile)
+
+    """
+    cat = loadcatalog(outfile)
+    modelim,skyim = None,None
+    with fits.open(outfile) as hdulist:
+        if model and hdulist[2].header.get('OMITTED') is not True:
+            modelim = np.asarray(hdulist[2].data).copy()
+        if sky and hdulist[3].header.get('OMITTED') is not True:
+            head = hdulist[3].header
+            if head.get('SKYTYPE','').upper()=='MESH':
+                skyim = meshsky(hdulist[3].data,(head['SKYNY'],head['SKYNX']),
+                                (head['SKYBOXY'],head['SKYBOXX']),hdulist[3].data.dtype.newbyteorder('='))
+            else:
+                skyim = np.asarray(hdulist[3].data).copy()
+    psf = models.read(outfile,4)
+    return cat,modelim,skyim,psf
     
+
+def importtime(module='prometheus',nrepeat=3):
+    """
+    Measure the time to import a module in a fresh python process, using
+    "python -X importtime".
+
+    Parameters
+    ----------
+    module : str, optional
+       Name of the module.  Default is "prometheus".
+    nrepeat : int, optional
+       Number of measurements, the fastest is returned.  Default is 3.
+
+    Returns
+    -------
+    dt : float
+       Cumulative import time in seconds.
+
+    Example
+    -------
+
+    dt = importtime('prometheus')
+
+    """
+    import subprocess
+    pkgdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = pkgdir+os.pathsep+env.get('PYTHONPATH','')
+    dt = np.inf
+    for i in range(nrepeat):
+        res = subprocess.run([sys.executable,'-X','importtime','-c','import '+module],
+                             capture_output=True,text=True,env=env)
+        if res.returncode != 0:
+            raise RuntimeError('Could not import '+module+'\n'+res.stderr)
+        # lines are "import time: self [us] | cumulative | imported package"
+        for line in res.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts)==3 and parts[2].strip()==module:
+                dt = min(dt,int(parts[1])/1e6)
+    return dt
+
+
+def checkimporttime(modules=['prometheus'],target=0.5,verbose=True):
+    """
+    Check that the import time of modules is below a target.
+
+    Parameters
+    ----------
+    modules : list, optional
+       Names of the modules.  Default is ['prometheus'].
+    target : float, optional
+       Maximum import time in seconds.  Default is 0.5.
+    verbose : boolean, optional
+       Print the results.  Default is True.
+
+    Returns
+    -------
+    passed : bool
+       True if all modules import in less than the target time.
+
+    Example
+    -------
+
+    passed = checkimporttime()
+
+    """
+    passed = True
+    for m in modules:
+        dt = importtime(m)
+        passed &= (dt < target)
+        if verbose:
+            print('import %-25s %6.3f sec  %s' % (m,dt,'PASSED' if dt<target else 'FAILED'))
+    return passed
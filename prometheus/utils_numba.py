@@ -1,7 +1,8 @@
 import os
 import numpy as np
 import numba
-from numba import njit,types,from_dtype,typed
+from numba import types,from_dtype,typed
+from .compiled import njit   # njit with on-disk caching
 from numba.typed import Dict,List
 from numba.experimental import jitclass
 from numba_kdtree import KDTree
@@ -1230,7 +1231,9 @@ def skygrid(im,binsize,tot=0,med=1):
     nx2 = nx // binsize
     bgim = np.zeros((ny2,nx2),float)
     nsample = np.minimum(1000,binsize*binsize)
-    sample = np.random.randint(0,binsize*binsize-1,nsample)
+    # Evenly spaced sample, numba's random generator is seeded per process/thread
+    #  and the sky has to be the same for every run
+    sample = (np.arange(nsample)*(binsize*binsize))//nsample
     for i in range(nx2):
         for j in range(ny2):
             x1 = i*binsize
@@ -184,11 +184,12 @@ def mean3d(data,axis=-1,ignore_nan=False):
 @cc.export('nanmediani', 'i8(i8[:])')
 def nanmedian(data):
     """ Get the median ignoring nans """
-    gd, = np.where(np.isfinite(data)==True)
+    data1d = data.ravel()
+    gd, = np.where(np.isfinite(data1d)==True)
     if len(gd)==0:
         med = np.nan
     else:
-        med = np.median(data[gd])
+        med = np.median(data1d[gd])
     return med
 
 @njit
@@ -1159,7 +1160,9 @@ def skygrid(im,binsize,tot=0,med=1):
     nx2 = nx // binsize
     bgim = np.zeros((ny2,nx2),float)
     nsample = np.minimum(1000,binsize*binsize)
-    sample = np.random.randint(0,binsize*binsize-1,nsample)
+    # Evenly spaced sample, numba's random generator is seeded per process/thread
+    #  and the sky has to be the same for every run
+    sample = (np.arange(nsample)*(binsize*binsize))//nsample
     for i in range(nx2):
         for j in range(ny2):
             x1 = i*binsize
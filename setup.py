@@ -1,7 +1,41 @@
 #!/usr/bin/env python
 
 #from distutils.core import setup
+import os
+import sys
+import subprocess
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+from setuptools.dist import Distribution
+
+# AOT-compiled numba modules, prometheus/NAME_numba_static.py is compiled
+#  into the prometheus._NAME_numba_static extension module
+staticmodules = ['utils','ladfit','models','getpsf','groupfit','allfit']
+
+class BuildStatic(build_py):
+    """ Build the package and compile the numba.pycc modules into it.
+        This needs numba in the build environment (pip install --no-build-isolation)
+        and takes a while.  Set PROMETHEUS_NO_STATIC=1 to skip it, prometheus
+        then falls back to the JIT-compiled modules."""
+    def run(self):
+        build_py.run(self)
+        if os.environ.get('PROMETHEUS_NO_STATIC','0') not in ['0','']:
+            return
+        pkgdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'prometheus')
+        outdir = os.path.abspath(os.path.join(self.build_lib,'prometheus'))
+        for name in staticmodules:
+            print('Compiling prometheus._'+name+'_numba_static')
+            code = ('import sys; sys.path.insert(0,%r); import %s_numba_static as m; '
+                    'm.cc.output_dir = %r; m.cc.compile()') % (pkgdir,name,outdir)
+            res = subprocess.run([sys.executable,'-c',code],cwd=pkgdir)
+            if res.returncode != 0:
+                print('WARNING: Could not compile prometheus._'+name+'_numba_static. '
+                      'The JIT version will be used.')
+
+class BinaryDistribution(Distribution):
+    """ The package includes compiled extension modules."""
+    def has_ext_modules(self):
+        return True
 
 # Change name to "theprometheus" when you want to
 #  load to PYPI
@@ -15,6 +49,8 @@ setup(name="prometheus",
       url='https://github.com/dnidever/prometheus',
       packages=find_packages(exclude=["tests"]),
       scripts=['bin/prometheus'],
+      cmdclass={'build_py':BuildStatic},
+      distclass=BinaryDistribution,
       requires=['numpy','astropy(>=4.0)','scipy','dlnpyutils','sep','extension_helpers','photutils','skimage'],
 #      include_package_data=True,
 )